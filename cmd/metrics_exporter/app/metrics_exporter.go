@@ -21,6 +21,7 @@ import (
 	"os"
 	"os/signal"
 	"syscall"
+	"time"
 
 	log "github.com/golang/glog"
 	// log "k8s.io/klog"
@@ -57,6 +58,18 @@ var (
 	metricsEP string
 
 	chiListEP string
+
+	// collectInterval defines how often metrics are collected from ClickHouse in background, scrapes collect when 0
+	collectInterval time.Duration
+
+	// collectWorkers defines how many ClickHouse hosts are collected from at once
+	collectWorkers int
+
+	// hostTimeout defines how long all queries to one ClickHouse host may take together
+	hostTimeout time.Duration
+
+	// combinedFetch defines whether all metrics of a ClickHouse host are fetched with one query
+	combinedFetch bool
 )
 
 func init() {
@@ -66,6 +79,10 @@ func init() {
 	flag.StringVar(&masterURL, "master", "", "The address of custom Kubernetes API server. Makes sense if runs outside of the cluster and not being specified in kube config file only.")
 	flag.StringVar(&metricsEP, "metrics-endpoint", defaultMetricsEndpoint, "The Prometheus exporter endpoint.")
 	flag.StringVar(&chiListEP, "chi-list-endpoint", defaultChiListEP, "The CHI list endpoint.")
+	flag.DurationVar(&collectInterval, "metrics-collect-interval", 0, "Collect metrics from ClickHouse hosts in background on this interval and serve the latest collected ones on scrape. Every scrape queries all hosts when 0.")
+	flag.IntVar(&collectWorkers, "metrics-collect-workers", 32, "How many ClickHouse hosts are collected from at once.")
+	flag.DurationVar(&hostTimeout, "metrics-host-timeout", 10*time.Second, "How long all queries to one ClickHouse host may take together, the host is reported failed after that.")
+	flag.BoolVar(&combinedFetch, "metrics-combined-fetch", false, "Fetch all metrics of a ClickHouse host with one query instead of one query per group of metrics.")
 	flag.Parse()
 }
 
@@ -97,18 +114,25 @@ func Run() {
 	chop.SetupLog()
 	log.Info(chop.Config().String(true))
 
+	chAccess := metrics.NewCHAccessInfo(
+		chop.Config().CHUsername,
+		chop.Config().CHPassword,
+		chop.Config().CHPort,
+	)
+	chAccess.Timeout = hostTimeout
+
 	exporter := metrics.StartMetricsREST(
-		metrics.NewCHAccessInfo(
-			chop.Config().CHUsername,
-			chop.Config().CHPassword,
-			chop.Config().CHPort,
-		),
+		chAccess,
 
 		metricsEP,
 		metricsPath,
 
 		chiListEP,
 		chiListPath,
+
+		collectInterval,
+		collectWorkers,
+		combinedFetch,
 	)
 
 	exporter.DiscoveryWatchedCHIs(chop, chopClient)
@@ -15,6 +15,7 @@
 package metrics
 
 import (
+	"context"
 	sqlmodule "database/sql"
 	"time"
 
@@ -123,6 +124,66 @@ const (
 	`
 )
 
+// fetch types, as reported in fetch_type label of chi_clickhouse_metric_fetch_errors
+const (
+	fetchTypeMetrics        = "system.metrics"
+	fetchTypeTableSizes     = "table sizes"
+	fetchTypeSystemReplicas = "system.replicas"
+	fetchTypeMutations      = "system.mutations"
+	fetchTypeSystemDisks    = "system.disks"
+	// fetchTypeCombined rows are the rows of all other fetch types, each tagged with its fetch type
+	fetchTypeCombined = "combined"
+)
+
+// queryCombinedSQL fetches all groups of metrics in one round-trip. Every row is its fetch type followed by
+// the columns of its group, padded with empty strings to the widest group, see demultiplexFetched
+const queryCombinedSQL = `
+	SELECT '` + fetchTypeMetrics + `' AS fetch_type, metric AS c1, value AS c2, description AS c3, type AS c4,
+		'' AS c5, '' AS c6, '' AS c7, '' AS c8
+	FROM (` + queryMetricsSQL + `)
+	UNION ALL
+	SELECT '` + fetchTypeTableSizes + `', database, table, active, partitions, parts, bytes, uncompressed_bytes, rows
+	FROM (` + queryTableSizesSQL + `)
+	UNION ALL
+	SELECT '` + fetchTypeSystemReplicas + `', database, table, is_session_expired, '', '', '', '', ''
+	FROM (` + querySystemReplicasSQL + `)
+	UNION ALL
+	SELECT '` + fetchTypeMutations + `', database, table, toString(mutations), toString(parts_to_do), '', '', '', ''
+	FROM (` + queryMutationsSQL + `)
+	UNION ALL
+	SELECT '` + fetchTypeSystemDisks + `', name, free_space, total_space, '', '', '', '', ''
+	FROM (` + querySystemDisksSQL + `)
+`
+
+// combinedFetchTypes lists the fetch types queryCombinedSQL fetches, in order, with the column count of their rows
+var combinedFetchTypes = []struct {
+	fetchType string
+	columns   int
+}{
+	{fetchTypeMetrics, 4},
+	{fetchTypeTableSizes, 8},
+	{fetchTypeSystemReplicas, 3},
+	{fetchTypeMutations, 4},
+	{fetchTypeSystemDisks, 3},
+}
+
+// hostFetch is the outcome of querying one host for one group of metrics
+type hostFetch struct {
+	fetchType string
+	data      [][]string
+	err       error
+}
+
+// fetchSucceeded tells whether all groups of metrics were fetched
+func fetchSucceeded(fetched []hostFetch) bool {
+	for _, f := range fetched {
+		if f.err != nil {
+			return false
+		}
+	}
+	return true
+}
+
 type ClickHouseFetcher struct {
 	chConnectionParams *clickhouse.CHConnectionParams
 }
@@ -142,8 +203,9 @@ func (f *ClickHouseFetcher) getCHConnection() *clickhouse.CHConnection {
 }
 
 // getClickHouseQueryMetrics requests metrics data from ClickHouse
-func (f *ClickHouseFetcher) getClickHouseQueryMetrics() ([][]string, error) {
+func (f *ClickHouseFetcher) getClickHouseQueryMetrics(ctx context.Context) ([][]string, error) {
 	return f.clickHouseQueryScanRows(
+		ctx,
 		queryMetricsSQL,
 		func(rows *sqlmodule.Rows, data *[][]string) error {
 			var metric, value, description, _type string
@@ -156,8 +218,9 @@ func (f *ClickHouseFetcher) getClickHouseQueryMetrics() ([][]string, error) {
 }
 
 // getClickHouseQueryTableSizes requests data sizes from ClickHouse
-func (f *ClickHouseFetcher) getClickHouseQueryTableSizes() ([][]string, error) {
+func (f *ClickHouseFetcher) getClickHouseQueryTableSizes(ctx context.Context) ([][]string, error) {
 	return f.clickHouseQueryScanRows(
+		ctx,
 		queryTableSizesSQL,
 		func(rows *sqlmodule.Rows, data *[][]string) error {
 			var database, table, active, partitions, parts, bytes, uncompressed, _rows string
@@ -170,8 +233,9 @@ func (f *ClickHouseFetcher) getClickHouseQueryTableSizes() ([][]string, error) {
 }
 
 // getClickHouseQuerySystemReplicas requests replica information from ClickHouse
-func (f *ClickHouseFetcher) getClickHouseQuerySystemReplicas() ([][]string, error) {
+func (f *ClickHouseFetcher) getClickHouseQuerySystemReplicas(ctx context.Context) ([][]string, error) {
 	return f.clickHouseQueryScanRows(
+		ctx,
 		querySystemReplicasSQL,
 		func(rows *sqlmodule.Rows, data *[][]string) error {
 			var database, table, isSessionExpired string
@@ -184,8 +248,9 @@ func (f *ClickHouseFetcher) getClickHouseQuerySystemReplicas() ([][]string, erro
 }
 
 // getClickHouseQueryMutations requests mutations information from ClickHouse
-func (f *ClickHouseFetcher) getClickHouseQueryMutations() ([][]string, error) {
+func (f *ClickHouseFetcher) getClickHouseQueryMutations(ctx context.Context) ([][]string, error) {
 	return f.clickHouseQueryScanRows(
+		ctx,
 		queryMutationsSQL,
 		func(rows *sqlmodule.Rows, data *[][]string) error {
 			var database, table, mutations, parts_to_do string
@@ -198,8 +263,9 @@ func (f *ClickHouseFetcher) getClickHouseQueryMutations() ([][]string, error) {
 }
 
 // getClickHouseQuerySystemDisks requests used disks information from ClickHouse
-func (f *ClickHouseFetcher) getClickHouseQuerySystemDisks() ([][]string, error) {
+func (f *ClickHouseFetcher) getClickHouseQuerySystemDisks(ctx context.Context) ([][]string, error) {
 	return f.clickHouseQueryScanRows(
+		ctx,
 		querySystemDisksSQL,
 		func(rows *sqlmodule.Rows, data *[][]string) error {
 			var disk, freeBytes, totalBytes string
@@ -211,15 +277,31 @@ func (f *ClickHouseFetcher) getClickHouseQuerySystemDisks() ([][]string, error)
 	)
 }
 
-// clickHouseQueryScanRows scan all rows by external scan function
+// getClickHouseQueryCombined requests all groups of metrics from ClickHouse at once, rows are tagged with their fetch type
+func (f *ClickHouseFetcher) getClickHouseQueryCombined(ctx context.Context) ([][]string, error) {
+	return f.clickHouseQueryScanRows(
+		ctx,
+		queryCombinedSQL,
+		func(rows *sqlmodule.Rows, data *[][]string) error {
+			row := make([]string, 9)
+			if err := rows.Scan(&row[0], &row[1], &row[2], &row[3], &row[4], &row[5], &row[6], &row[7], &row[8]); err == nil {
+				*data = append(*data, row)
+			}
+			return nil
+		},
+	)
+}
+
+// clickHouseQueryScanRows scan all rows by external scan function, the query is cancelled when ctx is done
 func (f *ClickHouseFetcher) clickHouseQueryScanRows(
+	ctx context.Context,
 	sql string,
 	scan func(
 		rows *sqlmodule.Rows,
 		data *[][]string,
 	) error,
 ) ([][]string, error) {
-	query, err := f.getCHConnection().Query(heredoc.Doc(sql))
+	query, err := f.getCHConnection().QueryContext(ctx, heredoc.Doc(sql))
 	if err != nil {
 		return nil, err
 	}
@@ -15,6 +15,7 @@
 package metrics
 
 import (
+	"context"
 	"encoding/json"
 	"fmt"
 	"net/http"
@@ -33,6 +34,8 @@ import (
 
 const (
 	defaultTimeout = 10 * time.Second
+	// defaultCollectWorkers is how many hosts are collected from at once
+	defaultCollectWorkers = 32
 )
 
 // Exporter implements prometheus.Collector interface
@@ -44,6 +47,19 @@ type Exporter struct {
 
 	mutex               sync.RWMutex
 	toRemoveFromWatched sync.Map
+
+	// collectInterval enables background collection when not zero: hosts are collected from on this interval
+	// and Collect serves the latest snapshot of every host instead of querying them
+	collectInterval time.Duration
+	snapshots       *hostSnapshotsIndex
+
+	// collectWorkers bounds how many hosts are collected from at once
+	collectWorkers int
+	// breakers back unreachable hosts off, see fetchFromHost
+	breakers *hostBreakersIndex
+
+	// combinedFetch makes fetchFromHost query all groups of metrics in one round-trip
+	combinedFetch bool
 }
 
 var exporter *Exporter
@@ -59,16 +75,22 @@ func (i chInstallationsIndex) Slice() []*WatchedCHI {
 }
 
 // NewExporter returns a new instance of Exporter type
-func NewExporter(chAccess *CHAccessInfo) *Exporter {
+func NewExporter(chAccess *CHAccessInfo, collectWorkers int) *Exporter {
 	timeout := chAccess.Timeout
 	if timeout == 0 {
 		timeout = defaultTimeout
 	}
+	if collectWorkers <= 0 {
+		collectWorkers = defaultCollectWorkers
+	}
 
 	return &Exporter{
 		chInstallations: make(map[string]*WatchedCHI),
 		chAccessInfo:    chAccess,
-		timeout:         chAccess.Timeout,
+		timeout:         timeout,
+		snapshots:       newHostSnapshotsIndex(),
+		collectWorkers:  collectWorkers,
+		breakers:        newHostBreakersIndex(),
 	}
 }
 
@@ -98,16 +120,122 @@ func (e *Exporter) Collect(ch chan<- prometheus.Metric) {
 	}()
 
 	log.V(2).Info("Starting Collect")
-	var wg = sync.WaitGroup{}
+	if e.collectInterval > 0 {
+		e.collectSnapshots(ch)
+		log.V(2).Info("Finished Collect")
+		return
+	}
+
+	hosts := e.watchedHosts()
+	forEachHost(hosts, e.collectWorkers, func(host watchedHost) {
+		e.collectFromHost(host.chi, host.hostname, ch)
+	})
+	e.retainBreakers(hosts)
+	log.V(2).Info("Finished Collect")
+}
+
+// collectSnapshots writes the latest collected metrics of every watched host and how stale they are
+func (e *Exporter) collectSnapshots(ch chan<- prometheus.Metric) {
+	now := time.Now()
 	e.WalkWatchedChi(func(chi *WatchedCHI, hostname string) {
+		snapshot := e.snapshots.get(chi, hostname)
+		if snapshot == nil {
+			// Not collected from yet
+			return
+		}
+		writer := NewPrometheusWriter(ch, chi, hostname)
+		writer.WriteFetched(snapshot.fetched)
+		writer.WriteStaleness(snapshot.staleness(now))
+	})
+}
+
+// StartBackgroundCollection makes the exporter collect from all watched hosts every interval in background.
+// From then on Collect serves the latest collected metrics, scrapes no longer wait for ClickHouse
+func (e *Exporter) StartBackgroundCollection(interval time.Duration) {
+	log.V(1).Infof("Collecting metrics in background every %s\n", interval)
+	e.collectInterval = interval
+	go func() {
+		for {
+			started := time.Now()
+			e.refreshSnapshots()
+			if elapsed := time.Since(started); elapsed < interval {
+				time.Sleep(interval - elapsed)
+			}
+		}
+	}()
+}
+
+// watchedHost is one host of a watched CHI
+type watchedHost struct {
+	chi      *WatchedCHI
+	hostname string
+}
+
+// watchedHosts lists all hosts of all watched CHIs, the caller holds the mutex
+func (e *Exporter) watchedHosts() []watchedHost {
+	hosts := make([]watchedHost, 0)
+	e.WalkWatchedChi(func(chi *WatchedCHI, hostname string) {
+		hosts = append(hosts, watchedHost{chi: chi, hostname: hostname})
+	})
+	return hosts
+}
+
+// forEachHost calls f for every host from at most workers goroutines and returns when all calls returned
+func forEachHost(hosts []watchedHost, workers int, f func(host watchedHost)) {
+	if workers > len(hosts) {
+		workers = len(hosts)
+	}
+	queue := make(chan watchedHost)
+	var wg = sync.WaitGroup{}
+	for i := 0; i < workers; i++ {
 		wg.Add(1)
-		go func(chi *WatchedCHI, hostname string, c chan<- prometheus.Metric) {
+		go func() {
 			defer wg.Done()
-			e.collectFromHost(chi, hostname, c)
-		}(chi, hostname, ch)
-	})
+			for host := range queue {
+				f(host)
+			}
+		}()
+	}
+	for _, host := range hosts {
+		queue <- host
+	}
+	close(queue)
 	wg.Wait()
-	log.V(2).Info("Finished Collect")
+}
+
+// retainBreakers forgets breakers of the hosts no longer watched
+func (e *Exporter) retainBreakers(hosts []watchedHost) {
+	hostnames := make(map[string]bool)
+	for _, host := range hosts {
+		hostnames[host.hostname] = true
+	}
+	e.breakers.retain(hostnames)
+}
+
+// refreshSnapshots collects from all watched hosts concurrently and replaces their snapshots
+func (e *Exporter) refreshSnapshots() {
+	e.mutex.RLock()
+	hosts := e.watchedHosts()
+	e.mutex.RUnlock()
+
+	log.V(2).Infof("Refreshing metrics of %d hosts\n", len(hosts))
+	forEachHost(hosts, e.collectWorkers, func(host watchedHost) {
+		e.refreshHost(host.chi, host.hostname)
+	})
+
+	// Hosts removed from watched meanwhile are forgotten
+	keys := make(map[string]bool)
+	for _, host := range hosts {
+		keys[hostSnapshotKey(host.chi, host.hostname)] = true
+	}
+	e.snapshots.retain(keys)
+	e.retainBreakers(hosts)
+	log.V(2).Infof("Refreshed metrics of %d hosts\n", len(hosts))
+}
+
+// refreshHost fetches metrics of one host into its snapshot
+func (e *Exporter) refreshHost(chi *WatchedCHI, hostname string) {
+	e.snapshots.update(chi, hostname, e.fetchFromHost(hostname), time.Now())
 }
 
 func (e *Exporter) enqueueToRemoveFromWatched(chi *WatchedCHI) {
@@ -181,74 +309,63 @@ func (e *Exporter) UpdateWatch(namespace, chiName string, hostnames []string) {
 
 // collectFromHost collects metrics from one host and writes them into chan
 func (e *Exporter) collectFromHost(chi *WatchedCHI, hostname string, c chan<- prometheus.Metric) {
-	fetcher := e.newFetcher(hostname)
-	writer := NewPrometheusWriter(c, chi, hostname)
+	NewPrometheusWriter(c, chi, hostname).WriteFetched(e.fetchFromHost(hostname))
+}
 
-	log.V(2).Infof("Querying metrics for %s\n", hostname)
-	if metrics, err := fetcher.getClickHouseQueryMetrics(); err == nil {
-		log.V(2).Infof("Extracted %d metrics for %s\n", len(metrics), hostname)
-		writer.WriteMetrics(metrics)
-		writer.WriteOKFetch("system.metrics")
-	} else {
-		// In case of an error fetching data from clickhouse store CHI name in e.cleanup
-		log.V(2).Infof("Error querying metrics for %s: %s\n", hostname, err)
-		writer.WriteErrorFetch("system.metrics")
-		//e.enqueueToRemoveFromWatched(chi)
-		return
+// fetchFromHost queries one host for every group of metrics in turn and stops at the first one that fails.
+// All queries share one timeout. A host that can not be connected to or does not answer the first query in time
+// is reported failed without being queried until its breaker lets it be tried again, see hostBreakersIndex
+func (e *Exporter) fetchFromHost(hostname string) []hostFetch {
+	if err := e.breakers.allow(hostname, time.Now()); err != nil {
+		log.V(2).Infof("Skipping %s: %s\n", hostname, err)
+		return []hostFetch{{fetchType: fetchTypeMetrics, err: err}}
 	}
 
-	log.V(2).Infof("Querying table sizes for %s\n", hostname)
-	if tableSizes, err := fetcher.getClickHouseQueryTableSizes(); err == nil {
-		log.V(2).Infof("Extracted %d table sizes for %s\n", len(tableSizes), hostname)
-		writer.WriteTableSizes(tableSizes)
-		writer.WriteOKFetch("table sizes")
-	} else {
-		// In case of an error fetching data from clickhouse store CHI name in e.cleanup
-		log.V(2).Infof("Error querying table sizes for %s: %s\n", hostname, err)
-		writer.WriteErrorFetch("table sizes")
-		// e.enqueueToRemoveFromWatched(chi)
-		return
-	}
+	ctx, cancel := context.WithTimeout(context.Background(), e.timeout)
+	defer cancel()
 
-	log.V(2).Infof("Querying system replicas for %s\n", hostname)
-	if systemReplicas, err := fetcher.getClickHouseQuerySystemReplicas(); err == nil {
-		log.V(2).Infof("Extracted %d system replicas for %s\n", len(systemReplicas), hostname)
-		writer.WriteSystemReplicas(systemReplicas)
-		writer.WriteOKFetch("system.replicas")
-	} else {
-		// In case of an error fetching data from clickhouse store CHI name in e.cleanup
-		log.V(2).Infof("Error querying system replicas for %s: %s\n", hostname, err)
-		writer.WriteErrorFetch("system.replicas")
-		// e.enqueueToRemoveFromWatched(chi)
-		return
+	fetcher := e.newFetcher(hostname)
+	if e.combinedFetch {
+		return e.fetchCombinedFromHost(ctx, fetcher, hostname)
 	}
-
-	log.V(2).Infof("Querying mutations for %s\n", hostname)
-	if mutations, err := fetcher.getClickHouseQueryMutations(); err == nil {
-		log.V(2).Infof("Extracted %d mutations for %s\n", len(mutations), hostname)
-		writer.WriteMutations(mutations)
-		writer.WriteOKFetch("system.mutations")
-	} else {
-		// In case of an error fetching data from clickhouse store CHI name in e.cleanup
-		log.V(2).Infof("Error querying mutations for %s: %s\n", hostname, err)
-		writer.WriteErrorFetch("system.mutations")
-		//e.enqueueToRemoveFromWatched(chi)
-		return
+	fetches := []struct {
+		fetchType string
+		fetch     func(ctx context.Context) ([][]string, error)
+	}{
+		{fetchTypeMetrics, fetcher.getClickHouseQueryMetrics},
+		{fetchTypeTableSizes, fetcher.getClickHouseQueryTableSizes},
+		{fetchTypeSystemReplicas, fetcher.getClickHouseQuerySystemReplicas},
+		{fetchTypeMutations, fetcher.getClickHouseQueryMutations},
+		{fetchTypeSystemDisks, fetcher.getClickHouseQuerySystemDisks},
 	}
 
-	log.V(2).Infof("Querying disks for %s\n", hostname)
-	if disks, err := fetcher.getClickHouseQuerySystemDisks(); err == nil {
-		log.V(2).Infof("Extracted %d disks for %s\n", len(disks), hostname)
-		writer.WriteSystemDisks(disks)
-		writer.WriteOKFetch("system.disks")
-	} else {
-		// In case of an error fetching data from clickhouse store CHI name in e.cleanup
-		log.V(2).Infof("Error querying disks for %s: %s\n", hostname, err)
-		writer.WriteErrorFetch("system.disks")
-		//e.enqueueToRemoveFromWatched(chi)
-		return
+	results := make([]hostFetch, 0, len(fetches))
+	for _, f := range fetches {
+		log.V(2).Infof("Querying %s for %s\n", f.fetchType, hostname)
+		data, err := f.fetch(ctx)
+		results = append(results, hostFetch{fetchType: f.fetchType, data: data, err: err})
+		if err != nil {
+			log.V(2).Infof("Error querying %s for %s: %s\n", f.fetchType, hostname, err)
+			break
+		}
+		log.V(2).Infof("Extracted %d rows of %s for %s\n", len(data), f.fetchType, hostname)
 	}
+	e.breakers.record(hostname, unreachable(results[0].err), time.Now())
+	return results
+}
 
+// fetchCombinedFromHost queries one host for all groups of metrics at once.
+// A failed query is reported as failed fetch of the first group, the way fetchFromHost stops at it
+func (e *Exporter) fetchCombinedFromHost(ctx context.Context, fetcher *ClickHouseFetcher, hostname string) []hostFetch {
+	log.V(2).Infof("Querying %s for %s\n", fetchTypeCombined, hostname)
+	data, err := fetcher.getClickHouseQueryCombined(ctx)
+	e.breakers.record(hostname, unreachable(err), time.Now())
+	if err != nil {
+		log.V(2).Infof("Error querying %s for %s: %s\n", fetchTypeCombined, hostname, err)
+		return []hostFetch{{fetchType: fetchTypeMetrics, err: err}}
+	}
+	log.V(2).Infof("Extracted %d rows of %s for %s\n", len(data), fetchTypeCombined, hostname)
+	return []hostFetch{{fetchType: fetchTypeCombined, data: data}}
 }
 
 // getWatchedCHI serves HTTP request to get list of watched CHIs
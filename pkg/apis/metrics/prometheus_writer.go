@@ -17,6 +17,7 @@ package metrics
 import (
 	"strconv"
 	"strings"
+	"sync"
 
 	log "github.com/golang/glog"
 	// log "k8s.io/klog"
@@ -47,6 +48,50 @@ func NewPrometheusWriter(
 	}
 }
 
+// WriteFetched pushes metrics fetched from the host group by group, each followed by its fetch status
+func (w *PrometheusWriter) WriteFetched(fetched []hostFetch) {
+	for _, f := range fetched {
+		if f.err != nil {
+			w.WriteErrorFetch(f.fetchType)
+			continue
+		}
+		switch f.fetchType {
+		case fetchTypeCombined:
+			w.WriteFetched(demultiplexFetched(f.data))
+			continue
+		case fetchTypeMetrics:
+			w.WriteMetrics(f.data)
+		case fetchTypeTableSizes:
+			w.WriteTableSizes(f.data)
+		case fetchTypeSystemReplicas:
+			w.WriteSystemReplicas(f.data)
+		case fetchTypeMutations:
+			w.WriteMutations(f.data)
+		case fetchTypeSystemDisks:
+			w.WriteSystemDisks(f.data)
+		}
+		w.WriteOKFetch(f.fetchType)
+	}
+}
+
+// demultiplexFetched splits rows fetched by queryCombinedSQL into the fetch of every group they belong to
+func demultiplexFetched(data [][]string) []hostFetch {
+	index := make(map[string]int)
+	fetched := make([]hostFetch, len(combinedFetchTypes))
+	for i, t := range combinedFetchTypes {
+		index[t.fetchType] = i
+		fetched[i] = hostFetch{fetchType: t.fetchType, data: make([][]string, 0)}
+	}
+	for _, row := range data {
+		i, found := index[row[0]]
+		if !found {
+			continue
+		}
+		fetched[i].data = append(fetched[i].data, row[1:1+combinedFetchTypes[i].columns])
+	}
+	return fetched
+}
+
 // WriteMetrics pushes set of prometheus.Metric objects created from the ClickHouse system data
 // Expected data structure: metric, value, description, type (gauge|counter)
 // TODO add namespace handling. It is just skipped for now
@@ -143,6 +188,13 @@ func (w *PrometheusWriter) WriteOKFetch(fetch_type string) {
 		w.chi.Name, w.chi.Namespace, w.hostname, fetch_type)
 }
 
+// WriteStaleness pushes seconds since metrics of the host were last fetched successfully, see hostSnapshot
+func (w *PrometheusWriter) WriteStaleness(seconds float64) {
+	writeSingleMetricToPrometheus(w.out, "metric_fetch_staleness_seconds", "Seconds since metrics of the host were last fetched successfully", strconv.FormatFloat(seconds, 'f', 3, 64), prometheus.GaugeValue,
+		[]string{"chi", "namespace", "hostname"},
+		w.chi.Name, w.chi.Namespace, w.hostname)
+}
+
 func writeSingleMetricToPrometheus(out chan<- prometheus.Metric, name string, desc string, value string, metricType prometheus.ValueType, labels []string, labelValues ...string) {
 	floatValue, _ := strconv.ParseFloat(value, 64)
 	m, err := prometheus.NewConstMetric(
@@ -155,22 +207,28 @@ func writeSingleMetricToPrometheus(out chan<- prometheus.Metric, name string, de
 		log.Infof("Error creating metric %s: %s", name, err)
 		return
 	}
-	select {
-	case out <- m:
-
-	default:
-		log.Infof("Error sending metric to the channel %s", name)
-	}
+	// Collectors of the registry and of background collection read until the writers are done,
+	// a full channel only means they have not caught up yet
+	out <- m
 }
 
-// newDescription creates a new prometheus.Desc object
+// descriptions caches prometheus.Desc objects by name, help and labels. Every series of a metric shares one,
+// which matters when snapshots of background collection keep all series of all hosts
+var descriptions sync.Map
+
+// newDescription returns prometheus.Desc object, creating it on first use
 func newDescription(name, help string, labels []string) *prometheus.Desc {
-	return prometheus.NewDesc(
+	key := name + "\x00" + help + "\x00" + strings.Join(labels, ",")
+	if desc, ok := descriptions.Load(key); ok {
+		return desc.(*prometheus.Desc)
+	}
+	desc, _ := descriptions.LoadOrStore(key, prometheus.NewDesc(
 		prometheus.BuildFQName(namespace, subsystem, name),
 		help,
 		labels,
 		nil,
-	)
+	))
+	return desc.(*prometheus.Desc)
 }
 
 // convertMetricName converts the given string to snake case following the Golang format:
@@ -17,6 +17,7 @@ package metrics
 import (
 	"fmt"
 	"net/http"
+	"time"
 
 	log "github.com/golang/glog"
 	// log "k8s.io/klog"
@@ -34,10 +35,18 @@ func StartMetricsREST(
 
 	chiListAddress string,
 	chiListPath string,
+
+	collectInterval time.Duration,
+	collectWorkers int,
+	combinedFetch bool,
 ) *Exporter {
 	log.V(1).Infof("Starting metrics exporter at '%s%s'\n", metricsAddress, metricsPath)
 
-	exporter = NewExporter(chAccess)
+	exporter = NewExporter(chAccess, collectWorkers)
+	exporter.combinedFetch = combinedFetch
+	if collectInterval > 0 {
+		exporter.StartBackgroundCollection(collectInterval)
+	}
 	prometheus.MustRegister(exporter)
 
 	http.Handle(metricsPath, promhttp.Handler())
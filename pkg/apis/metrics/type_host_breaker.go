@@ -0,0 +1,114 @@
+// Copyright 2019 Altinity Ltd and/or its affiliates. All rights reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+package metrics
+
+import (
+	"context"
+	"errors"
+	"fmt"
+	"net"
+	"sync"
+	"time"
+
+	"github.com/altinity/clickhouse-operator/pkg/model/clickhouse"
+)
+
+const (
+	// Backoff of an unreachable host doubles from hostBackoffMin on every failed attempt up to hostBackoffMax
+	hostBackoffMin = 10 * time.Second
+	hostBackoffMax = 5 * time.Minute
+)
+
+// hostBreaker is the circuit breaker state of one unreachable host
+type hostBreaker struct {
+	// failures counts attempts failed in a row
+	failures  int
+	openUntil time.Time
+}
+
+// hostBreakersIndex maps hostname to the breaker of the host, hosts that answer have no breaker
+type hostBreakersIndex struct {
+	mutex    sync.Mutex
+	breakers map[string]*hostBreaker
+}
+
+func newHostBreakersIndex() *hostBreakersIndex {
+	return &hostBreakersIndex{
+		breakers: make(map[string]*hostBreaker),
+	}
+}
+
+// backoff returns how long a host is not queried after failures attempts failed in a row
+func backoff(failures int) time.Duration {
+	delay := hostBackoffMin
+	for i := 1; i < failures && delay < hostBackoffMax; i++ {
+		delay *= 2
+	}
+	if delay > hostBackoffMax {
+		delay = hostBackoffMax
+	}
+	return delay
+}
+
+// unreachable tells errors of a host that could not be connected to or did not answer in time
+// from errors the host answered with, such as a failed SQL query. Only the former open the breaker
+func unreachable(err error) bool {
+	if err == nil {
+		return false
+	}
+	var netErr net.Error
+	return errors.Is(err, clickhouse.ErrConnect) ||
+		errors.Is(err, context.DeadlineExceeded) ||
+		errors.As(err, &netErr)
+}
+
+// allow returns nil when the host may be queried, otherwise the error the host is reported failed with
+func (i *hostBreakersIndex) allow(hostname string, now time.Time) error {
+	i.mutex.Lock()
+	defer i.mutex.Unlock()
+	breaker, found := i.breakers[hostname]
+	if !found || !now.Before(breaker.openUntil) {
+		return nil
+	}
+	return fmt.Errorf("host skipped for %s after %d failed attempts", breaker.openUntil.Sub(now).Round(time.Second), breaker.failures)
+}
+
+// record opens the breaker of the host for a longer backoff when it is unreachable and closes it otherwise
+func (i *hostBreakersIndex) record(hostname string, unreachable bool, now time.Time) {
+	i.mutex.Lock()
+	defer i.mutex.Unlock()
+	if !unreachable {
+		delete(i.breakers, hostname)
+		return
+	}
+	breaker, found := i.breakers[hostname]
+	if !found {
+		breaker = &hostBreaker{}
+		i.breakers[hostname] = breaker
+	}
+	breaker.failures++
+	breaker.openUntil = now.Add(backoff(breaker.failures))
+}
+
+// retain forgets breakers of the hosts not in hostnames
+func (i *hostBreakersIndex) retain(hostnames map[string]bool) {
+	i.mutex.Lock()
+	defer i.mutex.Unlock()
+	for hostname := range i.breakers {
+		if !hostnames[hostname] {
+			delete(i.breakers, hostname)
+		}
+	}
+}
@@ -0,0 +1,92 @@
+// Copyright 2019 Altinity Ltd and/or its affiliates. All rights reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+package metrics
+
+import (
+	"sync"
+	"time"
+)
+
+// hostSnapshot is the latest result of collecting metrics from one host in background collection mode.
+// It keeps the fetched rows, metrics are created from them on every scrape the way they would be after a fetch
+type hostSnapshot struct {
+	// fetched by the last collection, successful or not
+	fetched []hostFetch
+	// created is when the host was first collected from, succeeded is when the last collection succeeded
+	created   time.Time
+	succeeded time.Time
+}
+
+// staleness returns seconds since the host was last collected from successfully, or since it is watched
+func (s *hostSnapshot) staleness(now time.Time) float64 {
+	since := s.succeeded
+	if since.IsZero() {
+		since = s.created
+	}
+	return now.Sub(since).Seconds()
+}
+
+// hostSnapshotsIndex maps CHI index key and hostname to the snapshot of the host
+type hostSnapshotsIndex struct {
+	mutex     sync.RWMutex
+	snapshots map[string]*hostSnapshot
+}
+
+func newHostSnapshotsIndex() *hostSnapshotsIndex {
+	return &hostSnapshotsIndex{
+		snapshots: make(map[string]*hostSnapshot),
+	}
+}
+
+func hostSnapshotKey(chi *WatchedCHI, hostname string) string {
+	return chi.indexKey() + "/" + hostname
+}
+
+// get returns the snapshot of the host, nil when the host has not been collected from yet
+func (i *hostSnapshotsIndex) get(chi *WatchedCHI, hostname string) *hostSnapshot {
+	i.mutex.RLock()
+	defer i.mutex.RUnlock()
+	return i.snapshots[hostSnapshotKey(chi, hostname)]
+}
+
+// update replaces what was fetched from the host
+func (i *hostSnapshotsIndex) update(chi *WatchedCHI, hostname string, fetched []hostFetch, now time.Time) {
+	i.mutex.Lock()
+	defer i.mutex.Unlock()
+	key := hostSnapshotKey(chi, hostname)
+	snapshot := &hostSnapshot{
+		fetched: fetched,
+		created: now,
+	}
+	if previous, found := i.snapshots[key]; found {
+		snapshot.created = previous.created
+		snapshot.succeeded = previous.succeeded
+	}
+	if fetchSucceeded(fetched) {
+		snapshot.succeeded = now
+	}
+	i.snapshots[key] = snapshot
+}
+
+// retain forgets snapshots of the hosts not in keys
+func (i *hostSnapshotsIndex) retain(keys map[string]bool) {
+	i.mutex.Lock()
+	defer i.mutex.Unlock()
+	for key := range i.snapshots {
+		if !keys[key] {
+			delete(i.snapshots, key)
+		}
+	}
+}
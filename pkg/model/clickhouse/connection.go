@@ -17,6 +17,7 @@ package clickhouse
 import (
 	"context"
 	databasesql "database/sql"
+	"errors"
 	"fmt"
 	"time"
 
@@ -25,6 +26,9 @@ import (
 	_ "github.com/mailru/go-clickhouse"
 )
 
+// ErrConnect is wrapped by errors of queries that could not connect to the host
+var ErrConnect = errors.New("connect failed")
+
 type CHConnection struct {
 	params *CHConnectionParams
 	conn   *databasesql.DB
@@ -37,7 +41,7 @@ func NewConnection(params *CHConnectionParams) *CHConnection {
 	}
 }
 
-func (c *CHConnection) connect() {
+func (c *CHConnection) connect(ctx context.Context) {
 	log.V(2).Info("Establishing connection: %s", c.params.GetDSNWithHiddenCredentials())
 	dbConnection, err := databasesql.Open("clickhouse", c.params.GetDSN())
 	if err != nil {
@@ -46,7 +50,7 @@ func (c *CHConnection) connect() {
 	}
 
 	// Ping should be deadlined
-	ctx, cancel := context.WithDeadline(context.Background(), time.Now().Add(c.params.timeout))
+	ctx, cancel := context.WithDeadline(ctx, time.Now().Add(c.params.timeout))
 	defer cancel()
 
 	if err := dbConnection.PingContext(ctx); err != nil {
@@ -58,30 +62,35 @@ func (c *CHConnection) connect() {
 	c.conn = dbConnection
 }
 
-func (c *CHConnection) ensureConnected() bool {
+func (c *CHConnection) ensureConnected(ctx context.Context) bool {
 	if c.conn != nil {
 		log.V(2).F().Info("Already connected: %s", c.params.GetDSNWithHiddenCredentials())
 		return true
 	}
 
-	c.connect()
+	c.connect(ctx)
 
 	return c.conn != nil
 }
 
 // Query runs given sql query
 func (c *CHConnection) Query(sql string) (*Query, error) {
+	return c.QueryContext(context.Background(), sql)
+}
+
+// QueryContext runs given sql query, connecting when needed, before the earlier of ctx deadline and connection timeout
+func (c *CHConnection) QueryContext(ctx context.Context, sql string) (*Query, error) {
 	if len(sql) == 0 {
 		return nil, nil
 	}
 
-	ctx, cancel := context.WithDeadline(context.Background(), time.Now().Add(c.params.timeout))
+	ctx, cancel := context.WithDeadline(ctx, time.Now().Add(c.params.timeout))
 
-	if !c.ensureConnected() {
+	if !c.ensureConnected(ctx) {
 		cancel()
 		s := fmt.Sprintf("FAILED connect(%s) for SQL: %s", c.params.GetDSNWithHiddenCredentials(), sql)
 		log.V(1).A().Error(s)
-		return nil, fmt.Errorf(s)
+		return nil, fmt.Errorf("%s: %w", s, ErrConnect)
 	}
 
 	rows, err := c.conn.QueryContext(ctx, sql)
@@ -106,7 +115,7 @@ func (c *CHConnection) Exec(sql string) error {
 	ctx, cancel := context.WithDeadline(context.Background(), time.Now().Add(c.params.timeout))
 	defer cancel()
 
-	if !c.ensureConnected() {
+	if !c.ensureConnected(ctx) {
 		s := fmt.Sprintf("FAILED connect(%s) for SQL: %s", c.params.GetDSNWithHiddenCredentials(), sql)
 		log.V(1).A().Error(s)
 		return fmt.Errorf(s)
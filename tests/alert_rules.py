@@ -0,0 +1,400 @@
+import bisect
+import collections
+import math
+import re
+
+import yaml
+
+import exposition
+import prometheus_api
+
+# Offline evaluation of Prometheus alerting rules against synthetic series and simulated time.
+# Understands the PromQL the operator's rules use: selectors, range selectors, increase/delta/rate,
+# arithmetic, comparisons, and/or/unless and parentheses, with Prometheus' extrapolation and lookback semantics.
+
+# Instant selectors see the latest sample this many seconds back
+lookback = 300
+
+# One alert instance: labels include alertname and the rule labels, resolved_at is None while still active
+Alert = collections.namedtuple("Alert", "rule labels active_at firing_at resolved_at")
+Rule = collections.namedtuple("Rule", "group alert expr duration labels ast")
+
+
+class PromQLError(Exception):
+    pass
+
+
+token_re = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<duration>\d+(?:ms|s|m|h|d|w|y)(?:\d+(?:ms|s|m|h|d|w|y))*(?![a-zA-Z0-9_]))
+  | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+  | (?P<ident>[a-zA-Z_:][a-zA-Z0-9_:]*)
+  | (?P<op>=~|!~|==|!=|>=|<=|[-+*/%^<>=(){}\[\],])
+""", re.VERBOSE)
+
+# Binary operators by precedence, lowest first, as in the PromQL grammar
+precedence = [("or",), ("and", "unless"), ("==", "!=", "<=", "<", ">=", ">"), ("+", "-"), ("*", "/", "%"), ("^",)]
+comparisons = {"==", "!=", "<=", "<", ">=", ">"}
+functions = {"increase", "delta", "rate"}
+
+
+def tokenize(expr):
+    tokens = []
+    position = 0
+    while position < len(expr):
+        match = token_re.match(expr, position)
+        if match is None:
+            raise PromQLError(f"unexpected character {expr[position]!r} in {expr!r}")
+        position = match.end()
+        if match.lastgroup != "space":
+            tokens.append((match.lastgroup, match.group()))
+    return tokens
+
+
+class Parser:
+    # Recursive descent over the tokens, returns tuples:
+    # ("number", v), ("selector", name, [(label, op, value)], range seconds or None),
+    # ("call", function, [args]), ("binary", op, lhs, rhs, bool)
+    def __init__(self, expr):
+        self.expr = expr
+        self.tokens = tokenize(expr)
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def take(self, value=None):
+        token = self.peek()
+        if token[0] is None or (value is not None and token[1] != value):
+            raise PromQLError(f"expected {value or 'more'} at token {self.position} of {self.expr!r}")
+        self.position += 1
+        return token
+
+    def parse(self):
+        node = self.binary(0)
+        if self.position != len(self.tokens):
+            raise PromQLError(f"unexpected {self.peek()[1]!r} in {self.expr!r}")
+        return node
+
+    def binary(self, level):
+        if level == len(precedence):
+            return self.unary()
+        lhs = self.binary(level + 1)
+        while self.peek()[1] in precedence[level]:
+            op = self.take()[1]
+            is_bool = False
+            if self.peek()[1] == "bool":
+                self.take()
+                is_bool = True
+            if self.peek()[1] in ("on", "ignoring", "group_left", "group_right"):
+                raise PromQLError(f"vector matching modifiers are not supported: {self.expr!r}")
+            # ^ is right associative, everything else left associative
+            rhs = self.binary(level if op == "^" else level + 1)
+            lhs = ("binary", op, lhs, rhs, is_bool)
+        return lhs
+
+    def unary(self):
+        if self.peek()[1] in ("-", "+"):
+            sign = self.take()[1]
+            operand = self.unary()
+            return operand if sign == "+" else ("binary", "*", ("number", -1.0), operand, False)
+        return self.primary()
+
+    def primary(self):
+        kind, value = self.peek()
+        if kind == "number":
+            self.take()
+            return ("number", float(value))
+        if value == "(":
+            self.take("(")
+            node = self.binary(0)
+            self.take(")")
+            return node
+        if kind == "ident" and self.position + 1 < len(self.tokens) and self.tokens[self.position + 1][1] == "(":
+            if value not in functions:
+                raise PromQLError(f"function {value}() is not supported: {self.expr!r}")
+            self.take()
+            self.take("(")
+            args = [self.binary(0)]
+            self.take(")")
+            return ("call", value, args)
+        if kind == "ident" or value == "{":
+            return self.selector()
+        raise PromQLError(f"unexpected {value!r} in {self.expr!r}")
+
+    def selector(self):
+        name = None
+        if self.peek()[0] == "ident":
+            name = self.take()[1]
+        matchers = []
+        if self.peek()[1] == "{":
+            self.take("{")
+            while self.peek()[1] != "}":
+                label = self.take()[1]
+                op = self.take()[1]
+                kind, quoted = self.take()
+                if kind != "string":
+                    raise PromQLError(f"label value of {label} has to be quoted in {self.expr!r}")
+                matchers.append((label, op, quoted[1:-1].encode().decode("unicode_escape")))
+                if self.peek()[1] == ",":
+                    self.take(",")
+            self.take("}")
+        range_ = None
+        if self.peek()[1] == "[":
+            self.take("[")
+            kind, duration = self.take()
+            range_ = prometheus_api.duration_seconds(duration) if kind == "duration" else float(duration)
+            self.take("]")
+        return ("selector", name, matchers, range_)
+
+
+def parse(expr):
+    return Parser(expr).parse()
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def without_name(labels):
+    return {k: v for k, v in labels.items() if k != "__name__"}
+
+
+class SeriesStore:
+    # Synthetic time series: {label key: (labels, [timestamps], [values])}, samples kept in time order
+    def __init__(self):
+        self.series = {}
+        self.by_name = collections.defaultdict(list)
+
+    def add(self, labels, timestamp, value):
+        key = label_key(labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = (dict(labels), [], [])
+            self.by_name[labels.get("__name__")].append(series)
+        _, times, values = series
+        if len(times) == 0 or timestamp > times[-1]:
+            times.append(timestamp)
+            values.append(float(value))
+        else:
+            i = bisect.bisect_left(times, timestamp)
+            if i < len(times) and times[i] == timestamp:
+                values[i] = float(value)
+            else:
+                times.insert(i, timestamp)
+                values.insert(i, float(value))
+
+    def generate(self, labels, function, start, end, step):
+        # Samples function(t) every step seconds, None leaves a gap as a failed scrape would
+        t = start
+        while t <= end:
+            value = function(t)
+            if value is not None:
+                self.add(labels, t, value)
+            t += step
+
+    def add_scrape(self, text, timestamp, extra_labels=None):
+        # Samples of a text exposition scrape, e.g. the metrics-exporter's /metrics, taken at timestamp
+        for sample in exposition.parse(text.splitlines()):
+            labels = dict(sample.labels, __name__=sample.name, **(extra_labels or {}))
+            self.add(labels, timestamp, sample.value)
+
+    def select(self, name, matchers):
+        candidates = self.by_name.get(name, []) if name is not None else list(self.series.values())
+        return [s for s in candidates if matches_labels(s[0], matchers)]
+
+
+def matches_labels(labels, matchers):
+    for label, op, value in matchers:
+        actual = labels.get(label, "")
+        if op == "=" and actual != value or op == "!=" and actual == value:
+            return False
+        if op == "=~" and re.fullmatch(value, actual) is None or op == "!~" and re.fullmatch(value, actual) is not None:
+            return False
+    return True
+
+
+def extrapolated_rate(times, values, start, end, is_counter, is_rate):
+    # Prometheus' extrapolatedRate() over the samples in [start, end]
+    if len(times) < 2:
+        return None
+    result = values[-1] - values[0]
+    if is_counter:
+        for previous, current in zip(values, values[1:]):
+            if current < previous:
+                result += previous
+    duration_to_start = times[0] - start
+    duration_to_end = end - times[-1]
+    sampled = times[-1] - times[0]
+    average = sampled / (len(times) - 1)
+    if is_counter and result > 0 and values[0] >= 0:
+        duration_to_zero = sampled * (values[0] / result)
+        if duration_to_zero < duration_to_start:
+            duration_to_start = duration_to_zero
+    threshold = average * 1.1
+    interval = sampled
+    interval += duration_to_start if duration_to_start < threshold else average / 2
+    interval += duration_to_end if duration_to_end < threshold else average / 2
+    result = result * (interval / sampled)
+    return result / (end - start) if is_rate else result
+
+
+def arithmetic(op, a, b):
+    try:
+        if op == "+":
+            return a + b
+        if op == "-":
+            return a - b
+        if op == "*":
+            return a * b
+        if op == "/":
+            return a / b
+        if op == "%":
+            return math.fmod(a, b)
+        return a ** b
+    except ZeroDivisionError:
+        if op == "%" or a == 0 or math.isnan(a):
+            return math.nan
+        return math.copysign(math.inf, a) * math.copysign(1, b)
+
+
+def compare(op, a, b):
+    return {
+        "==": a == b, "!=": a != b, "<": a < b, "<=": a <= b, ">": a > b, ">=": a >= b,
+    }[op]
+
+
+class Evaluator:
+    def __init__(self, store):
+        self.store = store
+
+    def evaluate(self, node, t):
+        # float for scalars, [(labels, value)] for instant vectors
+        kind = node[0]
+        if kind == "number":
+            return node[1]
+        if kind == "selector":
+            _, name, matchers, range_ = node
+            if range_ is not None:
+                raise PromQLError("range vector outside of a function")
+            vector = []
+            for labels, times, values in self.store.select(name, matchers):
+                i = bisect.bisect_right(times, t) - 1
+                if i >= 0 and times[i] > t - lookback:
+                    vector.append((labels, values[i]))
+            return vector
+        if kind == "call":
+            _, function, (argument,) = node
+            if argument[0] != "selector" or argument[3] is None:
+                raise PromQLError(f"{function}() needs a range selector")
+            _, name, matchers, range_ = argument
+            vector = []
+            for labels, times, values in self.store.select(name, matchers):
+                first = bisect.bisect_left(times, t - range_)
+                last = bisect.bisect_right(times, t)
+                value = extrapolated_rate(
+                    times[first:last], values[first:last], t - range_, t,
+                    is_counter=function != "delta", is_rate=function == "rate",
+                )
+                if value is not None:
+                    vector.append((without_name(labels), value))
+            return vector
+        _, op, lhs, rhs, is_bool = node
+        return self.binary(op, self.evaluate(lhs, t), self.evaluate(rhs, t), is_bool)
+
+    def binary(self, op, lhs, rhs, is_bool):
+        if op in ("and", "or", "unless"):
+            if not isinstance(lhs, list) or not isinstance(rhs, list):
+                raise PromQLError(f"{op} needs vectors on both sides")
+            rhs_keys = {label_key(without_name(labels)) for labels, _ in rhs}
+            if op == "and":
+                return [(labels, v) for labels, v in lhs if label_key(without_name(labels)) in rhs_keys]
+            if op == "unless":
+                return [(labels, v) for labels, v in lhs if label_key(without_name(labels)) not in rhs_keys]
+            lhs_keys = {label_key(without_name(labels)) for labels, _ in lhs}
+            return lhs + [(labels, v) for labels, v in rhs if label_key(without_name(labels)) not in lhs_keys]
+        scalar_lhs, scalar_rhs = not isinstance(lhs, list), not isinstance(rhs, list)
+        if scalar_lhs and scalar_rhs:
+            if op in comparisons:
+                if not is_bool:
+                    raise PromQLError("comparisons between scalars need bool")
+                return float(compare(op, lhs, rhs))
+            return arithmetic(op, lhs, rhs)
+        if scalar_lhs or scalar_rhs:
+            pairs = [(labels, lhs, v) if scalar_lhs else (labels, v, rhs) for labels, v in (rhs if scalar_lhs else lhs)]
+        else:
+            # One-to-one matching on all labels but the metric name
+            right = {label_key(without_name(labels)): v for labels, v in rhs}
+            pairs = [
+                (labels, v, right[label_key(without_name(labels))])
+                for labels, v in lhs if label_key(without_name(labels)) in right
+            ]
+        result = []
+        for labels, a, b in pairs:
+            if op in comparisons:
+                if is_bool:
+                    result.append((without_name(labels), float(compare(op, a, b))))
+                elif compare(op, a, b):
+                    # Filtering keeps the sample of the vector side
+                    result.append((labels, b if scalar_lhs else a))
+            else:
+                result.append((without_name(labels), arithmetic(op, a, b)))
+        return result
+
+
+def load_rules(path):
+    # [Rule] of a PrometheusRule manifest or a plain Prometheus rules file
+    with open(path) as f:
+        doc = yaml.safe_load(f)
+    groups = (doc.get("spec") or doc)["groups"]
+    rules = []
+    for group in groups:
+        for rule in group["rules"]:
+            if "alert" not in rule:
+                continue
+            rules.append(Rule(
+                group=group["name"],
+                alert=rule["alert"],
+                expr=rule["expr"],
+                duration=prometheus_api.duration_seconds(rule["for"]) if "for" in rule else 0,
+                labels=dict(rule.get("labels") or {}),
+                ast=parse(rule["expr"]),
+            ))
+    return rules
+
+
+def simulate(rules, store, start, end, interval=30):
+    # Evaluates every rule at start, start + interval, ... end the way the rule manager does:
+    # new results go pending, firing once they have been active for the rule's "for", resolved once gone.
+    # Returns the alerts that fired, in the order they became active.
+    evaluator = Evaluator(store)
+    active = [{} for _ in rules]
+    alerts = []
+    t = start
+    while t <= end:
+        for i, rule in enumerate(rules):
+            vector = evaluator.evaluate(rule.ast, t)
+            if not isinstance(vector, list):
+                raise PromQLError(f"{rule.alert}: expression does not return a vector")
+            seen = set()
+            for labels, _ in vector:
+                labels = dict(without_name(labels), **rule.labels, alertname=rule.alert)
+                key = label_key(labels)
+                seen.add(key)
+                alert = active[i].get(key)
+                if alert is None:
+                    alert = active[i][key] = [rule, labels, t, None, None]
+                if alert[3] is None and t - alert[2] >= rule.duration:
+                    alert[3] = t
+            for key in list(active[i]):
+                if key not in seen:
+                    alert = active[i].pop(key)
+                    if alert[3] is not None:
+                        alert[4] = t
+                        alerts.append(Alert(*alert))
+        t += interval
+    # Still active at the end
+    for by_key in active:
+        alerts += [Alert(*alert) for alert in by_key.values() if alert[3] is not None]
+    return sorted(alerts, key=lambda a: (a.active_at, a.rule.alert))
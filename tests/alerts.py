@@ -0,0 +1,52 @@
+from testflows.core import Then, And, By
+from testflows.asserts import error
+
+import prometheus_api
+import timeline
+
+# Alert state steps of the alert scenarios, each asks the given prometheus_api.Client for ALERTS series.
+# test_metrics_alerts binds them to the Prometheus it deployed, the harness to its stand-in.
+
+
+def check_alert_state(client, alert_name, alert_state="firing", labels=None, time_range="10s"):
+    with Then(f"check {alert_name} for state {alert_state} and {labels} labels in {time_range}"):
+        labels = dict(labels or {})
+        labels.update({"alertname": alert_name, "alertstate": alert_state})
+        selector = ",".join([f"{name}=\"{value}\"" for name, value in labels.items()])
+        with By(f"querying ALERTS{{{selector}}}"):
+            result = client.query(f"ALERTS{{{selector}}}[{time_range}]")
+        if len(result) == 0:
+            with And("not present, empty result"):
+                return False
+        result_labels = result[0].metric.items()
+        exists = all(item in result_labels for item in labels.items())
+        with And("got result and contains labels" if exists else "got result, but doesn't contain labels"):
+            return exists
+
+
+def wait_alert_state(client, alert_name, alert_state, expected_state, labels=None, callback=None, max_try=20, sleep_time=10,
+                     time_range="10s"):
+    catched = False
+    for i in range(max_try):
+        if not callback is None:
+            callback()
+        if expected_state == check_alert_state(client, alert_name, alert_state, labels, time_range):
+            catched = True
+            break
+        with And(f"not ready, wait {sleep_time}s"):
+            timeline.sleep(sleep_time)
+    return catched
+
+
+def wait_alerts(client, expectations, callback=None, sleep_time=5):
+    # Waits for several prometheus_api.expect_alert() expectations at once, one ALERTS query per tick
+    names = ", ".join(f"{e.alertname} {'firing' if e.present else 'gone away'}" for e in expectations)
+    with Then(f"check {names}"):
+        watcher = prometheus_api.AlertWatcher(client, expectations, sleep_time, callback)
+        outcomes = watcher.run()
+    for outcome in outcomes:
+        e = outcome.expectation
+        with And(f"{e.alertname} {'firing' if e.present else 'gone away'} for {e.labels}" +
+                 (f" after {outcome.latency:.0f}s" if outcome.resolved else f", not within {e.timeout}s")):
+            assert outcome.resolved, error(f"can't get {e.alertname} alert {'in firing state' if e.present else 'gone away'}")
+    return outcomes
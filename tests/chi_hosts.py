@@ -0,0 +1,85 @@
+import collections
+import threading
+
+import kubectl
+
+# CHI -> hosts topology, resolved once per CHI instead of listing pods on every query.
+# With the watch-fed object cache an entry is rebuilt as soon as the CHI status or the set of its pods
+# changes. Without it entries are kept until invalidate() is called, kubectl.create_and_check() and
+# kubectl.delete_chi() do that through kubectl.chi_change_hooks.
+
+Host = collections.namedtuple("Host", "pod fqdn cluster shard replica shard_index replica_index")
+
+label_prefix = "clickhouse.altinity.com/"
+
+# (namespace, chi) -> (signature, [Host])
+hosts = {}
+lock = threading.Lock()
+
+
+def signature(chi_name, ns):
+    # Everything an entry depends on, None when there is no cache to tell changes apart cheaply
+    if not kubectl.cached("pod", ns) or not kubectl.cached("chi", ns):
+        return None
+    chi = kubectl.cache.reflector("chi", ns).get((ns, chi_name))
+    status = chi.get("status", {}) if chi is not None else {}
+    pods = kubectl.cache.list("pod", f"-l {label_prefix}chi={chi_name}", ns)
+    return (
+        status.get("status"),
+        tuple(status.get("pods") or ()),
+        tuple(status.get("fqdns") or ()),
+        tuple(sorted(pod["metadata"]["name"] for pod in pods)),
+    )
+
+
+def host_from_pod(pod, fqdns, ns):
+    name = pod["metadata"]["name"]
+    labels = pod["metadata"].get("labels") or {}
+    # Pod chi-a-b-0-0-0 is served by the per-host service chi-a-b-0-0
+    service = name.rsplit("-", 1)[0]
+    fqdn = next((f for f in fqdns if f.split(".")[0] == service), f"{service}.{ns}.svc.cluster.local")
+    return Host(
+        pod=name,
+        fqdn=fqdn,
+        cluster=labels.get(f"{label_prefix}cluster", ""),
+        shard=labels.get(f"{label_prefix}shard", ""),
+        replica=labels.get(f"{label_prefix}replica", ""),
+        # The operator swaps the scope indices, shardScopeIndex is the index of the replica in its shard and
+        # replicaScopeIndex the index of the shard, see ReplicaScopeIndex in pkg/apis/clickhouse.altinity.com/v1/type_chi.go
+        shard_index=int(labels.get(f"{label_prefix}replicaScopeIndex", -1)),
+        replica_index=int(labels.get(f"{label_prefix}shardScopeIndex", -1)),
+    )
+
+
+def resolve(chi_name, ns):
+    pods = kubectl.get("pod", "", label=f"-l {label_prefix}chi={chi_name}", ns=ns)["items"]
+    chis = [chi for chi in kubectl.get("chi", "", ns=ns)["items"] if chi["metadata"]["name"] == chi_name]
+    fqdns = (chis[0].get("status", {}).get("fqdns") or []) if len(chis) > 0 else []
+    return sorted((host_from_pod(pod, fqdns, ns) for pod in pods), key=lambda h: h.pod)
+
+
+def get(chi_name, ns=kubectl.namespace):
+    current = signature(chi_name, ns)
+    with lock:
+        entry = hosts.get((ns, chi_name))
+    if entry is not None and len(entry[1]) > 0 and (current is None or entry[0] == current):
+        return entry[1]
+    resolved = resolve(chi_name, ns)
+    with lock:
+        hosts[(ns, chi_name)] = (current, resolved)
+    return resolved
+
+
+def get_pod_names(chi_name, ns=kubectl.namespace):
+    return [h.pod for h in get(chi_name, ns)]
+
+
+def invalidate(chi_name=None, ns=None):
+    # Drops entries of one CHI, of all CHIs in a namespace or everything
+    with lock:
+        for key in list(hosts):
+            if (ns is None or key[0] == ns) and (chi_name is None or key[1] == chi_name):
+                del hosts[key]
+
+
+kubectl.chi_change_hooks.append(invalidate)
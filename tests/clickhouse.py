@@ -1,7 +1,38 @@
+import base64
+import collections
+import concurrent.futures
+import subprocess
+import tempfile
+
+from testflows.asserts import error
+
+import chi_hosts
+import clickhouse_format
+import clickhouse_http
 import kubectl
 import settings
+import timeline
 
 
+def select_pod(chi_name, host, pod, ns):
+    pod_names = chi_hosts.get_pod_names(chi_name, ns)
+    pod_name = pod_names[0]
+    for p in pod_names:
+        if host in p or p == pod:
+            pod_name = p
+            break
+    return pod_names, pod_name
+
+
+def http_target(pod_names, pod_name, host, port, advanced_params=""):
+    # The HTTP transport only replaces queries clickhouse-client would send to one of the CHI's own pods
+    # on the default port, connections to other hosts or with extra client flags still go through exec
+    if settings.clickhouse_transport not in ("http", "http-direct") or port != "9000" or advanced_params != "":
+        return None
+    return clickhouse_http.local_pod(pod_names, pod_name, host)
+
+
+@timeline.timed("query")
 def query(
         chi_name,
         sql,
@@ -15,12 +46,21 @@ def query(
         advanced_params="",
         pod="",
 ):
-    pod_names = kubectl.get_pod_names(chi_name, ns)
-    pod_name = pod_names[0]
-    for p in pod_names:
-        if host in p or p == pod:
-            pod_name = p
-            break
+    pod_names, pod_name = select_pod(chi_name, host, pod, ns)
+
+    target = http_target(pod_names, pod_name, host, port, advanced_params)
+    if target is not None:
+        try:
+            ok, out = clickhouse_http.query(target, ns, sql, user=user, pwd=pwd, timeout=timeout)
+        except clickhouse_http.PortForwardError as e:
+            print(f"HTTP query to {ns}/{target} failed, falling back to exec: {e}")
+        else:
+            if not with_error:
+                if not ok:
+                    print("query failed, output:")
+                    print(out)
+                assert ok, error()
+            return out
 
     pwd_str = "" if pwd == "" else f"--password={pwd}"
     user_str = "" if user == "" else f"--user={user}"
@@ -47,6 +87,258 @@ def query(
         )
 
 
+def check_lines(lines, sql):
+    # ClickHouse reports a failure that happens after the first rows have been sent at the end of the output
+    for line in lines:
+        if line.startswith("Code: ") and "DB::Exception" in line:
+            print(f"{sql} failed while reading the result:")
+            print(line)
+            assert False, error()
+        yield line
+
+
+@timeline.timed("query")
+def query_rows(
+        chi_name,
+        sql,
+        host="127.0.0.1",
+        port="9000",
+        user="",
+        pwd="",
+        ns=settings.test_namespace,
+        timeout=60,
+        advanced_params="",
+        pod="",
+):
+    # Same as query(), but returns clickhouse_format.Rows decoded from TSVWithNamesAndTypes.
+    # Rows are read from the connection as they are iterated, use them as a context manager
+    # or iterate to the end so the connection is released.
+    pod_names, pod_name = select_pod(chi_name, host, pod, ns)
+
+    target = http_target(pod_names, pod_name, host, port, advanced_params)
+    if target is not None:
+        try:
+            ok, lines, close = clickhouse_http.stream(
+                target, ns, sql, user=user, pwd=pwd, timeout=timeout, result_format=clickhouse_format.result_format,
+            )
+        except clickhouse_http.PortForwardError as e:
+            print(f"HTTP query to {ns}/{target} failed, falling back to exec: {e}")
+        else:
+            if not ok:
+                print("query failed, output:")
+                print("\n".join(lines))
+            assert ok, error()
+            return clickhouse_format.Rows(check_lines(lines, sql), close)
+
+    pwd_str = "" if pwd == "" else f"--password={pwd}"
+    user_str = "" if user == "" else f"--user={user}"
+    # stdout is read as rows are iterated, stderr goes to a file so a chatty client can not fill a pipe and stall
+    stderr = tempfile.TemporaryFile(mode="w+")
+    process = subprocess.Popen(
+        kubectl.command_line(
+            f"exec {pod_name}"
+            f" -- "
+            f"clickhouse-client -h {host} --port={port} {user_str} {pwd_str} {advanced_params}"
+            f" --format={clickhouse_format.result_format} --query=\"{sql}\"",
+            ns,
+        ),
+        shell=True, stdout=subprocess.PIPE, stderr=stderr, text=True,
+    )
+
+    def lines():
+        yield from process.stdout
+        code = process.wait(timeout=timeout)
+        if code != 0:
+            stderr.seek(0)
+            print("query failed, output:")
+            print(stderr.read())
+        assert code == 0, error()
+
+    def close():
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+        process.stdout.close()
+        stderr.close()
+
+    return clickhouse_format.Rows(lines(), close)
+
+
+def query_value(chi_name, sql, **kwargs):
+    # Typed value of the first column of the first row, None for an empty result
+    with query_rows(chi_name, sql, **kwargs) as rows:
+        return rows.scalar()
+
+
+# Outcome of one statement of a batch, duration is in seconds
+StatementResult = collections.namedtuple("StatementResult", "sql ok output duration")
+
+batch_marker = "--- clickhouse batch"
+
+
+def batch_script(statements, host, port, user_str, pwd_str):
+    # Shell script running statements one by one inside the pod, statements travel base64-encoded
+    # so they need no quoting. Each output is framed by markers carrying exit code and duration in ns.
+    lines = []
+    for i, sql in enumerate(statements):
+        encoded = base64.b64encode(sql.encode()).decode()
+        lines += [
+            f"echo '{batch_marker} {i}'",
+            "started=$(date +%s%N)",
+            f"clickhouse-client -h {host} --port={port} {user_str} {pwd_str} --query=\"$(echo {encoded} | base64 -d)\" 2>&1",
+            "rc=$?",
+            f"echo \"{batch_marker} {i} $rc $(( $(date +%s%N) - started ))\"",
+            "[ $rc -eq 0 ] || exit 0",
+        ]
+    return "\n".join(lines)
+
+
+def parse_batch_output(statements, out):
+    results = []
+    output = []
+    for line in out.splitlines():
+        if not line.startswith(batch_marker):
+            output.append(line)
+            continue
+        fields = line[len(batch_marker):].split()
+        if len(fields) == 1:
+            output = []
+        else:
+            i, rc, duration = int(fields[0]), int(fields[1]), int(fields[2]) / 1e9
+            results.append(StatementResult(statements[i], rc == 0, "\n".join(output), duration))
+    return results
+
+
+@timeline.timed("query")
+def query_batch(
+        chi_name,
+        statements,
+        with_error=False,
+        host="127.0.0.1",
+        port="9000",
+        user="",
+        pwd="",
+        ns=settings.test_namespace,
+        timeout=60,
+        pod="",
+):
+    # Runs an ordered list of statements on one host in a single round trip and stops at the first failure.
+    # Returns a StatementResult per executed statement. Statements are plain SQL, not shell-escaped as in query().
+    # Over HTTP they share a session, with exec every statement is a clickhouse-client run of its own,
+    # so SET does not carry over.
+    # timeout applies to every statement
+    pod_names, pod_name = select_pod(chi_name, host, pod, ns)
+    results = None
+
+    target = http_target(pod_names, pod_name, host, port)
+    if target is not None:
+        try:
+            results = [
+                StatementResult(sql, ok, out, duration)
+                for sql, (ok, out, duration) in zip(
+                    statements, clickhouse_http.run_statements(target, ns, statements, user, pwd, timeout),
+                )
+            ]
+        except clickhouse_http.PortForwardError as e:
+            print(f"HTTP query to {ns}/{target} failed, falling back to exec: {e}")
+
+    if results is None:
+        pwd_str = "" if pwd == "" else f"--password={pwd}"
+        user_str = "" if user == "" else f"--user={user}"
+        script = base64.b64encode(batch_script(statements, host, port, user_str, pwd_str).encode()).decode()
+        # launch_process() as batches may run from several threads, see query_batch_on_hosts()
+        out = kubectl.launch_process(
+            f"exec {pod_name} -- bash -c \"echo {script} | base64 -d | bash\"",
+            ns=ns,
+            timeout=timeout * len(statements),
+        )
+        results = parse_batch_output(statements, out)
+
+    if not with_error:
+        failed = [r for r in results if not r.ok]
+        if len(failed) > 0 or len(results) != len(statements):
+            print("batch failed, output:")
+            for r in results:
+                print(f"{r.sql}\n{r.output}")
+        assert len(failed) == 0 and len(results) == len(statements), error()
+    return results
+
+
+def query_batch_on_hosts(
+        chi_name,
+        statements,
+        hosts=None,
+        with_error=False,
+        port="9000",
+        user="",
+        pwd="",
+        ns=settings.test_namespace,
+        timeout=60,
+):
+    # Runs the same batch on several hosts concurrently, every host of the CHI when hosts is None.
+    # Returns {host: [StatementResult]}
+    if hosts is None:
+        hosts = [h.fqdn.split(".")[0] for h in chi_hosts.get(chi_name, ns)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(hosts), 1)) as pool:
+        futures = {
+            host: pool.submit(
+                query_batch, chi_name, statements,
+                with_error=with_error, host=host, port=port, user=user, pwd=pwd, ns=ns, timeout=timeout,
+            )
+            for host in hosts
+        }
+        return {host: future.result() for host, future in futures.items()}
+
+
+def query_on_hosts(
+        chi_name,
+        sql,
+        hosts=None,
+        with_error=False,
+        port="9000",
+        user="",
+        pwd="",
+        ns=settings.test_namespace,
+        timeout=60,
+):
+    # Runs sql on several hosts concurrently, every host of the CHI when hosts is None. Returns {host: output}.
+    # sql is plain SQL as in query_batch()
+    results = query_batch_on_hosts(
+        chi_name, [sql], hosts=hosts, with_error=with_error, port=port, user=user, pwd=pwd, ns=ns, timeout=timeout,
+    )
+    return {host: host_results[0].output if len(host_results) > 0 else "" for host, host_results in results.items()}
+
+
+def assert_query_on_hosts(
+        chi_name,
+        sql,
+        expected=None,
+        hosts=None,
+        port="9000",
+        user="",
+        pwd="",
+        ns=settings.test_namespace,
+        timeout=60,
+):
+    # Checks that sql returns the same value on every host, and that it is the expected one if given
+    out = query_on_hosts(chi_name, sql, hosts=hosts, port=port, user=user, pwd=pwd, ns=ns, timeout=timeout)
+    values = set(out.values())
+    if len(values) != 1 or (expected is not None and values != {expected}):
+        print(f"{sql} returned:")
+        for host, value in sorted(out.items()):
+            print(f"{host}: {value}")
+    assert len(values) == 1, error()
+    value = values.pop()
+    if expected is not None:
+        assert value == expected, error()
+    return value
+
+
+def invalidate_hosts(chi_name=None, ns=None):
+    # For scenarios that change a CHI's layout without kubectl.create_and_check()
+    chi_hosts.invalidate(chi_name, ns)
+
+
 def query_with_error(
         chi_name,
         sql,
@@ -0,0 +1,190 @@
+import datetime
+import decimal
+
+# Decoder for ClickHouse TSVWithNamesAndTypes output into typed Python values.
+# Rows are decoded one line at a time, so a result set never has to be held in memory as a whole.
+
+result_format = "TSVWithNamesAndTypes"
+
+tsv_escapes = {"b": "\b", "f": "\f", "r": "\r", "n": "\n", "t": "\t", "0": "\0", "'": "'", "\\": "\\"}
+
+int_types = {
+    "Int8", "Int16", "Int32", "Int64", "Int128", "Int256",
+    "UInt8", "UInt16", "UInt32", "UInt64", "UInt128", "UInt256",
+}
+float_types = {"Float32", "Float64"}
+floats = {"inf": float("inf"), "+inf": float("inf"), "-inf": float("-inf"), "nan": float("nan"), "-nan": float("nan")}
+
+
+def split_type(type_name):
+    # "Array(Nullable(Int8))" -> ("Array", ["Nullable(Int8)"]), "Decimal(9, 2)" -> ("Decimal", ["9", "2"])
+    if "(" not in type_name or not type_name.endswith(")"):
+        return type_name, []
+    name, rest = type_name.split("(", 1)
+    args = []
+    depth = 0
+    quote = False
+    current = ""
+    for c in rest[:-1]:
+        if quote:
+            if c == "'" and not current.endswith("\\"):
+                quote = False
+        elif c == "'":
+            quote = True
+        elif c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == "," and depth == 0:
+            args.append(current.strip())
+            current = ""
+            continue
+        current += c
+    args.append(current.strip())
+    return name, args
+
+
+def unescape(text):
+    if "\\" not in text:
+        return text
+    out = []
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c == "\\" and i + 1 < len(text):
+            out.append(tsv_escapes.get(text[i + 1], text[i + 1]))
+            i += 2
+        else:
+            out.append(c)
+            i += 1
+    return "".join(out)
+
+
+def decode_scalar(type_name, text):
+    name, args = split_type(type_name)
+    if name in ("Nullable", "LowCardinality", "SimpleAggregateFunction"):
+        return decode_scalar(args[-1], text)
+    if name in int_types:
+        return int(text)
+    if name in float_types:
+        return floats[text] if text in floats else float(text)
+    if name.startswith("Decimal"):
+        return decimal.Decimal(text)
+    if name in ("Date", "Date32"):
+        return datetime.date.fromisoformat(text)
+    if name in ("DateTime", "DateTime64"):
+        return datetime.datetime.fromisoformat(text)
+    if name == "Bool":
+        return text == "true"
+    if name in ("Array", "Tuple", "Map"):
+        value, _ = parse_composite(type_name, text, 0)
+        return value
+    # String, FixedString, UUID, Enum, IPv4/IPv6 and anything unknown stay strings
+    return text
+
+
+def parse_quoted(text, pos):
+    # 'a\'b' -> ("a'b", position after the closing quote)
+    end = pos + 1
+    while text[end] != "'":
+        end += 2 if text[end] == "\\" else 1
+    return unescape(text[pos + 1:end]), end + 1
+
+
+def parse_element(type_name, text, pos):
+    # One value inside Array/Tuple/Map text, where strings are quoted and NULL is spelled out
+    name, args = split_type(type_name)
+    if name in ("Nullable", "LowCardinality"):
+        if text.startswith("NULL", pos):
+            return None, pos + 4
+        return parse_element(args[-1], text, pos)
+    if name in ("Array", "Tuple", "Map"):
+        return parse_composite(type_name, text, pos)
+    if text[pos] == "'":
+        value, pos = parse_quoted(text, pos)
+        return decode_scalar(type_name, value), pos
+    end = pos
+    while end < len(text) and text[end] not in ",])}:":
+        end += 1
+    return decode_scalar(type_name, text[pos:end]), end
+
+
+def parse_composite(type_name, text, pos):
+    name, args = split_type(type_name)
+    close = {"Array": "]", "Tuple": ")", "Map": "}"}[name]
+    values = []
+    pos += 1
+    i = 0
+    while text[pos] != close:
+        if name == "Map":
+            key, pos = parse_element(args[0], text, pos)
+            value, pos = parse_element(args[1], text, pos + 1)
+            values.append((key, value))
+        else:
+            value, pos = parse_element(args[i] if name == "Tuple" else args[0], text, pos)
+            values.append(value)
+        i += 1
+        if text[pos] == ",":
+            pos += 1
+    if name == "Tuple":
+        return tuple(values), pos + 1
+    if name == "Map":
+        return dict(values), pos + 1
+    return values, pos + 1
+
+
+def decode_field(type_name, text):
+    if text == "\\N":
+        return None
+    return decode_scalar(type_name, unescape(text))
+
+
+class Rows:
+    # Typed rows of a TSVWithNamesAndTypes result, read lazily from an iterator of lines.
+    # close is called once the rows are consumed or the object is closed early.
+    def __init__(self, lines, close=None):
+        self.lines = iter(lines)
+        self.on_close = close
+        self.closed = False
+        header = [next(self.lines, "") for _ in range(2)]
+        self.names = [unescape(n) for n in header[0].rstrip("\n").split("\t")] if header[0].strip() != "" else []
+        self.types = [unescape(t) for t in header[1].rstrip("\n").split("\t")] if header[1].strip() != "" else []
+        self.columns = list(zip(self.names, self.types))
+
+    def __iter__(self):
+        try:
+            for line in self.lines:
+                line = line.rstrip("\n")
+                if line == "" and len(self.types) != 1:
+                    continue
+                yield tuple(decode_field(t, f) for t, f in zip(self.types, line.split("\t")))
+        finally:
+            self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if self.on_close is not None:
+                self.on_close()
+
+    def all(self):
+        return list(self)
+
+    def dicts(self):
+        for row in self:
+            yield dict(zip(self.names, row))
+
+    def scalar(self):
+        # First column of the first row, None for an empty result.
+        # Reads the result to the end so the connection can be reused, meant for single-row results
+        value = None
+        for i, row in enumerate(self):
+            if i == 0:
+                value = row[0]
+        return value
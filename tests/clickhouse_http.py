@@ -0,0 +1,252 @@
+import base64
+import http.client
+import re
+import shlex
+import subprocess
+import threading
+import time
+import uuid
+import urllib.parse
+
+import settings
+
+# ClickHouse HTTP interface transport for clickhouse.query(): one long-lived kubectl port-forward
+# per pod, or the pod's service address for in-cluster runs, and a pool of keep-alive connections on top of it.
+
+http_port = 8123
+
+class PortForwardError(ConnectionError):
+    pass
+
+
+class Endpoint:
+    # Pool of keep-alive connections to one ClickHouse HTTP address
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.pool = []
+        self.lock = threading.Lock()
+
+    def alive(self):
+        return True
+
+    def acquire(self, timeout):
+        with self.lock:
+            conn = self.pool.pop() if len(self.pool) > 0 else None
+        if conn is None:
+            return http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn
+
+    def release(self, conn):
+        with self.lock:
+            self.pool.append(conn)
+
+    def stop(self):
+        with self.lock:
+            pool, self.pool = self.pool, []
+        for conn in pool:
+            conn.close()
+
+
+class PortForward(Endpoint):
+    # Endpoint behind a long-lived kubectl port-forward to the pod
+    def __init__(self, pod, ns, remote_port=http_port, start_timeout=30):
+        super().__init__("127.0.0.1", None)
+        self.pod = pod
+        self.ns = ns
+        self.remote_port = remote_port
+        self.start_timeout = start_timeout
+        self.process = None
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        cmd = shlex.split(settings.kubectl_cmd) + [
+            "port-forward", f"--namespace={self.ns}", f"pod/{self.pod}", f":{self.remote_port}",
+        ]
+        try:
+            self.process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        except OSError as e:
+            raise PortForwardError(f"port-forward to {self.ns}/{self.pod} did not start: {e}")
+        timer = threading.Timer(self.start_timeout, self.process.kill)
+        timer.start()
+        try:
+            for line in self.process.stdout:
+                # Forwarding from 127.0.0.1:41235 -> 8123
+                match = re.search(r"Forwarding from 127\.0\.0\.1:(\d+)", line)
+                if match:
+                    self.port = int(match.group(1))
+                    break
+        finally:
+            timer.cancel()
+        if self.port is None:
+            self.stop()
+            raise PortForwardError(f"port-forward to {self.ns}/{self.pod} did not start")
+        # kubectl logs every forwarded connection, keep draining it so the pipe never fills up
+        threading.Thread(target=self.process.stdout.read, daemon=True).start()
+        return self
+
+    def stop(self):
+        super().stop()
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+
+# (namespace, pod) -> Endpoint
+endpoints = {}
+endpoints_lock = threading.Lock()
+
+
+def get_endpoint(pod, ns):
+    with endpoints_lock:
+        endpoint = endpoints.get((ns, pod))
+        # A restarted pod drops its port-forward, start a new one then
+        if endpoint is None or not endpoint.alive():
+            if endpoint is not None:
+                endpoint.stop()
+            if settings.clickhouse_transport == "http-direct":
+                # In-cluster runs reach the pod through its per-host service, chi-a-b-0-0-0 -> chi-a-b-0-0
+                endpoint = Endpoint(f"{pod.rsplit('-', 1)[0]}.{ns}.svc.cluster.local", http_port)
+            else:
+                endpoint = PortForward(pod, ns).start()
+            endpoints[(ns, pod)] = endpoint
+        return endpoint
+
+
+def close_all():
+    with endpoints_lock:
+        closing = list(endpoints.values())
+        endpoints.clear()
+    for endpoint in closing:
+        endpoint.stop()
+
+
+def shell_unescape(sql):
+    # Queries are written for clickhouse-client --query="..." inside a shell double-quoted string
+    return re.sub(r'\\([\\"$`])', r"\1", sql)
+
+
+def split_statements(sql):
+    # clickhouse-client -n accepts ';' separated statements, the HTTP interface takes one per request
+    statements = []
+    current = ""
+    quote = None
+    escaped = False
+    for c in sql:
+        if escaped:
+            escaped = False
+        elif c == "\\":
+            escaped = True
+        elif quote is not None:
+            if c == quote:
+                quote = None
+        elif c in "'\"`":
+            quote = c
+        elif c == ";":
+            statements.append(current)
+            current = ""
+            continue
+        current += c
+    statements.append(current)
+    return [s.strip() for s in statements if s.strip() != ""]
+
+
+def local_pod(pod_names, pod_name, host):
+    # Returns the pod a query connects to when the target is one of the CHI's own pods,
+    # None when clickhouse-client would connect to some other address
+    if host in ("127.0.0.1", "localhost", "::1"):
+        return pod_name
+    short_host = host.split(".")[0]
+    for p in pod_names:
+        if p.startswith(short_host):
+            return p
+    return None
+
+
+def send(endpoint, sql, params, headers, timeout, path="/", method="POST"):
+    # Returns (conn, response) with the response body left unread
+    url = f"{path}?{urllib.parse.urlencode(params)}"
+    for attempt in range(2):
+        conn = endpoint.acquire(timeout)
+        try:
+            conn.request(method, url, body=sql.encode() if sql is not None else None, headers=headers)
+            return conn, conn.getresponse()
+        except (http.client.RemoteDisconnected, http.client.CannotSendRequest, BrokenPipeError, ConnectionResetError):
+            # Stale keep-alive connection, retry once on a fresh one
+            conn.close()
+            if attempt == 1:
+                raise
+        except Exception:
+            conn.close()
+            raise
+
+
+def finish(endpoint, conn, response):
+    # Keeps the connection only when the response has been read to the end,
+    # line by line reads of a Content-Length body leave it open with nothing left
+    done = response.isclosed() or (not response.chunked and response.length == 0)
+    if done and not response.will_close:
+        response.close()
+        endpoint.release(conn)
+    else:
+        conn.close()
+
+
+def request(endpoint, sql, params, headers, timeout):
+    conn, response = send(endpoint, sql, params, headers, timeout)
+    try:
+        body = response.read().decode(errors="replace")
+    finally:
+        finish(endpoint, conn, response)
+    return response.status, body
+
+
+def auth_headers(user, pwd):
+    auth = base64.b64encode(f"{user or 'default'}:{pwd}".encode()).decode()
+    return {"Authorization": f"Basic {auth}"}
+
+
+def run_statements(pod, ns, statements, user="", pwd="", timeout=60):
+    # Runs statements one by one in one session until the first failure.
+    # Returns [(ok, output, seconds)] with outputs formatted as clickhouse-client would print them.
+    endpoint = get_endpoint(pod, ns)
+    headers = auth_headers(user, pwd)
+    params = {}
+    if len(statements) > 1:
+        # Keep SET and other session state between statements
+        params["session_id"] = str(uuid.uuid4())
+    results = []
+    for statement in statements:
+        started = time.monotonic()
+        status, body = request(endpoint, statement, params, headers, timeout)
+        duration = time.monotonic() - started
+        if status != 200:
+            results.append((False, "Received exception from server:\n" + body.rstrip("\n"), duration))
+            break
+        results.append((True, body.rstrip("\n"), duration))
+    return results
+
+
+def query(pod, ns, sql, user="", pwd="", timeout=60):
+    # Returns (ok, output) for a clickhouse-client -mn --query="..." style query
+    results = run_statements(pod, ns, split_statements(shell_unescape(sql)), user, pwd, timeout)
+    return all(ok for ok, _, _ in results), "\n".join(out for _, out, _ in results if out != "")
+
+
+def stream(pod, ns, sql, user="", pwd="", timeout=60, result_format="TSVWithNamesAndTypes"):
+    # Returns (ok, lines, close): output lines are read from the socket as they are consumed,
+    # close() has to be called when done with them. On failure lines holds the error message.
+    endpoint = get_endpoint(pod, ns)
+    params = {"default_format": result_format}
+    conn, response = send(endpoint, shell_unescape(sql), params, auth_headers(user, pwd), timeout)
+    if response.status != 200:
+        body = response.read().decode(errors="replace")
+        finish(endpoint, conn, response)
+        return False, ["Received exception from server:", body.rstrip("\n")], lambda: None
+    lines = (line.decode(errors="replace") for line in response)
+    return True, lines, lambda: finish(endpoint, conn, response)
@@ -0,0 +1,184 @@
+import argparse
+import json
+import math
+import os
+import sqlite3
+import time
+
+import parallel
+import settings
+import test as suite
+import test_operator
+
+# Runs the operator scenarios of tests/test.py over and over, one test.py process per scenario, and keeps
+# pass/fail, durations and per-step timings of every run in SQLite, so percentiles across runs can be
+# compared before and after a harness change.
+#   python3 cycle.py --runs 10 --db cycle.sqlite
+#   python3 cycle.py --report-only --db cycle.sqlite
+
+schema = """
+CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY AUTOINCREMENT, started REAL, finished REAL, failures INTEGER);
+CREATE TABLE IF NOT EXISTS scenarios (run_id INTEGER, scenario TEXT, ok INTEGER, duration REAL);
+CREATE TABLE IF NOT EXISTS steps (run_id INTEGER, scenario TEXT, step TEXT, duration REAL, events INTEGER);
+CREATE TABLE IF NOT EXISTS waits (run_id INTEGER, scenario TEXT, name TEXT, duration REAL, retries INTEGER);
+"""
+
+
+def scenario_ids():
+    # Operator scenarios, the ones run_tests_cycle.sh has always cycled through
+    return [parallel.scenario_id(test_operator, t if callable(t) else t[0]) for t in suite.operator_tests]
+
+
+def expected(scenario, exitcode, result):
+    # A scenario run is as expected when it passes or ends with a result test.py xfails it with,
+    # workers report the real result as the parent is the one that applies scenario-level xfails
+    if exitcode == 0:
+        return True
+    if result is None or not hasattr(test_operator, scenario):
+        return False
+    name = parallel.scenario_name(getattr(test_operator, scenario))
+    return any(result["type"] == r.__name__ for r, _ in suite.operator_xfails.get(f"/main/operator/{name}", []))
+
+
+def connect(path):
+    db = sqlite3.connect(path)
+    db.executescript(schema)
+    return db
+
+
+def run_scenario(scenario, timeline_dir):
+    # Returns (exitcode, seconds, result) of parallel.run_worker(), timelines of the run go to timeline_dir
+    exitcode, output, duration, result = parallel.run_worker(
+        scenario, settings.test_namespace, extra_env={"TIMELINE_DIR": timeline_dir},
+    )
+    print(output)
+    return exitcode, duration, result
+
+
+def load_timeline(timeline_dir, scenario):
+    path = os.path.join(timeline_dir, f"{scenario}.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def step_durations(events):
+    # Events carry the innermost testflows step they ran in, a step takes from its first event to its last one
+    steps = {}
+    for e in events:
+        step = e.get("step") or ""
+        start, end, count = steps.get(step, (e["start"], e["end"], 0))
+        steps[step] = (min(start, e["start"]), max(end, e["end"]), count + 1)
+    return {step: (end - start, count) for step, (start, end, count) in steps.items()}
+
+
+def store_run(db, started, finished, results, timeline_dir):
+    # results: [(scenario, ok, seconds)]
+    cur = db.execute(
+        "INSERT INTO runs (started, finished, failures) VALUES (?, ?, ?)",
+        (started, finished, sum(1 for _, ok, _ in results if not ok)),
+    )
+    run_id = cur.lastrowid
+    for scenario, ok, duration in results:
+        db.execute("INSERT INTO scenarios VALUES (?, ?, ?, ?)", (run_id, scenario, int(ok), duration))
+        timeline = load_timeline(timeline_dir, scenario)
+        if timeline is None:
+            continue
+        for step, (step_duration, count) in step_durations(timeline["events"]).items():
+            db.execute("INSERT INTO steps VALUES (?, ?, ?, ?, ?)", (run_id, scenario, step, step_duration, count))
+        for e in timeline["events"]:
+            if e["category"] == "wait":
+                db.execute(
+                    "INSERT INTO waits VALUES (?, ?, ?, ?, ?)",
+                    (run_id, scenario, e["name"], e["duration"], e.get("retries", 0)),
+                )
+    db.commit()
+    return run_id
+
+
+def run_cycle(db, scenarios, runs=0, until_failure=False, timeline_base="cycle-timelines", runner=run_scenario):
+    # runs=0 keeps going until interrupted, or until a failure with until_failure
+    run = 0
+    while runs == 0 or run < runs:
+        run += 1
+        print(f"start run {run}")
+        timeline_dir = os.path.abspath(os.path.join(timeline_base, f"run-{int(time.time())}-{run}"))
+        started = time.time()
+        results = []
+        for scenario in scenarios:
+            exitcode, duration, result = runner(scenario, timeline_dir)
+            results.append((scenario, expected(scenario, exitcode, result), duration))
+        run_id = store_run(db, started, time.time(), results, timeline_dir)
+        failed = [scenario for scenario, ok, _ in results if not ok]
+        print(f"run {run} (#{run_id} in the store): {len(results) - len(failed)} passed, {len(failed)} failed {failed}")
+        if until_failure and len(failed) > 0:
+            break
+    return run
+
+
+def percentile(values, p):
+    # Nearest-rank percentile
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+def stats(values):
+    return {"p50": percentile(values, 50), "p95": percentile(values, 95), "max": max(values)}
+
+
+def report(db):
+    # {"scenarios": {scenario: {...}}, "steps": {(scenario, step): {...}}, "waits": {(scenario, name): {...}}}
+    out = {"scenarios": {}, "steps": {}, "waits": {}}
+    rows = {}
+    for scenario, ok, duration in db.execute("SELECT scenario, ok, duration FROM scenarios"):
+        rows.setdefault(scenario, []).append((ok, duration))
+    for scenario, results in rows.items():
+        entry = stats([d for _, d in results])
+        entry["runs"] = len(results)
+        entry["failure_rate"] = sum(1 for ok, _ in results if not ok) / len(results)
+        out["scenarios"][scenario] = entry
+    for table, name in (("steps", "step"), ("waits", "name")):
+        rows = {}
+        for scenario, key, duration in db.execute(f"SELECT scenario, {name}, duration FROM {table}"):
+            rows.setdefault((scenario, key), []).append(duration)
+        for key, durations in rows.items():
+            entry = stats(durations)
+            entry["runs"] = len(durations)
+            out[table][key] = entry
+    return out
+
+
+def print_report(db, top=20):
+    res = report(db)
+    print(f"{'scenario':<24} {'runs':>5} {'failed':>7} {'p50':>8} {'p95':>8} {'max':>8}")
+    for scenario, e in sorted(res["scenarios"].items()):
+        print(
+            f"{scenario:<24} {e['runs']:>5} {e['failure_rate']:>6.0%} "
+            f"{e['p50']:>7.0f}s {e['p95']:>7.0f}s {e['max']:>7.0f}s"
+        )
+    for table in ("steps", "waits"):
+        print(f"\nSlowest {table} by p95:")
+        ranked = sorted(res[table].items(), key=lambda item: item[1]["p95"], reverse=True)[:top]
+        for (scenario, name), e in ranked:
+            print(f"{e['p50']:>7.1f}s {e['p95']:>7.1f}s {e['max']:>7.1f}s  {scenario}  {name}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run tests/test.py scenarios repeatedly and collect statistics")
+    parser.add_argument("--runs", type=int, default=0, help="number of runs, 0 runs until interrupted")
+    parser.add_argument("--until-failure", action="store_true", help="stop after the first run with a failure")
+    parser.add_argument("--db", default="cycle.sqlite", help="SQLite file the results are added to")
+    parser.add_argument("--timelines", default="cycle-timelines", help="directory for scenario timelines")
+    parser.add_argument("--report-only", action="store_true", help="print statistics of stored runs and exit")
+    parser.add_argument("--top", type=int, default=20, help="number of steps and waits to report")
+    options = parser.parse_args()
+
+    store = connect(options.db)
+    if not options.report_only:
+        scenarios = settings.scenarios if len(settings.scenarios) > 0 else scenario_ids()
+        try:
+            run_cycle(store, scenarios, options.runs, options.until_failure, options.timelines)
+        except KeyboardInterrupt:
+            print("interrupted")
+    print_report(store, options.top)
@@ -0,0 +1,338 @@
+import argparse
+import collections
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import exposition
+import fake_clickhouse
+import fake_kube
+import prometheus_api
+
+# Scrape benchmark of the metrics-exporter: the Go binary runs against one ClickHouse HTTP stand-in that plays
+# every host, CHIs are registered through the exporter's /chi endpoint and each step records scrape duration,
+# exporter memory and series count. Hosts get their own loopback address, 127.1.x.y, so the stand-in listens on
+# all interfaces and the exporter keeps one connection pool per host as it would in a cluster.
+# With collect_interval the exporter collects in background and scrapes serve its latest snapshot.
+# The first unresponsive hosts accept connections and never answer, the exporter gives up on them after host_timeout.
+# With combined the exporter fetches each host with one query instead of five, every query costs the shape's latency.
+#   python3 tests/exporter_bench.py --hosts 1,10,100,1000 --latency 5 [--collect-interval 5] [--unresponsive 10] [--combined]
+
+repo_dir = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# What every stand-in host reports: rows of system.metrics/events/asynchronous_metrics, active tables with
+# their part count, system.replicas rows, tables with unfinished mutations, disks, seconds each query takes
+# how many hosts never answer and the query kinds every host answers with an SQL error
+Shape = collections.namedtuple("Shape", "metrics tables parts replicas mutations disks latency unresponsive broken")
+
+# One step of the benchmark: durations in seconds, memory in kB of exporter RSS after the step and its peak so far,
+# connections the stand-in accepted and queries it answered during the timed scrapes, staleness: the largest
+# one reported, None unless the exporter collects in background
+Step = collections.namedtuple(
+    "Step",
+    "hosts expected series dropped fetch_errors bytes scrape_min scrape_median scrape_max rss_kb peak_rss_kb connections "
+    "queries staleness",
+)
+
+
+def shape(metrics=300, tables=20, parts=10, replicas=10, mutations=2, disks=1, latency=0.0, unresponsive=0, broken=()):
+    return Shape(metrics, tables, parts, replicas, mutations, disks, latency, unresponsive, tuple(broken))
+
+
+def tsv(names, types, rows):
+    # TSVWithNamesAndTypes body, the values here never need escaping
+    lines = ["\t".join(names), "\t".join(types)] + ["\t".join(str(v) for v in row) for row in rows]
+    return "\n".join(lines) + "\n"
+
+
+# fetch_type of every query kind, as the combined query tags its rows
+fetch_types = {
+    "metrics": "system.metrics",
+    "table_sizes": "table sizes",
+    "replicas": "system.replicas",
+    "mutations": "system.mutations",
+    "disks": "system.disks",
+}
+
+
+def query_kind(sql):
+    # Which of the exporter's queries, see pkg/apis/metrics/clickhouse_fetcher.go
+    for kind, marker in (
+        ("combined", "AS fetch_type"),
+        ("metrics", "system.asynchronous_metrics"),
+        ("table_sizes", "GROUP BY active, database, table"),
+        ("replicas", "system.replicas"),
+        ("mutations", "system.mutations"),
+        ("disks", "system.disks"),
+    ):
+        if marker in sql:
+            return kind
+    return None
+
+
+def results(s):
+    # {query kind: (column names, column types, rows)}, the same for every host
+    metrics = [(f"metric.Metric{i}", i, "", "gauge") for i in range(s.metrics // 2)]
+    metrics += [(f"event.Event{i}", i, "", "counter") for i in range(s.metrics - s.metrics // 2)]
+    tables = [(f"db{i % 5}", f"table_{i}", 1, s.parts // 2 or 1, s.parts, s.parts << 20, s.parts << 22, s.parts * 1000)
+              for i in range(s.tables)]
+    return {
+        "metrics": (["metric", "value", "description", "type"], ["String"] * 4, metrics),
+        "table_sizes": (
+            ["database", "table", "active", "partitions", "parts", "bytes", "uncompressed_bytes", "rows"], ["String"] * 8, tables,
+        ),
+        "replicas": (["database", "table", "is_session_expired"], ["String"] * 3,
+                     [(f"db{i % 5}", f"table_{i}", 0) for i in range(s.replicas)]),
+        "mutations": (["database", "table", "mutations", "parts_to_do"], ["String", "String", "UInt64", "UInt64"],
+                      [(f"db{i % 5}", f"table_{i}", 1, s.parts) for i in range(s.mutations)]),
+        "disks": (["name", "free_space", "total_space"], ["String"] * 3,
+                  [(f"disk{i}", 1 << 30, 1 << 32) for i in range(s.disks)]),
+    }
+
+
+def bodies(s):
+    # {query kind: body}, the combined query's rows are every other query's rows tagged and padded to 8 columns
+    kinds = results(s)
+    prepared = {kind: tsv(*result) for kind, result in kinds.items()}
+    combined = [(fetch_types[kind],) + tuple(row) + ("",) * (8 - len(row))
+                for kind, (_, _, rows) in kinds.items() for row in rows]
+    prepared["combined"] = tsv(["fetch_type"] + [f"c{i}" for i in range(1, 9)], ["String"] * 9, combined)
+    return prepared
+
+
+def responder(s):
+    prepared = bodies(s)
+
+    def respond(sql, params, user):
+        if s.latency > 0:
+            time.sleep(s.latency)
+        kind = query_kind(sql)
+        if kind is None:
+            return 400, f"Code: 62, e.displayText() = DB::Exception: unexpected query {sql[:80]!r}\n"
+        if kind in s.broken:
+            return 500, f"Code: 60, e.displayText() = DB::Exception: Table for {kind} doesn't exist\n"
+        return 200, prepared[kind]
+    return respond
+
+
+def expected_series(s):
+    # chi_clickhouse_* series one healthy host adds to a scrape, see pkg/apis/metrics/prometheus_writer.go
+    return s.metrics + 5 * s.tables + s.replicas + 2 * s.mutations + 2 * s.disks + 5
+
+
+def step_expected(s, hosts, background):
+    # chi_clickhouse_* series of a scrape of hosts, an unresponsive host only reports its failed fetch
+    unresponsive = min(hosts, s.unresponsive)
+    staleness = 1 if background else 0
+    return (hosts - unresponsive) * (expected_series(s) + staleness) + unresponsive * (1 + staleness)
+
+
+def host_addresses(count):
+    return [f"127.1.{i // 250}.{i % 250 + 1}" for i in range(count)]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def build_exporter(path):
+    subprocess.run(
+        ["go", "build", "-mod=vendor", "-o", path, "./cmd/metrics_exporter"], cwd=repo_dir, check=True,
+    )
+    return path
+
+
+def memory_kb(pid):
+    # (VmRSS, VmHWM) of a Linux process
+    fields = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if name in ("VmRSS", "VmHWM"):
+                fields[name] = int(value.split()[0])
+    return fields.get("VmRSS", 0), fields.get("VmHWM", 0)
+
+
+class Bench:
+    def __init__(self, s, binary=None, hosts_per_chi=8, workdir=None, collect_interval=0, host_timeout=10, workers=32,
+                 combined=False):
+        self.shape = s
+        self.combined = combined
+        self.collect_interval = collect_interval
+        self.host_timeout = host_timeout
+        self.workers = workers
+        self.binary = binary
+        self.hosts_per_chi = hosts_per_chi
+        self.workdir = workdir or tempfile.mkdtemp(prefix="exporter-bench-")
+        self.clickhouse = None
+        self.kube = None
+        self.process = None
+        self.client = None
+
+    def start(self):
+        self.clickhouse = fake_clickhouse.FakeClickHouse(
+            responder(self.shape), host="0.0.0.0", record=False, unresponsive=host_addresses(self.shape.unresponsive),
+        ).start()
+        # The exporter only reads its configuration and lists CHIs from the API server
+        self.kube = fake_kube.FakeKube().add_crds().start()
+        kubeconfig = self.kube.write_kubeconfig(os.path.join(self.workdir, "kubeconfig"))
+        config = os.path.join(self.workdir, "config.yaml")
+        with open(config, "w") as f:
+            f.write(f"chUsername: bench\nchPassword: bench\nchPort: {self.clickhouse.address[1]}\n")
+        if self.binary is None:
+            self.binary = build_exporter(os.path.join(self.workdir, "metrics-exporter"))
+        endpoint = f"127.0.0.1:{free_port()}"
+        self.process = subprocess.Popen(
+            [self.binary, "--kubeconfig", kubeconfig, "--config", config,
+             "--metrics-endpoint", endpoint, "--chi-list-endpoint", endpoint, "-logtostderr",
+             f"--metrics-collect-interval={self.collect_interval}s", f"--metrics-host-timeout={self.host_timeout}s",
+             f"--metrics-collect-workers={self.workers}", f"--metrics-combined-fetch={str(self.combined).lower()}"],
+            stdout=subprocess.DEVNULL, stderr=open(os.path.join(self.workdir, "exporter.log"), "w"),
+        )
+        self.client = prometheus_api.Client("metrics-exporter", "bench", url=f"http://{endpoint}", timeout=300)
+        deadline = time.time() + 30
+        while True:
+            try:
+                self.client.get("/chi")
+                return self
+            except (ConnectionError, prometheus_api.PrometheusError):
+                if time.time() > deadline or self.process.poll() is not None:
+                    raise
+                self.client.reset()
+                time.sleep(0.1)
+
+    def stop(self):
+        if self.client is not None:
+            self.client.reset()
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+        for server in (self.kube, self.clickhouse):
+            if server is not None:
+                server.stop()
+
+    def register(self, hosts):
+        # CHIs of hosts_per_chi hosts each, re-posting an unchanged CHI leaves it as it is
+        addresses = host_addresses(hosts)
+        for i in range(0, hosts, self.hosts_per_chi):
+            chi = {"namespace": "bench", "name": f"chi-{i // self.hosts_per_chi}", "hostnames": addresses[i:i + self.hosts_per_chi]}
+            status, body = self.client.request("POST", "/chi", data=chi)
+            if status != 200:
+                raise prometheus_api.PrometheusError("http_error", f"POST /chi returned {status}: {body[:200]}")
+
+    def scrape(self):
+        # (seconds, bytes, exposition.Scrape) of one /metrics request
+        size = 0
+
+        def counted(lines):
+            nonlocal size
+            for line in lines:
+                size += len(line)
+                yield line
+
+        started = time.time()
+        scrape = exposition.Scrape().feed(counted(self.client.lines("/metrics")))
+        return time.time() - started, size, scrape
+
+    def collected(self, hosts, timeout=600):
+        # Waits for a background collection that covers all hosts
+        deadline = time.time() + timeout
+        while True:
+            _, _, scrape = self.scrape()
+            if len(scrape.select("chi_clickhouse_metric_fetch_staleness_seconds")) >= hosts or time.time() > deadline:
+                return
+            time.sleep(min(self.collect_interval, 1))
+
+    def step(self, hosts, scrapes=3):
+        self.register(hosts)
+        if self.collect_interval:
+            self.collected(hosts)
+        else:
+            # The first scrape opens the connections to new hosts
+            self.scrape()
+        durations = []
+        connections, queries = self.clickhouse.connections, self.clickhouse.requests
+        for _ in range(scrapes):
+            duration, size, scrape = self.scrape()
+            durations.append(duration)
+        series = sum(len(scrape.series[name]) for name in scrape.series if name.startswith("chi_clickhouse_"))
+        fetch_errors = sum(1 for _, value in scrape.select("chi_clickhouse_metric_fetch_errors") if value != 0)
+        rss, peak = memory_kb(self.process.pid)
+        staleness = [value for _, value in scrape.select("chi_clickhouse_metric_fetch_staleness_seconds")]
+        expected = step_expected(self.shape, hosts, self.collect_interval > 0)
+        return Step(
+            hosts=hosts, expected=expected, series=series, dropped=expected - series, fetch_errors=fetch_errors,
+            bytes=size, scrape_min=min(durations), scrape_median=statistics.median(durations),
+            scrape_max=max(durations), rss_kb=rss, peak_rss_kb=peak, connections=self.clickhouse.connections - connections,
+            queries=self.clickhouse.requests - queries, staleness=max(staleness) if staleness else None,
+        )
+
+
+def run(hosts, s, scrapes=3, binary=None, hosts_per_chi=8, report=None, collect_interval=0, host_timeout=10, workers=32,
+        combined=False):
+    # [Step] for every host count, in increasing order, report(step) is called as each one finishes
+    bench = Bench(s, binary, hosts_per_chi, collect_interval=collect_interval, host_timeout=host_timeout, workers=workers,
+                  combined=combined).start()
+    steps = []
+    try:
+        for count in sorted(hosts):
+            steps.append(bench.step(count, scrapes))
+            if report is not None:
+                report(steps[-1])
+    finally:
+        bench.stop()
+    return steps
+
+
+def format_step(step):
+    return (
+        f"{step.hosts:>6} hosts {step.series:>8}/{step.expected:<8} series {step.fetch_errors:>5} errors "
+        f"{step.bytes / 1e6:>7.1f}MB  scrape {step.scrape_min:.3f}/{step.scrape_median:.3f}/{step.scrape_max:.3f}s  "
+        f"rss {step.rss_kb / 1024:.0f}MB peak {step.peak_rss_kb / 1024:.0f}MB"
+        + (f"  staleness {step.staleness:.1f}s" if step.staleness is not None else "")
+    )
+
+
+def print_step(step):
+    print(format_step(step), flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scrape duration, memory and series count of the metrics-exporter by host count")
+    parser.add_argument("--hosts", default="1,10,100,1000", help="comma separated host counts")
+    parser.add_argument("--scrapes", type=int, default=3, help="timed scrapes per step")
+    parser.add_argument("--metrics", type=int, default=300)
+    parser.add_argument("--tables", type=int, default=20)
+    parser.add_argument("--parts", type=int, default=10)
+    parser.add_argument("--replicas", type=int, default=10)
+    parser.add_argument("--mutations", type=int, default=2)
+    parser.add_argument("--disks", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.0, help="milliseconds each query takes")
+    parser.add_argument("--unresponsive", type=int, default=0, help="hosts that never answer")
+    parser.add_argument("--hosts-per-chi", type=int, default=8)
+    parser.add_argument("--collect-interval", type=float, default=0, help="seconds, collect in background when set")
+    parser.add_argument("--host-timeout", type=float, default=10, help="seconds the exporter waits for one host")
+    parser.add_argument("--workers", type=int, default=32, help="hosts the exporter collects from at once")
+    parser.add_argument("--combined", action="store_true", help="fetch each host with one query")
+    parser.add_argument("--exporter", default=None, help="metrics-exporter binary, built from the tree when not given")
+    parser.add_argument("--output", default=None, help="write the steps as JSON")
+    args = parser.parse_args()
+    s = shape(args.metrics, args.tables, args.parts, args.replicas, args.mutations, args.disks, args.latency / 1000,
+              args.unresponsive)
+    print(f"{s}, {expected_series(s)} series per host", flush=True)
+    steps = run([int(h) for h in args.hosts.split(",")], s, args.scrapes, args.exporter, args.hosts_per_chi, print_step,
+                args.collect_interval, args.host_timeout, args.workers, args.combined)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"shape": s._asdict(), "steps": [step._asdict() for step in steps]}, f, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,200 @@
+import collections
+import re
+import sys
+
+# Streaming parser of the Prometheus text exposition format, e.g. the metrics-exporter's /metrics,
+# and an index of one scrape by metric name and label set. Lines are consumed as they arrive, only the index
+# is kept: one float per series, label names and values interned so thousands of series share their strings.
+
+# labels: tuple of (label, value) pairs sorted by label, timestamp in milliseconds or None
+Sample = collections.namedtuple("Sample", "name labels value timestamp")
+
+# One assertion on a scrape, made with expect(): labels are a subset the series must carry,
+# values are exact strings or compiled patterns matched at the start of the label value.
+# present=False asserts no series matches. min/max bound the value of every matching series.
+# type asserts the # TYPE of the metric and that it has a # HELP line.
+Expectation = collections.namedtuple("Expectation", "name labels present min max type")
+
+# added/removed: [(name, labels)], changed: [(name, labels, before, after)]
+Diff = collections.namedtuple("Diff", "added removed changed")
+
+label_re = re.compile(r'\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*=\s*"((?:[^"\\]|\\.)*)"\s*,?')
+escape_re = re.compile(r'\\(.)')
+escapes = {"n": "\n", '"': '"', "\\": "\\"}
+# label name as written -> interned name, label names are few and repeat on every line
+label_names = {}
+
+
+class ExpositionError(Exception):
+    pass
+
+
+def unescape(value):
+    return escape_re.sub(lambda m: escapes.get(m.group(1), "\\" + m.group(1)), value)
+
+
+def parse_labels(text, line, pairs):
+    # Sorted tuple of (label, value), pairs caches every distinct pair so series share them.
+    # Without backslashes no value can hold a quote, splitting on '",' is exact then.
+    key = None
+    body = text.rstrip(" ,")
+    if "\\" not in body and body.endswith('"'):
+        key = []
+        for part in body[:-1].split('",'):
+            label, sep, value = part.partition('="')
+            name = label_names.get(label)
+            if name is None:
+                if not sep or not label.strip().isidentifier():
+                    key = None
+                    break
+                name = label_names[label] = sys.intern(label.strip())
+            pair = (name, value)
+            key.append(pairs.setdefault(pair, pair))
+    if key is None:
+        key = []
+        for label, value in label_re.findall(text):
+            pair = (sys.intern(label), unescape(value))
+            key.append(pairs.setdefault(pair, pair))
+        if len(key) == 0 and body.strip() != "":
+            raise ExpositionError(f"bad labels in {line!r}")
+    key.sort()
+    return tuple(key)
+
+
+def parse_line(line, pairs):
+    # Sample of one sample line, comments and blank lines are the caller's
+    brace = line.find("{")
+    if brace >= 0:
+        close = line.rfind("}")
+        if close < brace:
+            raise ExpositionError(f"unterminated labels in {line!r}")
+        name = line[:brace].strip()
+        labels = parse_labels(line[brace + 1:close], line, pairs)
+        rest = line[close + 1:].split()
+    else:
+        parts = line.split()
+        name, labels, rest = parts[0], (), parts[1:]
+    if len(rest) not in (1, 2):
+        raise ExpositionError(f"bad sample line {line!r}")
+    try:
+        value = float(rest[0])
+        timestamp = int(rest[1]) if len(rest) == 2 else None
+    except ValueError:
+        raise ExpositionError(f"bad value in {line!r}") from None
+    return Sample(sys.intern(name), labels, value, timestamp)
+
+
+def parse(lines, types=None, help=None, pairs=None):
+    # Yields a Sample per sample line of lines, str or bytes as read from a response.
+    # # TYPE and # HELP comments go to the types and help dicts when given.
+    pairs = {} if pairs is None else pairs
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode(errors="replace")
+        line = line.strip()
+        if line == "":
+            continue
+        if line[0] == "#":
+            parts = line.split(None, 3)
+            if len(parts) >= 3 and parts[1] == "TYPE" and types is not None:
+                types[parts[2]] = parts[3] if len(parts) == 4 else "untyped"
+            elif len(parts) >= 3 and parts[1] == "HELP" and help is not None:
+                help[parts[2]] = unescape(parts[3]) if len(parts) == 4 else ""
+            continue
+        yield parse_line(line, pairs)
+
+
+def expect(name, labels=None, present=True, min=None, max=None, type=None):
+    return Expectation(name, dict(labels or {}), present, min, max, type)
+
+
+def label_matches(labels, subset):
+    for label, expected in subset.items():
+        actual = labels.get(label)
+        if actual is None:
+            return False
+        if isinstance(expected, re.Pattern):
+            if expected.match(actual) is None:
+                return False
+        elif actual != expected:
+            return False
+    return True
+
+
+class Scrape:
+    def __init__(self):
+        # name -> {labels: value}
+        self.series = collections.defaultdict(dict)
+        self.types = {}
+        self.help = {}
+        self.samples = 0
+        # (label, value) -> the shared pair, see parse_labels()
+        self.pairs = {}
+
+    def feed(self, lines):
+        for sample in parse(lines, self.types, self.help, self.pairs):
+            self.series[sample.name][sample.labels] = sample.value
+            self.samples += 1
+        return self
+
+    @classmethod
+    def from_text(cls, text):
+        return cls().feed(text.splitlines())
+
+    def __len__(self):
+        return sum(len(s) for s in self.series.values())
+
+    def names(self):
+        return sorted(self.series)
+
+    def get(self, name, labels=None):
+        # Value of the series with exactly these labels, None when there is none
+        return self.series.get(name, {}).get(tuple(sorted((labels or {}).items())))
+
+    def select(self, name, labels=None):
+        # [(labels dict, value)] of the series of name carrying the labels subset
+        subset = labels or {}
+        found = []
+        for key, value in self.series.get(name, {}).items():
+            pairs = dict(key)
+            if label_matches(pairs, subset):
+                found.append((pairs, value))
+        return found
+
+    def exists(self, name, labels=None):
+        return len(self.select(name, labels)) > 0
+
+    def failures(self, expectations):
+        # Human readable reasons of the expectations the scrape does not meet, empty when all are met
+        reasons = []
+        for e in expectations:
+            selected = self.select(e.name, e.labels)
+            where = f"{e.name}{e.labels}" if e.labels else e.name
+            if not e.present:
+                if selected:
+                    reasons.append(f"{where}: {len(selected)} unexpected series, e.g. {selected[0][0]}")
+                continue
+            if not selected:
+                reasons.append(f"{where}: no series")
+                continue
+            if e.type is not None and (self.types.get(e.name) != e.type or e.name not in self.help):
+                reasons.append(f"{where}: TYPE {self.types.get(e.name)}, HELP {e.name in self.help}, expected TYPE {e.type}")
+            for labels, value in selected:
+                if e.min is not None and not value >= e.min or e.max is not None and not value <= e.max:
+                    reasons.append(f"{where}: {value} out of [{e.min}, {e.max}] for {labels}")
+                    break
+        return reasons
+
+
+def diff(before, after):
+    # Series that appeared, disappeared or changed value between two scrapes, NaN == NaN
+    added, removed, changed = [], [], []
+    for name in sorted(set(before.series) | set(after.series)):
+        old, new = before.series.get(name, {}), after.series.get(name, {})
+        for labels, value in new.items():
+            if labels not in old:
+                added.append((name, labels))
+            elif old[labels] != value and not (old[labels] != old[labels] and value != value):
+                changed.append((name, labels, old[labels], value))
+        removed.extend((name, labels) for labels in old if labels not in new)
+    return Diff(added, removed, changed)
@@ -0,0 +1,112 @@
+import base64
+import threading
+import urllib.parse
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the ClickHouse HTTP interface. Every query is passed to a responder
+# callable, responder(sql, params, user) -> (status, body), which plays the server.
+# Queries come as POST or, the way the Go driver sends read-only ones, as GET with a body; GET /ping answers Ok.
+# Connections to the local addresses in unresponsive are accepted and never answered, the way a stuck host hangs clients.
+
+
+def echo(sql, params, user):
+    return 200, sql + "\n"
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes, Nagle would hold the body back for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def hang(self):
+        if self.connection.getsockname()[0] not in self.server.unresponsive:
+            return False
+        self.server.stopped.wait()
+        self.close_connection = True
+        return True
+
+    def do_GET(self):
+        if self.hang():
+            return
+        if urllib.parse.urlsplit(self.path).path == "/ping":
+            return self.reply(200, "Ok.\n")
+        self.do_POST()
+
+    def do_POST(self):
+        if self.hang():
+            return
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        length = int(self.headers.get("Content-Length", 0))
+        sql = self.rfile.read(length).decode() or params.get("query", "")
+        user = "default"
+        if self.headers.get("Authorization", "").startswith("Basic "):
+            user = base64.b64decode(self.headers["Authorization"][len("Basic "):]).decode().split(":")[0]
+        with self.server.lock:
+            self.server.requests += 1
+            if self.server.record:
+                self.server.queries.append((sql, params, user))
+        self.reply(*self.server.responder(sql, params, user))
+
+    def reply(self, status, body):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "text/tab-separated-values; charset=UTF-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class Server(ThreadingHTTPServer):
+    # An exporter connects to every host at once, the default backlog of 5 would drop and delay SYNs
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class FakeClickHouse:
+    def __init__(self, responder=echo, host="127.0.0.1", port=0, record=True, unresponsive=()):
+        self.server = Server((host, port), Handler)
+        self.server.record = record
+        self.server.responder = responder
+        self.server.lock = threading.Lock()
+        self.server.connections = 0
+        # Queries answered, counted even when they are not recorded
+        self.server.requests = 0
+        self.server.queries = []
+        self.server.unresponsive = set(unresponsive)
+        self.server.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def address(self):
+        return self.server.server_address[:2]
+
+    @property
+    def connections(self):
+        return self.server.connections
+
+    @property
+    def requests(self):
+        return self.server.requests
+
+    @property
+    def queries(self):
+        return self.server.queries
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.stopped.set()
+        self.server.shutdown()
+        self.server.server_close()
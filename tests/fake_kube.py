@@ -0,0 +1,502 @@
+import argparse
+import copy
+import json
+import os
+import threading
+import time
+import urllib.parse
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import kube_api
+import topology
+
+# Local stand-in for the handful of core/v1, apps/v1 and clickhouse.altinity.com/v1
+# endpoints the harness talks to. Objects are kept in memory as plain dicts.
+# Run it as python3 fake_kube.py --kubeconfig=/tmp/fake-kubeconfig together with
+# KUBECONFIG=/tmp/fake-kubeconfig KUBECTL_CMD="python3 kubectl_shim.py" to run the harness without a cluster.
+
+
+class Store:
+    def __init__(self, history=1000):
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        # (prefix, plural) -> {(namespace, name): object}
+        self.objects = {}
+        # (resourceVersion, kind, event type, object), oldest first, at most history entries
+        self.events = []
+        self.history = history
+        self.resource_version = 0
+        self.requests = 0
+        self.connections = 0
+
+    def next_version(self):
+        self.resource_version += 1
+        return str(self.resource_version)
+
+    def collection(self, kind):
+        prefix, plural, _ = kube_api.resources[kind]
+        return self.objects.setdefault((prefix, plural), {})
+
+    def record(self, kind, event_type, obj):
+        _, plural, _ = kube_api.resources[kind]
+        self.events.append((int(obj["metadata"]["resourceVersion"]), plural, event_type, copy.deepcopy(obj)))
+        del self.events[:-self.history]
+        self.changed.notify_all()
+
+    def put(self, kind, obj):
+        with self.lock:
+            obj = copy.deepcopy(obj)
+            meta = obj.setdefault("metadata", {})
+            _, _, namespaced = kube_api.resources[kind]
+            if not namespaced:
+                meta.pop("namespace", None)
+            else:
+                meta.setdefault("namespace", "default")
+            key = (meta.get("namespace", ""), meta["name"])
+            event_type = "MODIFIED" if key in self.collection(kind) else "ADDED"
+            meta["resourceVersion"] = self.next_version()
+            self.collection(kind)[key] = obj
+            self.record(kind, event_type, obj)
+            return copy.deepcopy(obj)
+
+    def delete(self, kind, name, ns=None):
+        with self.lock:
+            if kube_api.resources[kind][1] == "namespaces":
+                # Deleting a namespace takes everything in it along
+                for (prefix, plural), objects in list(self.objects.items()):
+                    for obj_ns, obj_name in [key for key in objects if key[0] == name]:
+                        self.delete(plural, obj_name, obj_ns)
+            obj = self.collection(kind).pop((ns or "", name), None)
+            if obj is not None:
+                obj["metadata"]["resourceVersion"] = self.next_version()
+                self.record(kind, "DELETED", obj)
+            return obj
+
+    def events_since(self, kind, resource_version):
+        # Returns events newer than resource_version or None when it is older than the retained history
+        _, plural, _ = kube_api.resources[kind]
+        with self.lock:
+            if len(self.events) > 0 and resource_version < self.events[0][0] - 1:
+                return None
+            return [(rv, t, obj) for rv, p, t, obj in self.events if p == plural and rv > resource_version]
+
+    def get(self, kind, name, ns=None):
+        with self.lock:
+            obj = self.collection(kind).get((ns or "", name))
+            return copy.deepcopy(obj)
+
+    def list(self, kind, ns=None, label="", field=""):
+        with self.lock:
+            return [
+                copy.deepcopy(obj)
+                for (obj_ns, _), obj in sorted(self.collection(kind).items())
+                if matches(obj, ns, label, field)
+            ]
+
+
+def matches(obj, ns, label, field):
+    meta = obj["metadata"]
+    if ns is not None and meta.get("namespace", "") != ns:
+        return False
+    # Only metadata.name field selectors are used by the harness
+    if field.startswith("metadata.name=") and meta["name"] != field[len("metadata.name="):]:
+        return False
+    return kube_api.match_labels(meta.get("labels"), label)
+
+
+def parse_path(path):
+    # /api/v1/namespaces/test/pods/name -> ("pods", "test", "name")
+    parts = [p for p in path.split("/") if p != ""]
+    if len(parts) > 0 and parts[0] == "api":
+        prefix, rest = "/".join(parts[:2]), parts[2:]
+    else:
+        prefix, rest = "/".join(parts[:3]), parts[3:]
+    ns = None
+    if len(rest) >= 2 and rest[0] == "namespaces" and len(rest) != 2:
+        ns, rest = rest[1], rest[2:]
+    if len(rest) == 0:
+        return None
+    kind = rest[0]
+    if kind not in kube_api.resources or kube_api.resources[kind][0] != prefix:
+        return None
+    name = rest[1] if len(rest) > 1 else ""
+    return kind, ns, name
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.store.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def not_found(self, what):
+        self.reply(404, {"kind": "Status", "status": "Failure", "reason": "NotFound", "message": f"{what} not found", "code": 404})
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length)) if length > 0 else {}
+
+    def route(self):
+        url = urllib.parse.urlsplit(self.path)
+        self.server.store.requests += 1
+        return parse_path(url.path), dict(urllib.parse.parse_qsl(url.query))
+
+    def do_GET(self):
+        target, query = self.route()
+        if target is None:
+            return self.not_found(self.path)
+        kind, ns, name = target
+        store = self.server.store
+        if name != "":
+            obj = store.get(kind, name, ns)
+            return self.reply(200, obj) if obj is not None else self.not_found(f"{kind} {name}")
+        if query.get("watch") in ("1", "true"):
+            return self.watch(kind, ns, query)
+        with store.lock:
+            items = store.list(kind, ns, query.get("labelSelector", ""), query.get("fieldSelector", ""))
+            version = str(store.resource_version)
+        self.reply(200, {"kind": "List", "apiVersion": "v1", "metadata": {"resourceVersion": version}, "items": items})
+
+    def send_event(self, event_type, obj):
+        data = json.dumps({"type": event_type, "object": obj}).encode() + b"\n"
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def watch(self, kind, ns, query):
+        store = self.server.store
+        label = query.get("labelSelector", "")
+        field = query.get("fieldSelector", "")
+        deadline = time.monotonic() + int(query.get("timeoutSeconds", 60))
+        with store.lock:
+            resource_version = int(query.get("resourceVersion") or store.resource_version)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            while time.monotonic() < deadline:
+                with store.lock:
+                    events = store.events_since(kind, resource_version)
+                    if events is not None and len(events) == 0:
+                        store.changed.wait(min(1.0, max(deadline - time.monotonic(), 0)))
+                        continue
+                if events is None:
+                    self.send_event("ERROR", {"kind": "Status", "status": "Failure", "reason": "Expired", "code": 410})
+                    break
+                for rv, event_type, obj in events:
+                    resource_version = rv
+                    if matches(obj, ns, label, field):
+                        self.send_event(event_type, obj)
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def do_POST(self):
+        target, _ = self.route()
+        if target is None:
+            return self.not_found(self.path)
+        kind, ns, _ = target
+        obj = self.read_body()
+        if ns is not None:
+            obj.setdefault("metadata", {})["namespace"] = ns
+        self.reply(201, self.server.store.put(kind, obj))
+
+    def do_PUT(self):
+        self.do_POST()
+
+    def do_DELETE(self):
+        target, _ = self.route()
+        if target is None:
+            return self.not_found(self.path)
+        kind, ns, name = target
+        obj = self.server.store.delete(kind, name, ns)
+        return self.reply(200, obj) if obj is not None else self.not_found(f"{kind} {name}")
+
+
+chi_label = "clickhouse.altinity.com/chi"
+default_image = "yandex/clickhouse-server:latest"
+default_ports = {"http_port": 8123, "tcp_port": 9000, "interserver_http_port": 9009}
+
+
+def chi_topology(store, chi):
+    # CHITs of every namespace are visible to the operator
+    return topology.expand(chi, store.list("chit"), chi["metadata"].get("namespace", ""))
+
+
+def pod_spec(chi, spec, host):
+    settings = (spec.get("configuration") or {}).get("settings") or {}
+    ports = {name: int(settings.get(name, port)) for name, port in default_ports.items()}
+    pod_templates = {t["name"]: t for t in (spec.get("templates") or {}).get("podTemplates") or []}
+    template = pod_templates.get(host.templates.get("podTemplate")) or {}
+    pod = copy.deepcopy(template.get("spec") or {})
+    containers = pod.setdefault("containers", [{"name": "clickhouse"}])
+    container = containers[0]
+    container.setdefault("image", default_image)
+    container.setdefault("ports", [{"name": name.rsplit("_", 1)[0], "containerPort": port} for name, port in ports.items()])
+    mounts = container.setdefault("volumeMounts", [])
+    for name, path in (("logVolumeClaimTemplate", "/var/log/clickhouse-server"), ("dataVolumeClaimTemplate", "/var/lib/clickhouse")):
+        if host.templates.get(name):
+            mounts.append({"name": host.templates[name], "mountPath": path})
+    for distribution in template.get("podDistribution") or []:
+        if distribution.get("type") == "ClickHouseAntiAffinity":
+            ns = chi["metadata"].get("namespace", "")
+            pod["affinity"] = {"podAntiAffinity": {"requiredDuringSchedulingIgnoredDuringExecution": [{
+                "labelSelector": {"matchLabels": {
+                    "clickhouse.altinity.com/app": "chop",
+                    chi_label: chi["metadata"]["name"],
+                    "clickhouse.altinity.com/namespace": ns,
+                }},
+                "topologyKey": "kubernetes.io/hostname",
+            }]}}
+    return pod
+
+
+class Reconciler:
+    # Simulated operator: turns every CHI put into the store into per-host statefulsets, pods and services,
+    # the CHI service and the common configmaps, then reports it Completed. Hosts become ready one by one,
+    # ready_delay seconds apart, like the operator rolls them out. Deleted CHIs take their objects along.
+    def __init__(self, store, ready_delay=0.0):
+        self.store = store
+        self.ready_delay = ready_delay
+        # (namespace, chi) -> spec of the last reconcile, so the reconciler's own status updates are skipped
+        self.applied = {}
+        # (namespace, chi) -> pending readiness timer
+        self.timers = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.reconciles = 0
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        with self.store.lock:
+            self.store.changed.notify_all()
+        with self.lock:
+            for timer in self.timers.values():
+                timer.cancel()
+        self.thread.join()
+
+    def run(self):
+        with self.store.lock:
+            resource_version = self.store.resource_version
+            pending = self.store.list("chi")
+        for chi in pending:
+            self.reconcile(chi)
+        while not self.stopped.is_set():
+            with self.store.lock:
+                events = self.store.events_since("chi", resource_version)
+                if events is not None and len(events) == 0:
+                    self.store.changed.wait(1.0)
+                    continue
+                if events is None:
+                    # Fell behind the retained history, start over from the current state
+                    events = [(self.store.resource_version, "ADDED", chi) for chi in self.store.list("chi")]
+            for rv, event_type, chi in events:
+                resource_version = rv
+                if event_type == "DELETED":
+                    self.remove(chi)
+                else:
+                    self.reconcile(chi)
+
+    def owned(self, chi, kinds=("statefulset", "pod", "service", "configmap")):
+        ns = chi["metadata"].get("namespace", "")
+        label = f"{chi_label}={chi['metadata']['name']}"
+        return [(kind, obj) for kind in kinds for obj in self.store.list(kind, ns, label)]
+
+    def remove(self, chi):
+        key = (chi["metadata"].get("namespace", ""), chi["metadata"]["name"])
+        with self.lock:
+            self.applied.pop(key, None)
+            timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        for kind, obj in self.owned(chi):
+            self.store.delete(kind, obj["metadata"]["name"], key[0])
+
+    def reconcile(self, chi):
+        meta = chi["metadata"]
+        ns, name = meta.get("namespace", ""), meta["name"]
+        key = (ns, name)
+        with self.lock:
+            if self.applied.get(key) == chi.get("spec"):
+                return
+            self.applied[key] = copy.deepcopy(chi.get("spec"))
+            timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        self.reconciles += 1
+
+        self.set_status(ns, name, {"status": "InProgress"})
+        common = {"clickhouse.altinity.com/app": "chop", chi_label: name, "clickhouse.altinity.com/namespace": ns}
+        wanted = set()
+
+        def put(kind, obj_name, labels, **fields):
+            wanted.add((kind, obj_name))
+            obj = {"metadata": {"name": obj_name, "namespace": ns, "labels": labels}}
+            obj.update(fields)
+            self.store.put(kind, obj)
+
+        expected = chi_topology(self.store, chi)
+        spec = topology.templated(chi, self.store.list("chit"))
+        # Services of the CHI, clusters and shards come first, the host ones follow
+        for service in expected.services[:len(expected.services) - len(expected.hosts)]:
+            put("service", service, common, spec={"type": "LoadBalancer" if service == expected.services[0] else "ClusterIP"})
+        put("configmap", expected.configmaps[0], common, data={
+            "01-clickhouse-listen.xml": "", "02-clickhouse-logger.xml": "", "03-clickhouse-querylog.xml": "",
+        })
+        put("configmap", expected.configmaps[1], common, data={
+            "01-clickhouse-user.xml": "", "02-clickhouse-default-profile.xml": "",
+        })
+        hosts = []
+        for host in expected.hosts:
+            labels = dict(common, **{
+                "clickhouse.altinity.com/cluster": host.cluster,
+                "clickhouse.altinity.com/shard": host.shard,
+                "clickhouse.altinity.com/shardScopeIndex": str(host.replica_index),
+                "clickhouse.altinity.com/replica": host.replica,
+                "clickhouse.altinity.com/replicaScopeIndex": str(host.shard_index),
+            })
+            pod = pod_spec(chi, spec, host)
+            put("configmap", host.configmap, labels, data={})
+            put("statefulset", host.statefulset, labels, spec={"replicas": 1, "template": {"spec": pod}}, status={"readyReplicas": 0})
+            put("service", host.service, labels, spec={"type": "ClusterIP"})
+            put("pod", host.pod, labels, spec=copy.deepcopy(pod), status={
+                "phase": "Pending", "conditions": [{"type": "Ready", "status": "False"}],
+            })
+            hosts.append(host.statefulset)
+        for kind, obj in self.owned(chi):
+            if (kind, obj["metadata"]["name"]) not in wanted:
+                self.store.delete(kind, obj["metadata"]["name"], ns)
+        self.schedule(key, hosts, 0)
+
+    def schedule(self, key, hosts, ready):
+        # Makes hosts[ready] ready after ready_delay, the CHI is Completed once all of them are
+        if ready == len(hosts):
+            ns, name = key
+            self.set_status(ns, name, {
+                "status": "Completed",
+                "hostsCount": len(hosts),
+                "pods": [f"{host}-0" for host in hosts],
+                "fqdns": [f"{host}.{ns}.svc.cluster.local" for host in hosts],
+            })
+            with self.lock:
+                self.timers.pop(key, None)
+            return
+
+        def ready_host():
+            if self.stopped.is_set():
+                return
+            self.set_ready(key[0], hosts[ready])
+            self.schedule(key, hosts, ready + 1)
+
+        timer = threading.Timer(self.ready_delay, ready_host)
+        timer.daemon = True
+        with self.lock:
+            self.timers[key] = timer
+        timer.start()
+
+    def set_ready(self, ns, host):
+        with self.store.lock:
+            sts = self.store.get("statefulset", host, ns)
+            pod = self.store.get("pod", f"{host}-0", ns)
+            if sts is None or pod is None:
+                return
+            sts["status"] = {"replicas": 1, "readyReplicas": 1}
+            pod["status"] = {
+                "phase": "Running",
+                "conditions": [{"type": "Ready", "status": "True"}],
+                "containerStatuses": [{"name": "clickhouse", "ready": True}],
+            }
+            self.store.put("statefulset", sts)
+            self.store.put("pod", pod)
+
+    def set_status(self, ns, name, status):
+        with self.store.lock:
+            chi = self.store.get("chi", name, ns)
+            if chi is not None:
+                chi["status"] = status
+                self.store.put("chi", chi)
+
+
+class FakeKube:
+    def __init__(self, host="127.0.0.1", port=0, reconcile=False, ready_delay=0.0):
+        self.store = Store()
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.server.store = self.store
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.reconciler = Reconciler(self.store, ready_delay) if reconcile else None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        if self.reconciler is not None:
+            self.reconciler.start()
+        return self
+
+    def stop(self):
+        if self.reconciler is not None:
+            self.reconciler.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def api(self, default_ns="default"):
+        return kube_api.KubeAPI(self.url, default_ns=default_ns)
+
+    def add_crds(self):
+        # Scenarios check for the operator CRDs before touching CHIs
+        for plural in ("clickhouseinstallations", "clickhouseinstallationtemplates"):
+            self.store.put("crd", {"metadata": {"name": f"{plural}.clickhouse.altinity.com"}})
+        return self
+
+    def write_kubeconfig(self, path, ns="default"):
+        config = {
+            "apiVersion": "v1",
+            "kind": "Config",
+            "clusters": [{"name": "fake", "cluster": {"server": self.url}}],
+            "users": [{"name": "fake", "user": {}}],
+            "contexts": [{"name": "fake", "context": {"cluster": "fake", "user": "fake", "namespace": ns}}],
+            "current-context": "fake",
+        }
+        with open(path, "w") as f:
+            json.dump(config, f)
+        return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="In-memory Kubernetes API server with a simulated operator")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--kubeconfig", default=os.path.join(os.getcwd(), "fake-kubeconfig"))
+    parser.add_argument("--ready-delay", type=float, default=1.0, help="seconds between hosts of a CHI becoming ready")
+    args = parser.parse_args()
+    kube = FakeKube(port=args.port, reconcile=True, ready_delay=args.ready_delay).add_crds().start()
+    print(f"Serving {kube.url}, kubeconfig written to {kube.write_kubeconfig(args.kubeconfig)}", flush=True)
+    try:
+        kube.thread.join()
+    except KeyboardInterrupt:
+        kube.stop()
+
+
+if __name__ == "__main__":
+    main()
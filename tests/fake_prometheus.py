@@ -0,0 +1,145 @@
+import json
+import re
+import threading
+import time
+import urllib.parse
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the Prometheus HTTP API. Queries are answered from a list of series,
+# only plain selectors such as ALERTS{alertname=~"a|b",alertstate="firing"}[30s] are understood.
+# Other GET paths are served from pages, e.g. {"/metrics": exposition text} plays the metrics-exporter.
+
+selector_re = re.compile(r'^\s*([a-zA-Z_:][a-zA-Z0-9_:]*)?\s*(?:\{(.*)\})?\s*(?:\[(\w+)\])?\s*$')
+matcher_re = re.compile(r'\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*(=~|!~|!=|=)\s*"((?:[^"\\]|\\.)*)"\s*,?')
+
+
+class BadQuery(Exception):
+    pass
+
+
+def parse_selector(promql):
+    # Returns (metric name or None, [(label, op, value)], range or None)
+    match = selector_re.match(promql)
+    if match is None:
+        raise BadQuery(f"unsupported query {promql!r}")
+    name, matchers, range_ = match.groups()
+    parsed = []
+    position = 0
+    while matchers is not None and position < len(matchers):
+        m = matcher_re.match(matchers, position)
+        if m is None:
+            raise BadQuery(f"bad matcher in {promql!r}")
+        parsed.append((m.group(1), m.group(2), m.group(3).encode().decode("unicode_escape")))
+        position = m.end()
+    return name, parsed, range_
+
+
+def matches(labels, name, matchers):
+    if name is not None and labels.get("__name__") != name:
+        return False
+    for label, op, value in matchers:
+        actual = labels.get(label, "")
+        if op == "=" and actual != value or op == "!=" and actual == value:
+            return False
+        if op == "=~" and re.fullmatch(value, actual) is None or op == "!~" and re.fullmatch(value, actual) is not None:
+            return False
+    return True
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes, Nagle would hold the body back for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body, content_type="application/json"):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def params(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        length = int(self.headers.get("Content-Length", 0))
+        if length > 0:
+            params.update(urllib.parse.parse_qsl(self.rfile.read(length).decode()))
+        return url.path, params
+
+    def answer(self, path, params):
+        if path not in ("/api/v1/query", "/api/v1/query_range"):
+            if path in self.server.pages:
+                return self.reply(200, self.server.pages[path], "text/plain; version=0.0.4")
+            return self.reply(404, "404 page not found\n", "text/plain")
+        with self.server.lock:
+            self.server.queries.append(params.get("query", ""))
+        try:
+            name, matchers, range_ = parse_selector(params.get("query", ""))
+        except BadQuery as e:
+            return self.reply(400, json.dumps({"status": "error", "errorType": "bad_data", "error": str(e)}))
+        now = float(params.get("time", time.time()))
+        with self.server.lock:
+            selected = [(labels, value) for labels, value in self.server.series if matches(labels, name, matchers)]
+        if path == "/api/v1/query_range" or range_ is not None:
+            data = {"resultType": "matrix", "result": [
+                {"metric": labels, "values": [[now, str(value)]]} for labels, value in selected
+            ]}
+        else:
+            data = {"resultType": "vector", "result": [
+                {"metric": labels, "value": [now, str(value)]} for labels, value in selected
+            ]}
+        self.reply(200, json.dumps({"status": "success", "data": data}))
+
+    def do_GET(self):
+        self.answer(*self.params())
+
+    def do_POST(self):
+        self.answer(*self.params())
+
+
+class FakePrometheus:
+    def __init__(self, series=None, pages=None, host="127.0.0.1", port=0):
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.connections = 0
+        self.server.queries = []
+        # [(labels including __name__, value)]
+        self.server.series = list(series or [])
+        self.server.pages = dict(pages or {})
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def connections(self):
+        return self.server.connections
+
+    @property
+    def queries(self):
+        return self.server.queries
+
+    def set_series(self, series):
+        with self.server.lock:
+            self.server.series = list(series)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,562 @@
+import base64
+import concurrent.futures
+import http.client
+import json
+import os
+import re
+import socket
+import ssl
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import yaml
+
+# kind alias -> (api prefix, plural, namespaced)
+resources = {}
+
+
+def register_resource(prefix, plural, namespaced, *aliases):
+    for alias in (plural,) + aliases:
+        resources[alias] = (prefix, plural, namespaced)
+
+
+register_resource("api/v1", "pods", True, "pod", "po")
+register_resource("api/v1", "services", True, "service", "svc")
+register_resource("api/v1", "configmaps", True, "configmap", "cm")
+register_resource("api/v1", "persistentvolumeclaims", True, "persistentvolumeclaim", "pvc")
+register_resource("api/v1", "persistentvolumes", False, "persistentvolume", "pv")
+register_resource("api/v1", "namespaces", False, "namespace", "ns")
+register_resource("apis/apps/v1", "statefulsets", True, "statefulset", "sts")
+register_resource("apis/apps/v1", "deployments", True, "deployment", "deploy", "deployment.v1.apps")
+register_resource("apis/storage.k8s.io/v1", "storageclasses", False, "storageclass", "sc")
+register_resource("apis/apiextensions.k8s.io/v1", "customresourcedefinitions", False, "customresourcedefinition", "crd", "crds")
+register_resource("apis/clickhouse.altinity.com/v1", "clickhouseinstallations", True, "clickhouseinstallation", "chi")
+register_resource("apis/clickhouse.altinity.com/v1", "clickhouseinstallationtemplates", True, "clickhouseinstallationtemplate", "chit")
+
+
+class KubeAPIError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+        self.message = message
+
+
+class UnsupportedKubeconfig(Exception):
+    pass
+
+
+def resource_path(kind, name="", ns=None):
+    if kind not in resources:
+        raise KeyError(f"unknown resource kind {kind}")
+    prefix, plural, namespaced = resources[kind]
+    path = f"/{prefix}"
+    if namespaced and ns is not None and ns != "" and ns != "--all-namespaces":
+        path += f"/namespaces/{ns}"
+    path += f"/{plural}"
+    if name != "":
+        path += f"/{name}"
+    return path
+
+
+def parse_selector(label):
+    # Accepts kubectl-style "-l a=b,c=d", "--selector=a=b" or a bare selector
+    label = label.strip()
+    if label.startswith("-l "):
+        return label[3:].strip()
+    if label.startswith("--selector="):
+        return label[len("--selector="):].strip()
+    if label.startswith("-l"):
+        return label[2:].strip()
+    return label
+
+
+class KubeAPI:
+    def __init__(self, server, token=None, ssl_context=None, default_ns="default", timeout=60, basic_auth=None):
+        url = urllib.parse.urlsplit(server)
+        self.scheme = url.scheme
+        self.host = url.hostname
+        self.port = url.port
+        self.base_path = url.path.rstrip("/")
+        self.default_ns = default_ns
+        self.timeout = timeout
+        self.ssl_context = ssl_context
+        self.headers = {"Accept": "application/json"}
+        if token is not None:
+            self.headers["Authorization"] = f"Bearer {token}"
+        elif basic_auth is not None:
+            auth = base64.b64encode(f"{basic_auth[0]}:{basic_auth[1]}".encode()).decode()
+            self.headers["Authorization"] = f"Basic {auth}"
+        self.pool = []
+        self.lock = threading.Lock()
+        self.requests = 0
+        # Called as on_request(method, path, started, finished, status, size) after every non-watch request
+        self.on_request = None
+
+    def new_connection(self, timeout):
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.host, self.port, timeout=timeout, context=self.ssl_context)
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+
+    def acquire(self, timeout):
+        with self.lock:
+            conn = self.pool.pop() if len(self.pool) > 0 else None
+        if conn is None:
+            return self.new_connection(timeout)
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn
+
+    def release(self, conn):
+        with self.lock:
+            self.pool.append(conn)
+
+    def close(self):
+        with self.lock:
+            pool, self.pool = self.pool, []
+        for conn in pool:
+            conn.close()
+
+    def open(self, method, path, query=None, body=None, timeout=None):
+        # Returns an open response together with the connection it is bound to,
+        # caller must read the response and hand the connection to finish()
+        timeout = self.timeout if timeout is None else timeout
+        url = self.base_path + path
+        if query:
+            url += "?" + urllib.parse.urlencode(query)
+        headers = dict(self.headers)
+        if body is not None:
+            body = json.dumps(body).encode()
+            headers["Content-Type"] = "application/json"
+        self.requests += 1
+        # A pooled keep-alive connection may have been closed by the server, retry once on a fresh one
+        for attempt in range(2):
+            conn = self.acquire(timeout)
+            try:
+                conn.request(method, url, body=body, headers=headers)
+                return conn, conn.getresponse()
+            except (http.client.RemoteDisconnected, http.client.CannotSendRequest, BrokenPipeError, ConnectionResetError):
+                conn.close()
+                if attempt == 1:
+                    raise
+
+    def finish(self, conn, response):
+        if response.will_close:
+            conn.close()
+        else:
+            self.release(conn)
+
+    def request(self, method, path, query=None, body=None, timeout=None):
+        started = time.time()
+        conn, response = self.open(method, path, query, body, timeout)
+        try:
+            data = response.read()
+        except Exception:
+            conn.close()
+            raise
+        self.finish(conn, response)
+        if self.on_request is not None:
+            self.on_request(method, path, started, time.time(), response.status, len(data))
+        if response.status >= 400:
+            message = data.decode(errors="replace")
+            try:
+                message = json.loads(message).get("message", message)
+            except ValueError:
+                pass
+            raise KubeAPIError(response.status, message)
+        return json.loads(data) if len(data) > 0 else {}
+
+    def namespace(self, ns):
+        return self.default_ns if ns is None or ns == "" else ns
+
+    def get(self, kind, name="", label="", ns=None, field="", timeout=None):
+        query = selectors(label, field)
+        return self.request("GET", resource_path(kind, name, self.namespace(ns)), query=query, timeout=timeout)
+
+    def list(self, kind, label="", ns=None, field="", timeout=None):
+        return self.get(kind, "", label=label, ns=ns, field=field, timeout=timeout)["items"]
+
+    def watch(self, kind, label="", ns=None, field="", resource_version=None, timeout=60, on_open=None):
+        # Yields (type, object) events until the server closes the stream after timeout seconds
+        query = selectors(label, field)
+        query["watch"] = "1"
+        query["allowWatchBookmarks"] = "true"
+        query["timeoutSeconds"] = str(int(timeout))
+        if resource_version is not None:
+            query["resourceVersion"] = resource_version
+        conn, response = self.open("GET", resource_path(kind, "", self.namespace(ns)), query=query, timeout=timeout + 10)
+        if response.status >= 400:
+            data = response.read()
+            self.finish(conn, response)
+            raise KubeAPIError(response.status, data.decode(errors="replace"))
+        if on_open is not None:
+            on_open(conn)
+        done = False
+        try:
+            while True:
+                line = response.readline()
+                if not line:
+                    break
+                if line.strip() == b"":
+                    continue
+                event = json.loads(line)
+                yield event["type"], event["object"]
+            done = True
+        finally:
+            # A stream abandoned half way can not be reused
+            if done:
+                self.finish(conn, response)
+            else:
+                conn.close()
+
+
+def list_many(api, kinds, label="", ns=None):
+    # Kubernetes has no multi-kind list endpoint: issue the lists concurrently over pooled
+    # connections so the batch costs a single round trip. Returns {kind: items}.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(kinds)) as pool:
+        futures = {kind: pool.submit(api.list, kind, label, ns) for kind in kinds}
+        return {kind: future.result() for kind, future in futures.items()}
+
+
+def is_ready(kind, obj):
+    plural = resources[kind][1] if kind in resources else kind
+    status = obj.get("status") or {}
+    if plural == "pods":
+        for condition in status.get("conditions") or []:
+            if condition["type"] == "Ready":
+                return condition["status"] == "True"
+        return False
+    if plural == "statefulsets":
+        replicas = (obj.get("spec") or {}).get("replicas", 1)
+        return status.get("readyReplicas", 0) == replicas
+    if plural == "persistentvolumeclaims":
+        return status.get("phase") == "Bound"
+    if plural == "clickhouseinstallations":
+        return status.get("status") == "Completed"
+    return True
+
+
+def selectors(label="", field=""):
+    query = {}
+    label = parse_selector(label)
+    if label != "":
+        query["labelSelector"] = label
+    if field != "":
+        query["fieldSelector"] = field
+    return query
+
+
+def object_key(obj):
+    return obj["metadata"].get("namespace", ""), obj["metadata"]["name"]
+
+
+class Reflector:
+    # Keeps self.objects in sync with the API server using list + resourceVersion-resumable watch.
+    # on_change is called from the reflector thread after every update.
+    def __init__(self, api, kind, name="", label="", ns=None, on_change=None, watch_timeout=60):
+        self.api = api
+        self.kind = kind
+        self.label = label
+        self.field = f"metadata.name={name}" if name != "" else ""
+        self.ns = ns
+        self.on_change = on_change
+        self.watch_timeout = watch_timeout
+        self.objects = {}
+        # (label, value) -> set of object keys
+        self.index = {}
+        self.lock = threading.Lock()
+        self.synced = threading.Event()
+        self.stopped = False
+        self.conn = None
+        self.error = None
+        self.resource_version = None
+        self.thread = None
+
+    def start(self):
+        # Can be restarted after stop(), the watch then resumes from the last seen resourceVersion
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped = True
+        conn = self.conn
+        if conn is not None and conn.sock is not None:
+            try:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def items(self):
+        with self.lock:
+            return [self.objects[key] for key in sorted(self.objects)]
+
+    def get(self, key):
+        with self.lock:
+            return self.objects.get(key)
+
+    def select(self, label="", name=""):
+        # Narrows candidates down with the label index, then checks the full selector
+        selector = parse_selector(label)
+        with self.lock:
+            keys = self.objects.keys()
+            for requirement in selector.split(","):
+                if "=" in requirement and "!=" not in requirement:
+                    key, value = requirement.replace("==", "=").split("=", 1)
+                    keys = self.index.get((key.strip(), value.strip()), set())
+                    break
+            return [
+                self.objects[key]
+                for key in sorted(keys)
+                if (name == "" or key[1] == name) and match_labels(self.objects[key]["metadata"].get("labels"), selector)
+            ]
+
+    def index_add(self, key, obj):
+        for label in (obj["metadata"].get("labels") or {}).items():
+            self.index.setdefault(label, set()).add(key)
+
+    def index_remove(self, key):
+        obj = self.objects.get(key)
+        if obj is None:
+            return
+        for label in (obj["metadata"].get("labels") or {}).items():
+            self.index.get(label, set()).discard(key)
+
+    def changed(self):
+        if self.on_change is not None:
+            self.on_change(self)
+
+    def relist(self):
+        res = self.api.get(self.kind, "", label=self.label, ns=self.ns, field=self.field)
+        with self.lock:
+            self.objects = {object_key(obj): obj for obj in res["items"]}
+            self.index = {}
+            for key, obj in self.objects.items():
+                self.index_add(key, obj)
+            self.resource_version = res["metadata"].get("resourceVersion")
+        self.synced.set()
+        self.changed()
+
+    def apply(self, event_type, obj):
+        with self.lock:
+            key = object_key(obj)
+            self.index_remove(key)
+            if event_type == "DELETED":
+                self.objects.pop(key, None)
+            else:
+                self.objects[key] = obj
+                self.index_add(key, obj)
+            self.resource_version = obj["metadata"].get("resourceVersion", self.resource_version)
+        self.changed()
+
+    def run(self):
+        while not self.stopped:
+            try:
+                if self.resource_version is None:
+                    self.relist()
+                events = self.api.watch(
+                    self.kind,
+                    label=self.label,
+                    ns=self.ns,
+                    field=self.field,
+                    resource_version=self.resource_version,
+                    timeout=self.watch_timeout,
+                    on_open=lambda conn: setattr(self, "conn", conn),
+                )
+                for event_type, obj in events:
+                    if self.stopped:
+                        break
+                    if event_type == "ERROR":
+                        # 410 Gone: resourceVersion is too old, start over from a fresh list
+                        if obj.get("code") == 410:
+                            self.resource_version = None
+                            break
+                        raise KubeAPIError(obj.get("code"), obj.get("message"))
+                    if event_type == "BOOKMARK":
+                        self.resource_version = obj["metadata"]["resourceVersion"]
+                        continue
+                    self.apply(event_type, obj)
+            except Exception as e:
+                if self.stopped:
+                    break
+                if isinstance(e, KubeAPIError) and e.status == 410:
+                    self.resource_version = None
+                self.error = e
+                time.sleep(1)
+            finally:
+                self.conn = None
+
+
+def wait_for(api, watches, predicate, timeout, ns=None):
+    # Watches every (kind, name, label) in watches and returns (True, lists) as soon as
+    # predicate(*lists) holds, each list being the current objects of one watch sorted by namespace/name.
+    # Returns (False, lists) with the last observed state once timeout seconds have passed.
+    condition = threading.Condition()
+
+    def notify(reflector):
+        with condition:
+            condition.notify_all()
+
+    reflectors = [
+        Reflector(api, kind, name=name, label=label, ns=api.namespace(ns), on_change=notify).start()
+        for kind, name, label in watches
+    ]
+    deadline = time.monotonic() + timeout
+    try:
+        with condition:
+            while True:
+                if all(r.synced.is_set() for r in reflectors):
+                    lists = [r.items() for r in reflectors]
+                    if predicate(*lists):
+                        return True, lists
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False, [r.items() for r in reflectors]
+                condition.wait(remaining)
+    finally:
+        for r in reflectors:
+            r.stop()
+
+
+def load_kubeconfig(path=None, context=None):
+    if path is None:
+        path = os.getenv("KUBECONFIG", os.path.join(os.path.expanduser("~"), ".kube", "config")).split(os.pathsep)[0]
+    with open(path, "r") as f:
+        config = yaml.safe_load(f)
+    base_dir = os.path.dirname(os.path.abspath(path))
+
+    def by_name(section, name):
+        for item in config.get(section) or []:
+            if item["name"] == name:
+                return item[section[:-1]]
+        raise UnsupportedKubeconfig(f"{section[:-1]} {name} not found in {path}")
+
+    ctx = by_name("contexts", context if context is not None else config.get("current-context"))
+    cluster = by_name("clusters", ctx["cluster"])
+    user = by_name("users", ctx["user"]) if "user" in ctx else {}
+
+    if "exec" in user or "auth-provider" in user:
+        raise UnsupportedKubeconfig("exec and auth-provider credentials are not supported")
+
+    def materialize(section, key, directory):
+        # kubeconfig allows both file paths and inline base64 data, ssl module needs files
+        if f"{key}-data" in section:
+            name = os.path.join(directory, f"{key}.pem")
+            with open(name, "wb") as f:
+                f.write(base64.b64decode(section[f"{key}-data"]))
+            return name
+        if key in section:
+            return os.path.join(base_dir, section[key])
+        return None
+
+    ssl_context = None
+    if cluster["server"].startswith("https"):
+        # ssl reads certificates and keys while the context is set up, inline ones are removed right after
+        with tempfile.TemporaryDirectory(prefix="kubeconfig-") as directory:
+            ssl_context = ssl.create_default_context(cafile=materialize(cluster, "certificate-authority", directory))
+            if cluster.get("insecure-skip-tls-verify", False):
+                ssl_context.check_hostname = False
+                ssl_context.verify_mode = ssl.CERT_NONE
+            cert = materialize(user, "client-certificate", directory)
+            if cert is not None:
+                ssl_context.load_cert_chain(cert, materialize(user, "client-key", directory))
+
+    token = user.get("token")
+    if token is None and "tokenFile" in user:
+        with open(user["tokenFile"], "r") as f:
+            token = f.read().strip()
+    basic_auth = (user["username"], user["password"]) if "username" in user else None
+
+    return KubeAPI(
+        cluster["server"],
+        token=token,
+        ssl_context=ssl_context,
+        default_ns=ctx.get("namespace", "default"),
+        basic_auth=basic_auth,
+    )
+
+
+def parse_field(field):
+    # ".status.containerStatuses[0].state" -> ["status", "containerStatuses", 0, "state"]
+    # dots escaped as "\\." are part of the key, as in annotation names
+    path = []
+    for part in re.split(r"(?<!\\)\.", field.strip()):
+        part = part.replace("\\.", ".")
+        if part == "":
+            continue
+        while "[" in part:
+            head, rest = part.split("[", 1)
+            if head != "":
+                path.append(head)
+            index, part = rest.split("]", 1)
+            path.append("*" if index == "*" else int(index))
+        if part != "":
+            path.append(part)
+    return path
+
+
+def eval_field(obj, field):
+    values = [obj]
+    for key in parse_field(field):
+        result = []
+        for value in values:
+            if key == "*":
+                if isinstance(value, list):
+                    result.extend(value)
+            elif isinstance(key, int):
+                if isinstance(value, list) and -len(value) <= key < len(value):
+                    result.append(value[key])
+            elif isinstance(value, dict) and key in value:
+                result.append(value[key])
+        values = result
+    return values
+
+
+def match_labels(labels, selector):
+    # Equality-based selectors plus bare "key" / "!key" existence checks
+    labels = labels or {}
+    for requirement in parse_selector(selector).split(","):
+        requirement = requirement.strip()
+        if requirement == "":
+            continue
+        if "!=" in requirement:
+            key, value = requirement.split("!=", 1)
+            if labels.get(key.strip()) == value.strip():
+                return False
+        elif "=" in requirement:
+            key, value = requirement.replace("==", "=").split("=", 1)
+            if labels.get(key.strip()) != value.strip():
+                return False
+        elif requirement.startswith("!"):
+            if requirement[1:] in labels:
+                return False
+        elif requirement not in labels:
+            return False
+    return True
+
+
+def format_value(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, separators=(",", ":"))
+    return str(value)
+
+
+def jsonpath(obj, field):
+    # Mimics kubectl -o jsonpath="{.field}" output for plain field paths
+    field = field.strip().strip('"')
+    if field.startswith("{") and field.endswith("}"):
+        field = field[1:-1]
+    return " ".join(format_value(v) for v in eval_field(obj, field))
+
+
+def custom_column(obj, field):
+    # Mimics kubectl -o=custom-columns cell rendering
+    values = eval_field(obj, field)
+    if len(values) == 0:
+        return "<none>"
+    return ",".join(format_value(v) for v in values)
@@ -0,0 +1,86 @@
+import threading
+import time
+
+import kube_api
+
+# Kinds the harness reads over and over within a scenario
+cached_kinds = ("pod", "statefulset", "service", "configmap", "pvc", "chi", "chit")
+
+
+class ObjectCache:
+    # In-process copy of the cached kinds, one watch-fed Reflector per (kind, namespace).
+    # Entries are replaced by watch events only, there is no time-based expiry.
+    # Returned objects are shared with the cache and must be treated as read-only.
+    def __init__(self, api, kinds=cached_kinds, sync_timeout=60):
+        self.api = api
+        self.plurals = {kube_api.resources[kind][1] for kind in kinds}
+        self.sync_timeout = sync_timeout
+        self.reflectors = {}
+        self.lock = threading.Lock()
+        self.changed = threading.Condition()
+        self.hits = 0
+        self.misses = 0
+
+    def caches(self, kind, ns):
+        if kind not in kube_api.resources or kube_api.resources[kind][1] not in self.plurals:
+            return False
+        return ns is not None and ns != "" and ns != "--all-namespaces"
+
+    def notify(self, reflector):
+        with self.changed:
+            self.changed.notify_all()
+
+    def reflector(self, kind, ns):
+        key = (kube_api.resources[kind][1], ns)
+        with self.lock:
+            reflector = self.reflectors.get(key)
+            if reflector is None:
+                # The initial list is the only API call this kind and namespace will ever cost
+                self.misses += 1
+                reflector = kube_api.Reflector(self.api, kind, ns=ns, on_change=self.notify).start()
+                self.reflectors[key] = reflector
+            else:
+                self.hits += 1
+        if not reflector.synced.wait(self.sync_timeout):
+            raise kube_api.KubeAPIError(504, f"{kind} cache in namespace {ns} did not sync: {reflector.error}")
+        return reflector
+
+    def get(self, kind, name, ns):
+        obj = self.reflector(kind, ns).get((ns, name))
+        if obj is not None:
+            return obj
+        # Not observed yet, e.g. created a moment ago: ask the API server directly
+        with self.lock:
+            self.hits -= 1
+            self.misses += 1
+        return self.api.get(kind, name, ns=ns)
+
+    def list(self, kind, label="", ns=None):
+        return self.reflector(kind, ns).select(label)
+
+    def wait_for(self, watches, predicate, timeout, ns):
+        # Same contract as kube_api.wait_for, but evaluated on the cached state
+        reflectors = [(self.reflector(kind, ns), name, label) for kind, name, label in watches]
+        deadline = time.monotonic() + timeout
+        with self.changed:
+            while True:
+                lists = [reflector.select(label, name) for reflector, name, label in reflectors]
+                if predicate(*lists):
+                    return True, lists
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False, lists
+                self.changed.wait(remaining)
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+    def stop(self, ns=None):
+        # Stops and drops the reflectors of ns, of every namespace when None, a later read starts them anew
+        with self.lock:
+            stopped = {key: r for key, r in self.reflectors.items() if ns is None or key[1] == ns}
+            for key in stopped:
+                del self.reflectors[key]
+        for reflector in stopped.values():
+            reflector.stop()
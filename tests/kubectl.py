@@ -1,10 +1,16 @@
+import hashlib
 import json
 import os
+import subprocess
 import time
+import kube_api
+import kube_cache
 import manifest
+import timeline
+import topology
 import util
 
-from testflows.core import TestScenario, Name, When, Then, Given, And, main, Module
+from testflows.core import TestScenario, Name, When, Then, Given, And, main, Module, fail
 from testflows.asserts import error
 from testflows.connect import Shell
 
@@ -17,17 +23,99 @@ shell = Shell()
 namespace = settings.test_namespace
 kubectl_cmd = settings.kubectl_cmd
 
+# Kubernetes API session used instead of forking kubectl for read-only calls, see get_api()
+api = None
+api_initialized = False
+# Watch-fed object cache on top of the API session, see kube_cache.ObjectCache
+cache = None
+# Called with (chi_name, ns) once a CHI has been (re)configured or deleted, used to drop derived state
+chi_change_hooks = []
+# (namespace, CHIT name) -> (spec digest, resourceVersion) of templates applied by apply_templates()
+templates = {}
 
-def launch(command, ok_to_fail=False, ns=namespace, timeout=60):
-    # Build command
+
+def get_api():
+    global api, api_initialized
+    if not api_initialized:
+        api_initialized = True
+        if settings.kubectl_backend == "api":
+            try:
+                set_api(kube_api.load_kubeconfig())
+            except Exception as e:
+                print(f"Kubernetes API session is not available, falling back to '{kubectl_cmd}': {e}")
+    return api
+
+
+def set_api(new_api, with_cache=None):
+    # Point the harness to a specific API server (e.g. a local stand-in), None restores the shell backend
+    global api, api_initialized, cache
+    if cache is not None:
+        cache.stop()
+    if with_cache is None:
+        with_cache = settings.kubectl_cache
+    api = new_api
+    api_initialized = True
+    if api is not None:
+        api.on_request = record_api_request
+    cache = kube_cache.ObjectCache(api) if api is not None and with_cache else None
+
+
+def record_api_request(method, path, started, finished, status, size):
+    # /api/v1/namespaces/test/pods -> test
+    parts = path.split("/")
+    ns = parts[parts.index("namespaces") + 1] if "namespaces" in parts[:-1] else None
+    timeline.record("api", f"{method} {path}", started, finished, ns=ns, status=status, bytes=size)
+
+
+def cached(kind, ns):
+    return get_api() is not None and cache is not None and cache.caches(kind, ns)
+
+
+def chi_changed(chi_name, ns):
+    for hook in chi_change_hooks:
+        hook(chi_name, ns)
+
+
+def cache_stats():
+    return cache.stats() if cache is not None else {"hits": 0, "misses": 0}
+
+
+def print_cache_stats(since):
+    stats = cache_stats()
+    hits = stats["hits"] - since["hits"]
+    misses = stats["misses"] - since["misses"]
+    print(f"API object cache: {hits} hits (API calls saved), {misses} misses")
+
+
+def api_args(kind, name, label):
+    # Returns (kind, name, label) for API calls or None when the call has to go through kubectl
+    if get_api() is None or kind not in kube_api.resources:
+        return None
+    name = name.strip()
+    if name.startswith("-l") or name.startswith("--selector"):
+        name, label = "", name
+    if " " in name:
+        return None
+    return kind, name, label
+
+
+def command_line(command, ns=namespace):
     cmd = f"{kubectl_cmd}"
     if ns is not None and ns != "" and ns != "--all-namespaces":
         cmd += f" --namespace={ns}"
     elif ns == "--all-namespaces":
         cmd += f" {ns}"
-    cmd += f" {command}"
+    return cmd + f" {command}"
+
+
+def launch(command, ok_to_fail=False, ns=namespace, timeout=60):
+    # Build command
+    cmd = command_line(command, ns)
     # Run command
-    cmd = shell(cmd, timeout=timeout)
+    with timeline.span("kubectl", command[:200], ns=ns) as event:
+        cmd = shell(cmd, timeout=timeout)
+        event["exitcode"] = cmd.exitcode
+        event["bytes"] = len(cmd.output)
     # Check command failure
     code = cmd.exitcode
     if not ok_to_fail:
@@ -39,6 +127,29 @@ def launch(command, ok_to_fail=False, ns=namespace, timeout=60):
     return cmd.output if (code == 0) or ok_to_fail else ""
 
 
+def launch_process(command, ok_to_fail=False, ns=namespace, timeout=60):
+    # Same as launch(), but runs in a process of its own, so it can be called from several threads at once
+    with timeline.span("kubectl", command[:200], ns=ns) as event:
+        try:
+            res = subprocess.run(
+                command_line(command, ns), shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                text=True, timeout=timeout,
+            )
+            code, output = res.returncode, res.stdout.rstrip("\n")
+        except subprocess.TimeoutExpired as e:
+            # Output collected so far may come back undecoded
+            output = e.stdout.decode(errors="replace") if isinstance(e.stdout, bytes) else e.stdout or ""
+            code = -1
+        event["exitcode"] = code
+        event["bytes"] = len(output)
+    if not ok_to_fail:
+        if code != 0:
+            print("command failed, output:")
+            print(output)
+        assert code == 0, error()
+    return output if (code == 0) or ok_to_fail else ""
+
+
 def delete_chi(chi, ns=namespace):
     with When(f"Delete chi {chi}"):
         launch(f"delete chi {chi}", ns=ns, timeout=180)
@@ -51,6 +162,7 @@ def delete_chi(chi, ns=namespace):
             },
             ns,
         )
+        chi_changed(chi, ns)
 
 
 def delete_all_chi(ns=namespace):
@@ -68,14 +180,15 @@ def create_and_check(config, check, ns=namespace, timeout=600):
 
     if "apply_templates" in check:
         print("Need to apply additional templates")
-        for t in check["apply_templates"]:
-            print("Applying template:" + t)
-            apply(util.get_full_path(t), ns)
-        time.sleep(5)
+        apply_templates(check["apply_templates"], ns)
 
     apply(config, ns=ns, timeout=timeout)
 
-    if "object_counts" in check:
+    if check.get("object_counts") == "auto":
+        expected = expected_topology(config, ns)
+        wait_objects(chi_name, topology.object_counts(expected), ns)
+        check_object_names(chi_name, expected, ns)
+    elif "object_counts" in check:
         wait_objects(chi_name, check["object_counts"], ns)
 
     if "pod_count" in check:
@@ -85,6 +198,7 @@ def create_and_check(config, check, ns=namespace, timeout=600):
         wait_chi_status(chi_name, check["chi_status"], ns)
     else:
         wait_chi_status(chi_name, "Completed", ns)
+    chi_changed(chi_name, ns)
 
     if "pod_image" in check:
         check_pod_image(chi_name, check["pod_image"], ns)
@@ -109,6 +223,16 @@ def create_and_check(config, check, ns=namespace, timeout=600):
 
 
 def get(kind, name, label="", ns=namespace):
+    args = api_args(kind, name, label)
+    if args is not None:
+        try:
+            if cache is not None and cache.caches(kind, ns):
+                if args[1] != "":
+                    return cache.get(kind, args[1], ns)
+                return {"items": cache.list(kind, args[2], ns)}
+            return api.get(*args, ns=ns)
+        except kube_api.KubeAPIError as e:
+            fail(f"get {kind} {name} {label} failed: {e}")
     out = launch(f"get {kind} {name} {label} -o json", ns=ns)
     return json.loads(out.strip())
 
@@ -120,23 +244,146 @@ def create_ns(ns):
 
 def delete_ns(ns, ok_to_fail=False):
     launch(f"delete ns {ns}", ns=None, ok_to_fail=ok_to_fail)
+    stop_cache(ns)
+
+
+def stop_cache(ns):
+    # Watches of a namespace that is gone or no longer used by this process
+    if cache is not None:
+        cache.stop(ns)
 
 
 def get_count(kind, name="", label="", ns=namespace):
+    args = api_args(kind, name, label)
+    if args is not None:
+        try:
+            if cache is not None and cache.caches(kind, ns) and args[1] == "":
+                return len(cache.list(kind, args[2], ns))
+            res = api.get(*args, ns=ns)
+        except kube_api.KubeAPIError:
+            return 0
+        return len(res["items"]) if "items" in res else 1
     out = launch(f"get {kind} {name} -o=custom-columns=kind:kind,name:.metadata.name {label}", ns=ns, ok_to_fail=True)
     if (out is None) or (len(out) == 0):
         return 0
     return len(out.splitlines()) - 1
 
 
-def count_objects(label="", ns=namespace):
+def get_object_states(label="", ns=namespace, kinds=("statefulset", "pod", "service")):
+    # Fetches all kinds in one batch, returns {kind: {name: ready}}
+    if get_api() is not None:
+        if cache is not None and all(cache.caches(kind, ns) for kind in kinds):
+            lists = {kind: cache.list(kind, label, ns) for kind in kinds}
+        else:
+            lists = kube_api.list_many(api, kinds, label=label, ns=ns)
+    else:
+        # kubectl accepts a comma-separated list of kinds, so a single process is enough
+        out = launch(f"get {','.join(kinds)} {label} -o json", ns=ns, ok_to_fail=True)
+        items = json.loads(out)["items"] if out.strip().startswith("{") else []
+        lists = {kind: [] for kind in kinds}
+        for item in items:
+            for kind in kinds:
+                if item["kind"].lower() == kube_api.resources[kind][1][:-1]:
+                    lists[kind].append(item)
     return {
-        "statefulset": get_count("sts", ns=ns, label=label),
-        "pod": get_count("pod", ns=ns, label=label),
-        "service": get_count("service", ns=ns, label=label),
+        kind: {item["metadata"]["name"]: kube_api.is_ready(kind, item) for item in items}
+        for kind, items in lists.items()
     }
 
 
+def count_objects(label="", ns=namespace, kinds=("statefulset", "pod", "service")):
+    states = get_object_states(label=label, ns=ns, kinds=kinds)
+    return {kind: len(states[kind]) for kind in kinds}
+
+
+def expected_topology(config, ns=namespace):
+    # Objects the operator creates for the CHI manifest, given the CHITs the namespace has
+    chits = get("chit", "", ns=ns)["items"]
+    return topology.expand(manifest.get(util.get_full_path(config)).doc, chits, ns)
+
+
+def check_object_names(chi_name, expected, ns=namespace):
+    with Then("StatefulSets and services should be named after the CHI layout"):
+        states = get_object_states(label=f"-l clickhouse.altinity.com/chi={chi_name}", ns=ns, kinds=("statefulset", "service"))
+        assert sorted(states["statefulset"]) == sorted(expected.statefulsets), error()
+        assert sorted(states["service"]) == sorted(expected.services), error()
+
+
+def template_digest(chit):
+    return hashlib.sha256(json.dumps(chit.get("spec"), sort_keys=True).encode()).hexdigest()
+
+
+def get_template(name, ns=namespace):
+    # CHIT as the cluster has it, None when there is none
+    if get_api() is not None:
+        try:
+            if cached("chit", ns):
+                return cache.get("chit", name, ns)
+            return api.get("chit", name, ns=ns)
+        except kube_api.KubeAPIError:
+            return None
+    out = launch(f"get chit {name} -o json", ns=ns, ok_to_fail=True)
+    return json.loads(out) if out.strip().startswith("{") else None
+
+
+def template_applied(chit, ns=namespace):
+    # True when the cluster already has this template: same spec, or the very object apply_templates() left there.
+    # The latter covers API servers that normalize the spec on the way in.
+    name = chit["metadata"]["name"]
+    current = get_template(name, ns)
+    if current is None:
+        return False
+    digest = template_digest(chit)
+    return template_digest(current) == digest or \
+        templates.get((ns, name)) == (digest, current["metadata"]["resourceVersion"])
+
+
+def apply_templates(paths, ns=namespace, timeout=30):
+    # Applies the CHIT manifests the cluster does not have yet or has in a different version,
+    # then waits until the new versions are served instead of sleeping
+    for path in paths:
+        config = util.get_full_path(path)
+        docs = manifest.load(config)
+        chits = [m.doc for m in docs if m.kind == "ClickHouseInstallationTemplate"]
+        if len(chits) == len(docs) and all(template_applied(chit, ns) for chit in chits):
+            print(f"Template {path} is up to date")
+            continue
+        print("Applying template:" + path)
+        with When(f"{config} is applied"):
+            out = launch(f"apply --validate=true -f {config} -o json", ns=ns, timeout=timeout)
+        applied = json.loads(out)
+        applied = applied["items"] if applied.get("kind") == "List" else [applied]
+        for chit, obj in zip(chits, [o for o in applied if o.get("kind") == "ClickHouseInstallationTemplate"]):
+            name = chit["metadata"]["name"]
+            templates[(ns, name)] = (template_digest(chit), obj["metadata"]["resourceVersion"])
+            wait_template(name, obj["metadata"]["resourceVersion"], ns)
+
+
+@timeline.timed("wait")
+def wait_template(name, resource_version, ns=namespace, timeout=30):
+    # apply returns once the API server has stored the object, with the cache it may take a watch event to see it,
+    # without the cache the CHIT is polled until it is served with the applied resourceVersion
+    with Then(f"chit {name} resourceVersion should be {resource_version}"):
+        if get_api() is None or not cached("chit", ns):
+            deadline = time.time() + timeout
+            while True:
+                chit = get_template(name, ns)
+                cur = chit["metadata"]["resourceVersion"] if chit is not None else None
+                if cur == resource_version or time.time() >= deadline:
+                    break
+                timeline.sleep(1)
+            assert cur == resource_version, error()
+            return
+        cur = wait_until(
+            [("chit", name, "")],
+            lambda objects: objects[0]["metadata"]["resourceVersion"] if len(objects) > 0 else None,
+            lambda cur: cur == resource_version,
+            ns,
+            timeout,
+        )
+        assert cur == resource_version, error()
+
+
 def apply(config, ns=namespace, validate=True, timeout=30):
     with When(f"{config} is applied"):
         launch(f"apply --validate={validate} -f {config}", ns=ns, timeout=timeout)
@@ -147,7 +394,31 @@ def delete(config, ns=namespace, timeout=30):
         launch(f"delete -f {config}", ns=ns, timeout=timeout)
 
 
-def wait_objects(chi, object_counts, ns=namespace):
+def retries_timeout(retries, backoff=5):
+    # Total time the linear backoff polling loops wait for, used as the deadline by watch-based waits
+    return backoff * retries * (retries - 1) / 2
+
+
+def wait_until(watches, value, expected, ns, timeout):
+    # Re-evaluates value(*objects) on every watch event until expected(value) holds or timeout expires
+    evaluations = [0]
+
+    def predicate(*lists):
+        # Every re-evaluation after the first one is a wait iteration
+        if evaluations[0] > 0:
+            timeline.retry()
+        evaluations[0] += 1
+        return expected(value(*lists))
+
+    if cache is not None and all(cache.caches(kind, ns) for kind, _, _ in watches):
+        _, lists = cache.wait_for(watches, predicate, timeout, ns)
+    else:
+        _, lists = kube_api.wait_for(api, watches, predicate, timeout, ns=ns)
+    return value(*lists)
+
+
+@timeline.timed("wait")
+def wait_objects(chi, object_counts, ns=namespace, timeout=None):
     with Then(
             f"Waiting for: "
             f"{object_counts['statefulset']} statefulsets, "
@@ -155,6 +426,17 @@ def wait_objects(chi, object_counts, ns=namespace):
             f"{object_counts['service']} services "
             f"to be available"
     ):
+        if get_api() is not None:
+            label = f"-l clickhouse.altinity.com/chi={chi}"
+            cur_object_counts = wait_until(
+                [("statefulset", "", label), ("pod", "", label), ("service", "", label)],
+                lambda sts, pods, services: {"statefulset": len(sts), "pod": len(pods), "service": len(services)},
+                lambda counts: counts == object_counts,
+                ns,
+                timeout or retries_timeout(max_retries),
+            )
+            assert cur_object_counts == object_counts, error()
+            return
         for i in range(1, max_retries):
             cur_object_counts = count_objects(label=f"-l clickhouse.altinity.com/chi={chi}", ns=ns)
             if cur_object_counts == object_counts:
@@ -166,67 +448,113 @@ def wait_objects(chi, object_counts, ns=namespace):
                     f"service: {cur_object_counts['service']} ]. "
                     f"Wait for {i * 5} seconds"
             ):
-                time.sleep(i * 5)
+                timeline.sleep(i * 5)
         assert cur_object_counts == object_counts, error()
 
 
-def wait_object(kind, name, label="", count=1, ns=namespace, retries=max_retries, backoff = 5):
+@timeline.timed("wait")
+def wait_object(kind, name, label="", count=1, ns=namespace, retries=max_retries, backoff = 5, timeout=None):
     with Then(f"{count} {kind}(s) {name} should be created"):
+        args = api_args(kind, name, label)
+        if args is not None:
+            cur_count = wait_until(
+                [args],
+                lambda objects: len(objects),
+                lambda cur: cur >= count,
+                ns,
+                timeout or retries_timeout(retries, backoff),
+            )
+            assert cur_count >= count, error()
+            return
         for i in range(1, retries):
             cur_count = get_count(kind, ns=ns, name=name, label=label)
             if cur_count >= count:
                 break
             with Then("Not ready. Wait for " + str(i * backoff) + " seconds"):
-                time.sleep(i * backoff)
+                timeline.sleep(i * backoff)
         assert cur_count >= count, error()
 
 
-def wait_command(command, result, count=1, ns=namespace, retries=max_retries):
+@timeline.timed("wait")
+def wait_command(command, result, count=1, ns=namespace, retries=max_retries, timeout=None):
+    # Arbitrary commands (e.g. exec) can not be watched, poll them with a short capped backoff until the deadline
     with Then(f"{command} should return {result}"):
-        for i in range(1, retries):
+        deadline = time.monotonic() + (timeout or retries_timeout(retries))
+        delay = 1
+        res = launch(command, ok_to_fail=True, ns=ns)
+        while res != result and time.monotonic() < deadline:
+            with Then("Not ready. Wait for " + str(delay) + " seconds"):
+                timeline.sleep(delay)
+            delay = min(delay * 2, 5)
             res = launch(command, ok_to_fail=True, ns=ns)
-            if res == result:
-                break
-            with Then("Not ready. Wait for " + str(i * 5) + " seconds"):
-                time.sleep(i * 5)
         assert res == result, error()
 
 
-def wait_chi_status(chi, status, ns=namespace, retries=max_retries):
-    wait_field("chi", chi, ".status.status", status, ns, retries)
+def wait_chi_status(chi, status, ns=namespace, retries=max_retries, timeout=None):
+    wait_field("chi", chi, ".status.status", status, ns, retries, timeout=timeout)
 
 
 def get_chi_status(chi, ns=namespace):
     get_field("chi", chi, ".status.status", ns)
 
 
-def wait_pod_status(pod, status, ns=namespace):
-    wait_field("pod", pod, ".status.phase", status, ns)
+def wait_pod_status(pod, status, ns=namespace, timeout=None):
+    wait_field("pod", pod, ".status.phase", status, ns, timeout=timeout)
 
 
-def wait_field(kind, name, field, value, ns=namespace, retries=max_retries, backoff = 5):
+@timeline.timed("wait")
+def wait_field(kind, name, field, value, ns=namespace, retries=max_retries, backoff = 5, timeout=None):
     with Then(f"{kind} {name} {field} should be {value}"):
+        args = api_args(kind, name, "")
+        if args is not None:
+            cur_value = wait_until(
+                [args],
+                lambda objects: kube_api.custom_column(objects[0], field) if len(objects) > 0 else None,
+                lambda cur: cur == value,
+                ns,
+                timeout or retries_timeout(retries, backoff),
+            )
+            assert cur_value == value, error()
+            return
         for i in range(1, retries):
             cur_value = get_field(kind, name, field, ns)
             if cur_value == value:
                 break
             with Then("Not ready. Wait for " + str(i * backoff) + " seconds"):
-                time.sleep(i * backoff)
+                timeline.sleep(i * backoff)
         assert cur_value == value, error()
 
 
-def wait_jsonpath(kind, name, field, value, ns=namespace, retries=max_retries):
+@timeline.timed("wait")
+def wait_jsonpath(kind, name, field, value, ns=namespace, retries=max_retries, timeout=None):
     with Then(f"{kind} {name} -o jsonpath={field} should be {value}"):
+        args = api_args(kind, name, "")
+        if args is not None:
+            cur_value = wait_until(
+                [args],
+                lambda objects: kube_api.jsonpath(objects[0], field) if len(objects) > 0 else None,
+                lambda cur: cur == value,
+                ns,
+                timeout or retries_timeout(retries),
+            )
+            assert cur_value == value, error()
+            return
         for i in range(1, retries):
             cur_value = get_jsonpath(kind, name, field, ns)
             if cur_value == value:
                 break
             with Then("Not ready. Wait for " + str(i * 5) + " seconds"):
-                time.sleep(i * 5)
+                timeline.sleep(i * 5)
         assert cur_value == value, error()
 
 
 def get_field(kind, name, field, ns=namespace):
+    args = api_args(kind, name, "")
+    if args is not None:
+        obj = get(kind, name, ns=ns)
+        if "items" in obj:
+            obj = obj["items"][0]
+        return kube_api.custom_column(obj, field)
     out = launch(f"get {kind} {name} -o=custom-columns=field:{field}", ns=ns).splitlines()
     return out[1]
 
@@ -237,6 +565,16 @@ def get_jsonpath(kind, name, field, ns=namespace):
 
 
 def get_default_storage_class(ns=namespace):
+    if get_api() is not None:
+        for sc in api.list("storageclass"):
+            annotations = sc["metadata"].get("annotations", {})
+            if annotations.get("storageclass.kubernetes.io/is-default-class") == "true":
+                return sc["metadata"]["name"]
+        for sc in api.list("storageclass"):
+            annotations = sc["metadata"].get("annotations", {})
+            if annotations.get("storageclass.beta.kubernetes.io/is-default-class") == "true":
+                return sc["metadata"]["name"]
+        return None
     out = launch(
         f"get storageclass "
         f"-o=custom-columns="
@@ -270,6 +608,9 @@ def get_pod_image(chi_name, ns=namespace):
 
 
 def get_pod_names(chi_name, ns=namespace):
+    if get_api() is not None:
+        pods = get("pod", "", ns=ns, label=f"-l clickhouse.altinity.com/chi={chi_name}")["items"]
+        return [pod["metadata"]["name"] for pod in pods]
     pod_names = launch(
         f"get pods -o=custom-columns=name:.metadata.name -l clickhouse.altinity.com/chi={chi_name}",
         ns=ns,
@@ -0,0 +1,309 @@
+import json
+import sys
+
+import yaml
+
+import kube_api
+
+# Minimal kubectl for offline harness runs against fake_kube.py: the subset of get, apply, delete, create ns,
+# set image, rollout status and patch the scenarios use, talking to the API server from KUBECONFIG.
+# Point the harness to it with KUBECTL_CMD="python3 /path/to/tests/kubectl_shim.py"
+
+# plural -> Kind, kubectl output carries the kind of every object
+kinds = {
+    "pods": "Pod",
+    "services": "Service",
+    "configmaps": "ConfigMap",
+    "persistentvolumeclaims": "PersistentVolumeClaim",
+    "persistentvolumes": "PersistentVolume",
+    "namespaces": "Namespace",
+    "statefulsets": "StatefulSet",
+    "deployments": "Deployment",
+    "storageclasses": "StorageClass",
+    "customresourcedefinitions": "CustomResourceDefinition",
+    "clickhouseinstallations": "ClickHouseInstallation",
+    "clickhouseinstallationtemplates": "ClickHouseInstallationTemplate",
+}
+
+
+class ShimError(Exception):
+    pass
+
+
+def parse_args(argv):
+    # Returns (namespace, positional args, {flag: value}), flags keep their last value except -f
+    ns = None
+    args = []
+    flags = {"-f": []}
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        name, _, value = arg.partition("=")
+        if name in ("-n", "--namespace", "-l", "--selector", "-o", "--output", "-f", "--filename", "-p", "--patch", "-c", "--type", "--validate"):
+            if value == "" and "=" not in arg and name != "--validate":
+                i += 1
+                value = argv[i]
+            name = {"--namespace": "-n", "--selector": "-l", "--output": "-o", "--filename": "-f", "--patch": "-p"}.get(name, name)
+            if name == "-f":
+                flags["-f"].append(value)
+            elif name == "-n":
+                ns = value
+            else:
+                flags[name] = value
+        elif arg.startswith("-l") and len(arg) > 2:
+            flags["-l"] = arg[2:]
+        elif arg in ("-A", "--all-namespaces"):
+            ns = "--all-namespaces"
+        elif arg.startswith("-"):
+            flags[name] = value
+        else:
+            args.append(arg)
+        i += 1
+    return ns, args, flags
+
+
+def resource(kind):
+    # "deployment.v1.apps/clickhouse-operator" -> ("deployment.v1.apps", "clickhouse-operator")
+    kind, _, name = kind.partition("/")
+    if kind.lower() not in kube_api.resources:
+        raise ShimError(f'error: the server doesn\'t have a resource type "{kind}"')
+    return kind.lower(), name
+
+
+def with_kind(kind, obj):
+    prefix, plural, _ = kube_api.resources[kind]
+    obj.setdefault("kind", kinds.get(plural, plural))
+    obj.setdefault("apiVersion", prefix.split("/", 1)[1] if prefix.startswith("apis/") else "v1")
+    return obj
+
+
+def not_found(kind, name):
+    return ShimError(f'Error from server (NotFound): {kube_api.resources[kind][1]} "{name}" not found')
+
+
+def fetch(api, kind, name, ns, label=""):
+    try:
+        if name != "":
+            return [with_kind(kind, api.get(kind, name, ns=ns))]
+        return [with_kind(kind, obj) for obj in api.list(kind, label, ns=ns)]
+    except kube_api.KubeAPIError as e:
+        if e.status == 404:
+            raise not_found(kind, name)
+        raise
+
+
+def render(objects, output, single):
+    if output == "json":
+        if single:
+            return json.dumps(objects[0], indent=4)
+        return json.dumps({"apiVersion": "v1", "kind": "List", "items": objects, "metadata": {}}, indent=4)
+    if output == "yaml":
+        return yaml.safe_dump(objects[0] if single else {"apiVersion": "v1", "kind": "List", "items": objects})
+    if output.startswith("custom-columns="):
+        columns = [c.split(":", 1) for c in output[len("custom-columns="):].split(",")]
+        rows = [[header for header, _ in columns]]
+        rows += [[kube_api.custom_column(obj, field) for _, field in columns] for obj in objects]
+        return format_table(rows)
+    if output.startswith("jsonpath="):
+        target = objects[0] if single else {"items": objects}
+        return kube_api.jsonpath(target, output[len("jsonpath="):])
+    if output == "name":
+        return "\n".join(f"{obj['kind'].lower()}/{obj['metadata']['name']}" for obj in objects)
+    if len(objects) == 0:
+        return ""
+    rows = [["NAME", "STATUS"]]
+    for obj in objects:
+        status = obj.get("status") or {}
+        rows.append([obj["metadata"]["name"], status.get("phase") or status.get("status") or ""])
+    return format_table(rows)
+
+
+def format_table(rows):
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return "\n".join("   ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() for row in rows)
+
+
+def get(api, ns, args, flags):
+    kind_names = args[0].split(",")
+    names = args[1:]
+    objects = []
+    for kind_name in kind_names:
+        kind, name = resource(kind_name)
+        if name != "":
+            names = [name]
+        for name in names or [""]:
+            objects += fetch(api, kind, name, ns, flags.get("-l", ""))
+    single = len(kind_names) == 1 and len(names) == 1
+    if len(objects) == 0 and flags.get("-o", "") == "":
+        print(f"No resources found in {api.namespace(ns)} namespace.", file=sys.stderr)
+    return render(objects, flags.get("-o", ""), single)
+
+
+def load_manifests(paths):
+    documents = []
+    for path in paths:
+        with (sys.stdin if path == "-" else open(path, "r")) as f:
+            documents += [d for d in yaml.safe_load_all(f) if d is not None]
+    items = []
+    for d in documents:
+        items += d["items"] if d.get("kind") == "List" else [d]
+    return items
+
+
+def manifest_kind(obj):
+    kind = obj.get("kind", "").lower()
+    return kind if kind in kube_api.resources else None
+
+
+def apply(api, ns, flags):
+    out = []
+    objects = []
+    for obj in load_manifests(flags["-f"]):
+        kind = manifest_kind(obj)
+        name = obj["metadata"]["name"]
+        if kind is None:
+            # RBAC objects, service accounts and the like only matter to a real cluster
+            out.append(f"{obj.get('kind', '').lower()}/{name} configured (not simulated)")
+            continue
+        obj_ns = obj["metadata"].get("namespace") or api.namespace(ns)
+        path = kube_api.resource_path(kind, name, obj_ns)
+        try:
+            existing = api.get(kind, name, ns=obj_ns)
+        except kube_api.KubeAPIError as e:
+            if e.status != 404:
+                raise
+            existing = None
+        if existing is not None and "status" in existing and "status" not in obj:
+            # apply does not touch the status subresource
+            obj["status"] = existing["status"]
+        if existing is None:
+            stored = api.request("POST", kube_api.resource_path(kind, "", obj_ns), body=obj)
+            out.append(f"{kind}/{name} created")
+        else:
+            stored = api.request("PUT", path, body=obj)
+            out.append(f"{kind}/{name} configured")
+        objects.append(with_kind(kind, stored))
+    if flags.get("-o", "") != "":
+        return render(objects, flags["-o"], len(objects) == 1)
+    return "\n".join(out)
+
+
+def delete_object(api, kind, name, ns, ignore_not_found=False):
+    try:
+        api.request("DELETE", kube_api.resource_path(kind, name, api.namespace(ns)))
+    except kube_api.KubeAPIError as e:
+        if e.status == 404 and not ignore_not_found:
+            raise not_found(kind, name)
+        if e.status != 404:
+            raise
+        return ""
+    return f'{kube_api.resources[kind][1][:-1]} "{name}" deleted'
+
+
+def delete(api, ns, args, flags):
+    ignore = flags.get("--ignore-not-found", "") in ("", "true") and "--ignore-not-found" in flags
+    if len(flags["-f"]) > 0:
+        out = []
+        for obj in load_manifests(flags["-f"]):
+            kind = manifest_kind(obj)
+            if kind is not None:
+                out.append(delete_object(api, kind, obj["metadata"]["name"], obj["metadata"].get("namespace") or ns, ignore))
+        return "\n".join(o for o in out if o != "")
+    kind, name = resource(args[0])
+    names = [name] if name != "" else args[1:]
+    return "\n".join(delete_object(api, kind, n, ns, ignore) for n in names)
+
+
+def create(api, ns, args, flags):
+    if len(args) == 2 and resource(args[0])[0] in ("ns", "namespace", "namespaces"):
+        try:
+            api.request("POST", kube_api.resource_path("ns"), body={"metadata": {"name": args[1]}})
+        except kube_api.KubeAPIError as e:
+            raise ShimError(f"Error from server: {e}")
+        return f"namespace/{args[1]} created"
+    if len(flags["-f"]) > 0:
+        return apply(api, ns, flags)
+    raise ShimError(f"error: kubectl_shim does not support create {' '.join(args)}")
+
+
+def merge(target, patch):
+    # JSON merge patch, RFC 7386
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge(target[key], value)
+        else:
+            target[key] = value
+    return target
+
+
+def update(api, kind, name, ns, change):
+    obj = fetch(api, kind, name, ns)[0]
+    change(obj)
+    api.request("PUT", kube_api.resource_path(kind, name, api.namespace(ns)), body=obj)
+
+
+def patch(api, ns, args, flags):
+    kind, name = resource(args[0])
+    name = name or args[1]
+    update(api, kind, name, ns, lambda obj: merge(obj, json.loads(flags["-p"])))
+    return f"{kind}/{name} patched"
+
+
+def set_image(api, ns, args, flags):
+    # set image deployment/name container=image [container=image ...]
+    kind, name = resource(args[1])
+    images = dict(a.split("=", 1) for a in args[2:])
+
+    def change(obj):
+        for container in obj["spec"]["template"]["spec"]["containers"]:
+            if container["name"] in images:
+                container["image"] = images[container["name"]]
+
+    update(api, kind, name, ns, change)
+    return f"{kind}/{name} image updated"
+
+
+def rollout(api, ns, args, flags):
+    # Nothing rolls out in the stand-in, the deployment only has to exist
+    kind, name = resource(args[1])
+    fetch(api, kind, name, ns)
+    return f'{kind} "{name}" successfully rolled out'
+
+
+def main(argv):
+    ns, args, flags = parse_args(argv)
+    if len(args) == 0:
+        raise ShimError("error: no command given")
+    verb, args = args[0], args[1:]
+    api = kube_api.load_kubeconfig()
+    if verb == "get":
+        return get(api, ns, args, flags)
+    if verb == "apply":
+        return apply(api, ns, flags)
+    if verb == "delete":
+        return delete(api, ns, args, flags)
+    if verb == "create":
+        return create(api, ns, args, flags)
+    if verb == "patch":
+        return patch(api, ns, args, flags)
+    if verb == "set" and len(args) > 0 and args[0] == "image":
+        return set_image(api, ns, args, flags)
+    if verb == "rollout" and len(args) > 0 and args[0] == "status":
+        return rollout(api, ns, args, flags)
+    # exec, port-forward, logs and friends need real pods
+    raise ShimError(f"error: kubectl_shim does not support '{verb}'")
+
+
+if __name__ == "__main__":
+    try:
+        out = main(sys.argv[1:])
+    except ShimError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    except kube_api.KubeAPIError as e:
+        print(f"Error from server: {e.message}", file=sys.stderr)
+        sys.exit(1)
+    if out != "":
+        print(out)
@@ -1,5 +1,119 @@
+import collections
+import glob
+import os
+import threading
+
 import yaml
 
+# Index of the CHI/CHIT manifests the harness uses. Files are parsed once and re-parsed only when their
+# mtime or size changes. Parsed documents are shared between callers, copy them before changing anything.
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+manifest_dirs = [
+    os.path.join(current_dir, "configs"),
+    os.path.join(current_dir, "templates"),
+    os.path.join(current_dir, "..", "docs", "chi-examples"),
+]
+
+# libyaml is several times faster than the pure Python loader
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Facts of one YAML document:
+# clusters: cluster names in manifest order
+# layout: {cluster: [replicas of shard 0, replicas of shard 1, ...]}
+# templates: {template kind: [names]} defined by the manifest, use_templates: names of CHITs it uses
+# images: container images of its pod templates
+Manifest = collections.namedtuple("Manifest", "path name kind clusters layout templates use_templates images doc")
+
+# absolute path -> ((mtime_ns, size), [Manifest])
+parsed = {}
+lock = threading.Lock()
+# absolute path -> YAMLError of files index() could not parse
+errors = {}
+
+
+def cluster_layout(cluster):
+    # Replica counts per shard, the way the operator's normalizer expands layout.shardsCount/replicasCount
+    # and explicit shards/replicas lists: counts not given are the largest the lists imply
+    layout = cluster.get("layout") or {}
+    shards = layout.get("shards") or []
+    replicas = layout.get("replicas") or []
+    shards_count = int(layout.get("shardsCount") or max(
+        [1, len(shards)] + [int(r.get("shardsCount") or 0) for r in replicas] + [len(r.get("shards") or []) for r in replicas]
+    ))
+    replicas_count = int(layout.get("replicasCount") or max(
+        [1, len(replicas)] + [int(s.get("replicasCount") or 0) for s in shards] + [len(s.get("replicas") or []) for s in shards]
+    ))
+    counts = []
+    for shard_index in range(shards_count):
+        shard = shards[shard_index] if shard_index < len(shards) else {}
+        counts.append(int(shard.get("replicasCount") or len(shard.get("replicas") or []) or replicas_count))
+    return counts
+
+
+def describe(path, doc):
+    spec = doc.get("spec") or {}
+    clusters = (spec.get("configuration") or {}).get("clusters") or []
+    templates = spec.get("templates") or {}
+    images = []
+    for pod_template in templates.get("podTemplates") or []:
+        for container in ((pod_template.get("spec") or {}).get("containers") or []):
+            if "image" in container:
+                images.append(container["image"])
+    return Manifest(
+        path=path,
+        name=(doc.get("metadata") or {}).get("name"),
+        kind=doc.get("kind"),
+        clusters=[c["name"] for c in clusters],
+        layout={c["name"]: cluster_layout(c) for c in clusters},
+        templates={kind: [t["name"] for t in items or []] for kind, items in templates.items()},
+        use_templates=[t["name"] for t in spec.get("useTemplates") or []],
+        images=images,
+        doc=doc,
+    )
+
+
+def load(path):
+    # [Manifest] for every document of the file
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    with lock:
+        cached = parsed.get(path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    with open(path, "r") as f:
+        manifests = [describe(path, d) for d in yaml.load_all(f, Loader=Loader) if isinstance(d, dict)]
+    with lock:
+        parsed[path] = (version, manifests)
+    return manifests
+
+
+def get(path):
+    # First document of the file
+    return load(path)[0]
+
+
+def index(dirs=None):
+    # {path: [Manifest]} of every YAML file in dirs, files that do not parse are left out and reported in errors
+    manifests = {}
+    for d in dirs or manifest_dirs:
+        for path in sorted(glob.glob(os.path.join(d, "*.yaml")) + glob.glob(os.path.join(d, "*.yml"))):
+            try:
+                manifests[os.path.abspath(path)] = load(path)
+            except yaml.YAMLError as e:
+                with lock:
+                    errors[os.path.abspath(path)] = e
+    return manifests
+
+
+def find(name, kind=None, dirs=None):
+    # Manifests with the given metadata.name, e.g. the files that define a CHIT
+    return [
+        m for manifests in index(dirs).values() for m in manifests
+        if m.name == name and (kind is None or m.kind == kind)
+    ]
+
 
 def get_chi_name(chi_manifest_filename):
-    return yaml.safe_load(open(chi_manifest_filename, "r"))["metadata"]["name"]
+    return get(chi_manifest_filename).name
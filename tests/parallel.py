@@ -0,0 +1,167 @@
+import concurrent.futures
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from testflows.core import Scenario, Given, Then, And, fail, err, null, skip, xfail, xerr, xnull, xok
+from testflows.asserts import error
+
+import kubectl
+import settings
+
+# Runs scenarios of tests/test.py concurrently, every scenario in a separate test.py process
+# with its own namespace. Results are reported back through testflows in the parent process.
+
+# How the parent raises a result type a worker recorded, see record_scenario(), OK needs nothing raised
+raise_result = {
+    "Fail": fail, "Error": err, "Null": null, "Skip": skip,
+    "XFail": xfail, "XError": xerr, "XNull": xnull, "XOK": xok,
+}
+
+
+class SharedExclusiveLock:
+    # Ordinary scenarios hold the lock shared, scenarios that touch cluster-wide state hold it exclusively
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.shared = 0
+        self.exclusive = False
+        self.exclusive_waiting = 0
+
+    def acquire(self, exclusive):
+        with self.condition:
+            if exclusive:
+                self.exclusive_waiting += 1
+                self.condition.wait_for(lambda: not self.exclusive and self.shared == 0)
+                self.exclusive_waiting -= 1
+                self.exclusive = True
+            else:
+                # Do not let a stream of ordinary scenarios starve a waiting exclusive one
+                self.condition.wait_for(lambda: not self.exclusive and self.exclusive_waiting == 0)
+                self.shared += 1
+
+    def release(self, exclusive):
+        with self.condition:
+            if exclusive:
+                self.exclusive = False
+            else:
+                self.shared -= 1
+            self.condition.notify_all()
+
+
+def scenario_id(module, test):
+    for name, value in vars(module).items():
+        if value is test:
+            return name
+    raise KeyError(f"{test} is not defined in {module.__name__}")
+
+
+def scenario_name(test):
+    return getattr(test, "name", getattr(test, "__name__", str(test)))
+
+
+def scenario_namespace(group):
+    return f"{settings.test_namespace}-{group}".replace("_", "-").lower()
+
+
+def record_scenario(test, args=None):
+    # Runs one scenario, a worker also writes its result type and message where the parent reads them back
+    path = os.getenv("PARALLEL_RESULT")
+    result = None
+    try:
+        result = (Scenario(test=test)() if args is None else Scenario(test=test, args=args)()).result
+    except Exception as e:
+        # Results of failed tests are raised as exceptions
+        result = e
+        raise
+    finally:
+        if path and result is not None:
+            with open(path, "w") as f:
+                json.dump({"type": type(result).__name__, "message": getattr(result, "message", None) or str(result)}, f)
+
+
+def run_worker(test_id, ns, extra_env=None, script=None):
+    # Returns (exitcode, output, seconds, result), result is {"type", "message"} of record_scenario(),
+    # None when the worker did not get as far as running the scenario
+    env = dict(os.environ)
+    env.update(extra_env or {})
+    env["TEST_NAMESPACE"] = ns
+    env["SCENARIOS"] = test_id
+    env["PARALLEL"] = "1"
+    env["PARALLEL_WORKER"] = "1"
+    fd, result_path = tempfile.mkstemp(prefix="scenario-", suffix=".json")
+    os.close(fd)
+    env["PARALLEL_RESULT"] = result_path
+    cmd = [sys.executable, script or os.path.join(os.path.dirname(os.path.abspath(__file__)), "test.py")]
+    started = time.time()
+    try:
+        res = subprocess.run(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        try:
+            with open(result_path) as f:
+                result = json.load(f)
+        except ValueError:
+            result = None
+    finally:
+        os.remove(result_path)
+    return res.returncode, res.stdout, time.time() - started, result
+
+
+def report(name, ns, exitcode, output, duration, result):
+    # Reports a worker's scenario with the result type it got in the worker, so xfails of the parent Module
+    # apply the way they would to the scenario run in the parent. Returns the result of the reported scenario
+    with Scenario(name) as scenario:
+        with Given(f"Scenario was run in namespace {ns} in {duration:.0f}s"):
+            print(output)
+        with Then("Scenario process should succeed"):
+            if result is None:
+                assert exitcode == 0, error(f"worker exited with {exitcode} before recording a result")
+            elif result["type"] in raise_result:
+                raise_result[result["type"]](result["message"])
+    return scenario.result
+
+
+def run(module, tests, concurrency=None, exclusive=(), serial_groups=None):
+    # tests: same list format as in test.py, callables or (callable, args) tuples,
+    # the worker process picks the args up from its own copy of the list
+    # exclusive: scenarios that must not run concurrently with anything else
+    # serial_groups: {group: scenarios}, scenarios of a group run one by one in a namespace of their own
+    concurrency = concurrency or settings.parallel
+    serial_groups = serial_groups or {}
+    lock = SharedExclusiveLock()
+    group_locks = {group: threading.Lock() for group in serial_groups}
+    namespaces = set()
+
+    def execute(test):
+        test_id = scenario_id(module, test)
+        group = next((g for g, members in serial_groups.items() if test in members), None)
+        ns = scenario_namespace(group if group is not None else test_id)
+        namespaces.add(ns)
+        is_exclusive = test in exclusive
+        # Take the group lock first so a queued group member does not hold the shared lock while waiting
+        group_lock = group_locks[group] if group is not None else threading.Lock()
+        with group_lock:
+            lock.acquire(is_exclusive)
+            try:
+                return run_worker(test_id, ns) + (ns,)
+            finally:
+                lock.release(is_exclusive)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = {}
+        for t in tests:
+            test = t if callable(t) else t[0]
+            futures[pool.submit(execute, test)] = test
+
+        # Report in completion order
+        for future in concurrent.futures.as_completed(futures):
+            test = futures[future]
+            exitcode, output, duration, result, ns = future.result()
+            report(scenario_name(test), ns, exitcode, output, duration, result)
+
+    with And("Scenario namespaces are deleted"):
+        for ns in sorted(namespaces):
+            kubectl.delete_all_chi(ns)
+            kubectl.delete_ns(ns, ok_to_fail=True)
@@ -0,0 +1,252 @@
+import collections
+import http.client
+import json
+import re
+import threading
+import time
+import urllib.parse
+
+import clickhouse_http
+import exposition
+import settings
+import timeline
+
+# Prometheus HTTP API client: instant and range queries over one long-lived kubectl port-forward
+# (or settings.prometheus_url) and a pool of keep-alive connections, the same transport clickhouse_http uses.
+# Plain GETs reach any other HTTP endpoint of a pod, e.g. the metrics-exporter's /metrics and /chi.
+
+prometheus_port = 9090
+metrics_exporter_port = 8888
+
+# timestamp in seconds, value as float, NaN and +Inf included
+Sample = collections.namedtuple("Sample", "timestamp value")
+# metric: {label: value} with __name__ when the query keeps it, samples: [Sample], a single one for instant vectors
+Series = collections.namedtuple("Series", "metric samples")
+
+
+class PrometheusError(Exception):
+    def __init__(self, error_type, message):
+        super().__init__(f"{error_type}: {message}")
+        self.error_type = error_type
+        self.message = message
+
+
+def decode(body):
+    # [Series] of a /api/v1/query or /api/v1/query_range response, scalars become one series without labels
+    out = json.loads(body)
+    if out.get("status") != "success":
+        raise PrometheusError(out.get("errorType", "unknown"), out.get("error", body[:200]))
+    data = out["data"]
+    result_type, result = data["resultType"], data["result"]
+    if result_type == "vector":
+        return [Series(r["metric"], [Sample(float(r["value"][0]), float(r["value"][1]))]) for r in result]
+    if result_type == "matrix":
+        return [Series(r["metric"], [Sample(float(t), float(v)) for t, v in r["values"]]) for r in result]
+    if result_type == "scalar":
+        return [Series({}, [Sample(float(result[0]), float(result[1]))])]
+    raise PrometheusError("bad_data", f"unsupported result type {result_type}")
+
+
+class Client:
+    def __init__(self, pod, ns, port=prometheus_port, url="", timeout=30):
+        self.pod = pod
+        self.ns = ns
+        self.port = port
+        self.url = url
+        self.timeout = timeout
+        self.endpoint = None
+        self.lock = threading.Lock()
+
+    def get_endpoint(self):
+        with self.lock:
+            # A restarted pod drops its port-forward, start a new one then
+            if self.endpoint is None or not self.endpoint.alive():
+                if self.endpoint is not None:
+                    self.endpoint.stop()
+                if self.url != "":
+                    address = urllib.parse.urlsplit(self.url)
+                    self.endpoint = clickhouse_http.Endpoint(address.hostname, address.port or 80)
+                else:
+                    self.endpoint = clickhouse_http.PortForward(self.pod, self.ns, remote_port=self.port).start()
+            return self.endpoint
+
+    def reset(self):
+        with self.lock:
+            endpoint, self.endpoint = self.endpoint, None
+        if endpoint is not None:
+            endpoint.stop()
+
+    def request(self, method, path, params=None, form=None, data=None):
+        # Returns (status, body), a connection refused by a restarted container is retried once over a new port-forward.
+        # form is sent url-encoded, data as JSON
+        headers = {}
+        body = None
+        if form is not None:
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+            body = urllib.parse.urlencode(form)
+        elif data is not None:
+            headers["Content-Type"] = "application/json"
+            body = json.dumps(data)
+        for attempt in range(2):
+            endpoint = self.get_endpoint()
+            try:
+                conn, response = clickhouse_http.send(endpoint, body, params or {}, headers, self.timeout, path, method)
+                try:
+                    return response.status, response.read().decode(errors="replace")
+                finally:
+                    clickhouse_http.finish(endpoint, conn, response)
+            except (ConnectionError, http.client.HTTPException):
+                self.reset()
+                if attempt == 1:
+                    raise
+
+    def api(self, path, form):
+        status, body = self.request("POST", path, form=form)
+        if status >= 500 and not body.startswith("{"):
+            raise PrometheusError("server_error", f"HTTP {status}: {body[:200]}")
+        return decode(body)
+
+    def query(self, promql, at=None):
+        form = {"query": promql}
+        if at is not None:
+            form["time"] = at
+        with timeline.span("query", f"promql {promql}"[:200], ns=self.ns):
+            return self.api("/api/v1/query", form)
+
+    def query_range(self, promql, start, end, step):
+        form = {"query": promql, "start": start, "end": end, "step": step}
+        with timeline.span("query", f"promql range {promql}"[:200], ns=self.ns):
+            return self.api("/api/v1/query_range", form)
+
+    def get(self, path):
+        # Body of a plain GET, e.g. get("/metrics") from the metrics-exporter
+        with timeline.span("query", f"GET {path}", ns=self.ns) as fields:
+            status, body = self.request("GET", path)
+            fields["bytes"] = len(body)
+        if status != 200:
+            raise PrometheusError("http_error", f"GET {path} returned {status}: {body[:200]}")
+        return body
+
+    def lines(self, path):
+        # Lines of a plain GET as they arrive, bytes, the body is never held as a whole
+        for attempt in range(2):
+            endpoint = self.get_endpoint()
+            try:
+                conn, response = clickhouse_http.send(endpoint, None, {}, {}, self.timeout, path, "GET")
+                break
+            except (ConnectionError, http.client.HTTPException):
+                self.reset()
+                if attempt == 1:
+                    raise
+        try:
+            if response.status != 200:
+                body = response.read(200).decode(errors="replace")
+                raise PrometheusError("http_error", f"GET {path} returned {response.status}: {body}")
+            yield from response
+        finally:
+            clickhouse_http.finish(endpoint, conn, response)
+
+    def scrape(self, path="/metrics"):
+        # exposition.Scrape of an exporter endpoint, parsed while it streams in
+        with timeline.span("query", f"scrape {path}", ns=self.ns) as fields:
+            scrape = exposition.Scrape().feed(self.lines(path))
+            fields["series"] = len(scrape)
+        return scrape
+
+
+# (namespace, pod, port) -> Client
+clients = {}
+clients_lock = threading.Lock()
+
+
+def get_client(pod, ns=None, port=prometheus_port):
+    ns = ns or settings.prometheus_namespace
+    with clients_lock:
+        client = clients.get((ns, pod, port))
+        if client is None:
+            url = settings.prometheus_url if port == prometheus_port else ""
+            client = clients[(ns, pod, port)] = Client(pod, ns, port, url)
+        return client
+
+
+def close_all():
+    with clients_lock:
+        closing = list(clients.values())
+        clients.clear()
+    for client in closing:
+        client.reset()
+
+
+# One alert to wait for: present=False waits until the alert is gone.
+# Series count only with a sample within time_range, timeout counts from the start of the wait.
+AlertExpectation = collections.namedtuple("AlertExpectation", "alertname state labels present time_range timeout")
+# resolved: expectation met before its deadline, at: when it was first seen met, latency: seconds since the start
+AlertOutcome = collections.namedtuple("AlertOutcome", "expectation resolved at latency")
+
+
+def expect_alert(alertname, present=True, labels=None, state="firing", time_range="10s", timeout=100):
+    return AlertExpectation(alertname, state, dict(labels or {}), present, time_range, timeout)
+
+
+def duration_seconds(duration):
+    # Prometheus durations as used in range selectors, "90s", "5m", "1h30m"
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800, "y": 31536000}
+    parts = re.findall(r"(\d+)(ms|s|m|h|d|w|y)", duration)
+    if len(parts) == 0 or "".join(n + u for n, u in parts) != duration:
+        raise ValueError(f"bad duration {duration!r}")
+    return sum(int(n) * units[u] for n, u in parts)
+
+
+class AlertWatcher:
+    # Waits for many alert expectations at once: every tick issues one ALERTS query covering all pending ones
+    # and resolves each of them independently, so alerts expected to fire together are checked together
+    def __init__(self, client, expectations, interval=5, callback=None):
+        self.client = client
+        self.expectations = list(expectations)
+        self.interval = interval
+        self.callback = callback
+        self.queries = 0
+
+    def selector(self, pending):
+        names = sorted({e.alertname for e in pending})
+        states = sorted({e.state for e in pending})
+        longest = max(pending, key=lambda e: duration_seconds(e.time_range)).time_range
+        return 'ALERTS{alertname=~"%s",alertstate=~"%s"}[%s]' % (
+            "|".join(re.escape(n) for n in names), "|".join(states), longest,
+        )
+
+    @staticmethod
+    def met(expectation, series, now):
+        since = now - duration_seconds(expectation.time_range)
+        seen = any(
+            s.metric.get("alertname") == expectation.alertname and
+            s.metric.get("alertstate") == expectation.state and
+            all(s.metric.get(k) == v for k, v in expectation.labels.items()) and
+            any(sample.timestamp >= since for sample in s.samples)
+            for s in series
+        )
+        return seen == expectation.present
+
+    def run(self):
+        # [AlertOutcome] in the order of the expectations
+        started = time.time()
+        outcomes = {}
+        while len(outcomes) < len(self.expectations):
+            pending = [e for i, e in enumerate(self.expectations) if i not in outcomes]
+            if self.callback is not None:
+                self.callback()
+            now = time.time()
+            series = self.client.query(self.selector(pending), at=now)
+            self.queries += 1
+            for i, e in enumerate(self.expectations):
+                if i in outcomes:
+                    continue
+                if self.met(e, series, now):
+                    outcomes[i] = AlertOutcome(e, True, now, now - started)
+                elif now - started >= e.timeout:
+                    outcomes[i] = AlertOutcome(e, False, None, None)
+            if len(outcomes) == len(self.expectations):
+                break
+            deadline = min(started + e.timeout for i, e in enumerate(self.expectations) if i not in outcomes)
+            timeline.sleep(max(0.0, min(self.interval, deadline - time.time())), "alert watcher tick")
+        return [outcomes[i] for i in range(len(self.expectations))]
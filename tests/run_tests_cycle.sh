@@ -1,21 +1,7 @@
 #!/bin/bash
 
-start=`date`
-runs=1
-echo "start run $runs"
-while ./run_tests.sh; do
-  runs=$((runs+1))
-  echo "---------------------"
-  echo "---------------------"
-  echo "---------------------"
-  echo "---------------------"
-  echo "start run $runs"
-done
-end=`date`
+# Runs the suite until the first failure, see cycle.py for run counts, durations and failure rates
+pip3 install -r requirements.txt
 
-echo "====================="
-echo "====================="
-echo "====================="
-echo "successful runs $((runs-1))"
-echo "start $start"
-echo "end   $end"
+export OPERATOR_NAMESPACE=test
+python3 cycle.py --until-failure "$@"
@@ -1,22 +1,48 @@
 import os
-import yaml
-import pathlib
+import threading
+
+# Importing settings does no file I/O: values that come from files are resolved on first access
+# and memoized as module attributes, see __getattr__(). Listing or filtering scenarios and reusing
+# helpers from other tools therefore works without ../release or the CHIT manifests.
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
 
 
 def get_ch_version(test_file):
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    return yaml.safe_load(
-        open(os.path.join(current_dir, test_file), "r")
-    )["spec"]["templates"]["podTemplates"][0]["spec"]["containers"][0]["image"]
+    # manifest pulls in yaml, only pay for it when a version is actually needed
+    import manifest
+    return manifest.get(os.path.join(current_dir, test_file)).images[0]
+
+
+def get_operator_version():
+    with open(os.path.join(current_dir, "..", "release")) as f:
+        return f.read(1024)
 
 
 # kubectl_cmd="minikube kubectl --"
-kubectl_cmd = "kubectl"
-test_namespace = "test"
+# KUBECTL_CMD="python3 tests/kubectl_shim.py" together with fake_kube.py runs the harness without a cluster
+kubectl_cmd = os.getenv('KUBECTL_CMD') if 'KUBECTL_CMD' in os.environ else "kubectl"
+# "api" talks to the API server from kubeconfig over a keep-alive session for read-only calls,
+# "shell" forks kubectl_cmd for every call
+kubectl_backend = os.getenv('KUBECTL_BACKEND') if 'KUBECTL_BACKEND' in os.environ else "api"
+# Serve pods, statefulsets, services, configmaps, PVCs and CHIs from a watch-fed in-process cache
+kubectl_cache = os.getenv('KUBECTL_CACHE', "1") != "0"
+# "exec" runs clickhouse-client in the pod for every query, "http" sends queries to the pod's HTTP port
+# over a kept-alive kubectl port-forward, "http-direct" connects to the per-host service address instead
+clickhouse_transport = os.getenv('CLICKHOUSE_TRANSPORT') if 'CLICKHOUSE_TRANSPORT' in os.environ else "exec"
+test_namespace = os.getenv('TEST_NAMESPACE') if 'TEST_NAMESPACE' in os.environ else "test"
+
+# Directory for per-scenario timelines of kubectl calls, waits, queries and sleeps, empty disables them
+timeline_dir = os.getenv('TIMELINE_DIR') if 'TIMELINE_DIR' in os.environ else ""
+
+# Number of scenarios tests/test.py runs concurrently, each one in its own namespace
+parallel = int(os.getenv('PARALLEL')) if 'PARALLEL' in os.environ else 1
+# Set for test.py processes started by the parallel runner
+parallel_worker = os.getenv('PARALLEL_WORKER') == "1"
+# Comma-separated scenario function names to run, e.g. "test_001,test_013", empty runs all
+scenarios = [s for s in os.getenv('SCENARIOS', "").split(",") if s != ""]
 
-# Default value
-operator_version = os.getenv('OPERATOR_VERSION') if 'OPERATOR_VERSION' in os.environ else \
-    open(os.path.join(pathlib.Path(__file__).parent.absolute(), "../release")).read(1024)
+# operator_version, see lazy
 # operator_version = "0.11.0"
 operator_namespace = os.getenv('OPERATOR_NAMESPACE') if 'OPERATOR_NAMESPACE' in os.environ else \
     'kube-system'
@@ -30,7 +56,34 @@ clickhouse_template = "templates/tpl-clickhouse-stable.yaml"
 # clickhouse_template = "templates/tpl-clickhouse-20.3.yaml"
 # clickhouse_template = "templates/tpl-clickhouse-20.4.yaml"
 
-clickhouse_version = get_ch_version(clickhouse_template)
-
 prometheus_namespace = "prometheus"
 prometheus_operator_version = "0.42"
+# Prometheus HTTP API address for in-cluster runs, e.g. "http://prometheus-operated.prometheus:9090",
+# empty reaches the Prometheus pod over a kubectl port-forward
+prometheus_url = os.getenv('PROMETHEUS_URL') if 'PROMETHEUS_URL' in os.environ else ""
+
+# Settings resolved on first access: name -> function computing the value
+lazy = {
+    "operator_version": lambda: os.getenv('OPERATOR_VERSION') if 'OPERATOR_VERSION' in os.environ else \
+        get_operator_version(),
+    "clickhouse_version": lambda: os.getenv('CLICKHOUSE_VERSION') if 'CLICKHOUSE_VERSION' in os.environ else \
+        get_ch_version(clickhouse_template),
+}
+lock = threading.Lock()
+
+
+def __getattr__(name):
+    # Only called for attributes the module does not have yet, the resolved value is stored as one
+    if name not in lazy:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    with lock:
+        if name not in globals():
+            globals()[name] = lazy[name]()
+    return globals()[name]
+
+
+def reset():
+    # Forgets resolved values, e.g. after clickhouse_template or the environment changed
+    with lock:
+        for name in lazy:
+            globals().pop(name, None)
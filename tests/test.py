@@ -1,18 +1,63 @@
 import kubectl
+import parallel
 import settings
 import test_operator
 import test_clickhouse
+import timeline
 import util
 
-from testflows.core import TestScenario, Name, When, Then, Given, And, main, Scenario, Module, TE, args, Fail, Error
+from testflows.core import TestScenario, Name, When, Then, Given, And, Finally, main, Scenario, Module, TE, args, Fail, Error
 from testflows.asserts import error
 
+# Scenarios in the order they run, cycle.py picks them up from here as well
+operator_tests = [
+    test_operator.test_001,
+    test_operator.test_002,
+    test_operator.test_004,
+    test_operator.test_005,
+    test_operator.test_006,
+    test_operator.test_007,
+    test_operator.test_008,
+    (test_operator.test_009, {"version_from": "0.13.0"}),
+    test_operator.test_010,
+    test_operator.test_011,
+    test_operator.test_011_1,
+    test_operator.test_012,
+    test_operator.test_013,
+    test_operator.test_014,
+    test_operator.test_015,
+    test_operator.test_016,
+    test_operator.test_017,
+    # test_operator.test_018, # Obsolete, covered by test_016
+    test_operator.test_019,
+    test_operator.test_020,
+    test_operator.test_021,
+    test_operator.test_023,
+    test_operator.test_024,
+    test_operator.test_025,
+    test_operator.test_022, # this should go last while failing
+]
+clickhouse_tests = [
+    test_clickhouse.test_ch_001,
+    test_clickhouse.test_ch_002,
+]
+# Known failures of operator scenarios, cycle.py counts them as expected results too
+operator_xfails = {
+     "/main/operator/test_009. Test operator upgrade": [(Fail, "May fail due to label changes")],
+     "/main/operator/test_022. Test that chi with broken image can be deleted": [(Error, "Not supported yet. Timeout")],
+     "/main/operator/test_024. Test annotations for various template types/PV annotations should be populated": [(Fail, "Not supported yet")],
+}
+
 if main():
     with Module("main"):
         with Given(f"Clean namespace {settings.test_namespace}"):
             kubectl.delete_all_chi(settings.test_namespace)
-            kubectl.delete_ns(settings.test_namespace, ok_to_fail=True)
-            kubectl.create_ns(settings.test_namespace)
+            if not settings.parallel_worker:
+                kubectl.delete_ns(settings.test_namespace, ok_to_fail=True)
+                kubectl.create_ns(settings.test_namespace)
+            elif kubectl.get_count("ns", settings.test_namespace, ns=None) == 0:
+                # Namespaces of serialized scenario groups are reused to keep e.g. Zookeeper installed
+                kubectl.create_ns(settings.test_namespace)
 
         with Given(f"clickhouse-operator version {settings.operator_version} is installed"):
             if kubectl.get_count("pod", ns=settings.operator_namespace, label="-l app=clickhouse-operator") == 0:
@@ -36,62 +81,72 @@ if main():
             pass
 
         # python3 tests/test.py --only operator*
-        xfails = {
-             "/main/operator/test_009. Test operator upgrade": [(Fail, "May fail due to label changes")],
-             "/main/operator/test_022. Test that chi with broken image can be deleted": [(Error, "Not supported yet. Timeout")],
-             "/main/operator/test_024. Test annotations for various template types/PV annotations should be populated": [(Fail, "Not supported yet")],
-        }
-        with Module("operator", xfails = xfails):
-            all_tests = [
-                test_operator.test_001,
-                test_operator.test_002,
-                test_operator.test_004,
-                test_operator.test_005,
-                test_operator.test_006,
-                test_operator.test_007,
-                test_operator.test_008,
-                (test_operator.test_009, {"version_from": "0.13.0"}),
+        # Worker processes of the parallel runner record the real result of their scenario and the parent
+        # re-raises it under scenario-level xfails, xfails of nested steps stay with the worker
+        if settings.parallel_worker:
+            xfails = {name: xfail for name, xfail in operator_xfails.items() if name.count("/") > 3}
+        else:
+            xfails = operator_xfails
+
+        # Scenarios that restart or upgrade the operator shared by all namespaces,
+        # or install an auto template that the operator applies to every CHI
+        exclusive = [test_operator.test_008, test_operator.test_009, test_operator.test_023]
+        # Scenarios that depend on (and e.g. restart) Zookeeper run one by one in a shared namespace
+        serial_groups = {
+            "zookeeper": [
                 test_operator.test_010,
-                test_operator.test_011,
-                test_operator.test_011_1,
-                test_operator.test_012,
-                test_operator.test_013,
                 test_operator.test_014,
-                test_operator.test_015,
-                test_operator.test_016,
-                test_operator.test_017,
-                # test_operator.test_018, # Obsolete, covered by test_016
                 test_operator.test_019,
-                test_operator.test_020,
-                test_operator.test_021,
-                test_operator.test_023,
-                test_operator.test_024,
                 test_operator.test_025,
-                test_operator.test_022, # this should go last while failing
-            ]
+                test_clickhouse.test_ch_001,
+            ],
+        }
+
+        with Module("operator", xfails = xfails):
+            all_tests = operator_tests
             run_tests = all_tests
 
             # placeholder for selective test running
             # run_tests = [test_008, (test_009, {"version_from": "0.9.10"})]
             # run_tests = [test_002]
 
-            for t in run_tests:
-                if callable(t):
-                    Scenario(test=t)()
-                else:
-                    Scenario(test=t[0], args=t[1])()
+            if len(settings.scenarios) > 0:
+                run_tests = [t for t in run_tests if parallel.scenario_id(test_operator, t if callable(t) else t[0]) in settings.scenarios]
+
+            if settings.parallel > 1:
+                parallel.run(test_operator, run_tests, exclusive=exclusive, serial_groups=serial_groups)
+            else:
+                for t in run_tests:
+                    cache_stats = kubectl.cache_stats()
+                    with timeline.scenario(parallel.scenario_id(test_operator, t if callable(t) else t[0])):
+                        if callable(t):
+                            parallel.record_scenario(t)
+                        else:
+                            parallel.record_scenario(t[0], t[1])
+                    kubectl.print_cache_stats(cache_stats)
 
         # python3 tests/test.py --only clickhouse*
         with Module("clickhouse"):
-            all_tests = [
-                test_clickhouse.test_ch_001,
-                test_clickhouse.test_ch_002,
-            ]
+            all_tests = clickhouse_tests
 
             run_test = all_tests
 
             # placeholder for selective test running
             # run_test = [test_ch_002]
 
-            for t in run_test:
-                Scenario(test=t)()
+            if len(settings.scenarios) > 0:
+                run_test = [t for t in run_test if parallel.scenario_id(test_clickhouse, t) in settings.scenarios]
+
+            if settings.parallel > 1:
+                parallel.run(test_clickhouse, run_test, exclusive=exclusive, serial_groups=serial_groups)
+            else:
+                for t in run_test:
+                    cache_stats = kubectl.cache_stats()
+                    with timeline.scenario(parallel.scenario_id(test_clickhouse, t)):
+                        parallel.record_scenario(t)
+                    kubectl.print_cache_stats(cache_stats)
+
+        if settings.parallel_worker:
+            # The namespace outlives the worker, the parent deletes it once the whole run is over
+            with Finally(f"Watches of namespace {settings.test_namespace} are stopped"):
+                kubectl.stop_cache(settings.test_namespace)
@@ -0,0 +1,254 @@
+import time
+
+from testflows.core import TestScenario, Name, When, Then, Given, And, main, Scenario, Module, TE, note, metric
+from testflows.asserts import error
+
+import alert_rules
+import util
+
+# deploy/prometheus/prometheus-alert-rules.yaml evaluated offline against synthetic series in simulated time,
+# no Prometheus, ClickHouse or Kubernetes needed: python3 tests/test_alert_rules.py
+
+rules_file = "../deploy/prometheus/prometheus-alert-rules.yaml"
+scrape_interval = 15
+evaluation_interval = 30
+# Simulated seconds, metrics misbehave from trouble_start to trouble_end
+trouble_start = 300
+trouble_end = 600
+simulation_end = 1500
+# Latest an alert may fire after trouble_start, on top of its "for", and resolve after trouble_end:
+# a few evaluation intervals plus the longest range its rules look back over (delta over 5m)
+fire_within = 120
+resolve_within = 420
+
+clickhouse_labels = {"chi": "test-alerts", "namespace": "test", "hostname": "chi-test-alerts-default-0-0"}
+zookeeper_labels = {"app": "zookeeper", "pod": "zookeeper-0"}
+
+
+# Series functions take the simulated time and the trouble window, None when everything is fine
+def gauge(normal, trouble):
+    return lambda t, window: trouble if window is not None and window[0] <= t < window[1] else normal
+
+
+def counter(trouble_rate, normal_rate=0):
+    def value(t, window):
+        overlap = 0 if window is None else max(0, min(t, window[1]) - window[0])
+        return normal_rate * t + (trouble_rate - normal_rate) * overlap
+    return value
+
+
+def restarted(scale=1):
+    # Uptime of a server that restarts when the trouble starts
+    return lambda t, window: (t - window[0]) * scale if window is not None and t >= window[0] else (100000 + t) * scale
+
+
+def clickhouse(metric, function, **labels):
+    return dict(clickhouse_labels, __name__=metric, **labels), function
+
+
+def zookeeper(metric, function, **labels):
+    return dict(zookeeper_labels, __name__=metric, **labels), function
+
+
+# alertname -> series that make it fire between trouble_start and trouble_end
+cases = {
+    "ClickHouseMetricsExporterDown": [({"__name__": "up", "job": "clickhouse-operator-metrics"}, gauge(1, 0))],
+    "ClickHouseServerDown": [clickhouse("chi_clickhouse_metric_fetch_errors", gauge(0, 1))],
+    "ClickHouseServerRestartRecently": [clickhouse("chi_clickhouse_metric_Uptime", restarted())],
+    "ClickHouseDNSErrors": [
+        clickhouse("chi_clickhouse_event_DNSError", counter(1)),
+        clickhouse("chi_clickhouse_event_NetworkErrors", counter(0)),
+    ],
+    "ClickHouseDistributedFilesToInsertHigh": [clickhouse("chi_clickhouse_metric_DistributedFilesToInsert", gauge(0, 100))],
+    "ClickHouseDistributedConnectionExceptions": [
+        clickhouse("chi_clickhouse_event_DistributedConnectionFailTry", counter(1)),
+    ],
+    "ClickHouseRejectedInsert": [clickhouse("chi_clickhouse_event_RejectedInserts", counter(1))],
+    "ClickHouseDelayedInsertThrottling": [clickhouse("chi_clickhouse_event_DelayedInserts", counter(1))],
+    "ClickHouseMaxPartCountForPartition": [clickhouse("chi_clickhouse_metric_MaxPartCountForPartition", gauge(10, 200))],
+    "ClickHouseLowInsertedRowsPerQuery": [
+        clickhouse("chi_clickhouse_event_InsertQuery", counter(1, 1)),
+        clickhouse("chi_clickhouse_event_InsertedRows", counter(1, 10000)),
+    ],
+    "ClickHouseLongestRunningQuery": [clickhouse("chi_clickhouse_metric_LongestRunningQuery", gauge(0, 700))],
+    "ClickHouseQueryPreempted": [clickhouse("chi_clickhouse_metric_QueryPreempted", gauge(0, 1))],
+    "ClickHouseReadonlyReplica": [clickhouse("chi_clickhouse_metric_ReadonlyReplica", gauge(0, 1))],
+    "ClickHouseReplicasMaxAbsoluteDelay": [clickhouse("chi_clickhouse_metric_ReplicasMaxAbsoluteDelay", gauge(0, 400))],
+    "ClickHouseTooManyConnections": [
+        clickhouse("chi_clickhouse_metric_HTTPConnection", gauge(1, 50)),
+        clickhouse("chi_clickhouse_metric_TCPConnection", gauge(1, 50)),
+        clickhouse("chi_clickhouse_metric_MySQLConnection", gauge(0, 10)),
+    ],
+    "ClickHouseTooMuchRunningQueries": [clickhouse("chi_clickhouse_metric_Query", gauge(1, 100))],
+    "ClickHouseSystemSettingsChanged": [clickhouse("chi_clickhouse_metric_ChangedSettingsHash", gauge(1, 2))],
+    "ClickHouseVersionChanged": [clickhouse("chi_clickhouse_metric_VersionInteger", gauge(20008007, 20009001))],
+    "ClickHouseZooKeeperHardwareExceptions": [clickhouse("chi_clickhouse_event_ZooKeeperHardwareExceptions", counter(1))],
+    "ClickHouseZooKeeperSession": [clickhouse("chi_clickhouse_metric_ZooKeeperSession", gauge(1, 2))],
+    "ClickHouseDiskUsage": [
+        clickhouse("chi_clickhouse_metric_DiskDataBytes", gauge(10, 90), disk="default"),
+        clickhouse("chi_clickhouse_metric_DiskFreeBytes", gauge(90, 10), disk="default"),
+    ],
+    "ClickHouseReplicatedPartChecksFailed": [clickhouse("chi_clickhouse_event_ReplicatedPartChecksFailed", counter(1))],
+    "ClickHouseReplicatedPartFailedFetches": [clickhouse("chi_clickhouse_event_ReplicatedPartFailedFetches", counter(1))],
+    "ClickHouseReplicatedDataLoss": [clickhouse("chi_clickhouse_event_ReplicatedDataLoss", counter(1))],
+    "ClickHouseStorageBufferErrorOnFlush": [clickhouse("chi_clickhouse_event_StorageBufferErrorOnFlush", counter(1))],
+    "ClickHouseDataAfterMergeDiffersFromReplica": [
+        clickhouse("chi_clickhouse_event_DataAfterMergeDiffersFromReplica", counter(1)),
+    ],
+    "ClickHouseDistributedSyncInsertionTimeoutExceeded": [
+        clickhouse("chi_clickhouse_event_DistributedSyncInsertionTimeoutExceeded", counter(1)),
+    ],
+    "ClickHouseFileDescriptorBufferReadOrWriteFailed": [
+        clickhouse("chi_clickhouse_event_WriteBufferFromFileDescriptorWriteFailed", counter(1)),
+    ],
+    "ClickHouseSlowRead": [clickhouse("chi_clickhouse_event_SlowRead", counter(1))],
+    "ClickHouseTooMuchMutations": [clickhouse("chi_clickhouse_table_mutations", gauge(0, 200), table="default.test")],
+    "ZookeeperDown": [zookeeper("up", gauge(1, 0))],
+    "ZookeeperRestartRecently": [zookeeper("uptime", restarted(1000))],
+    "ZookeeperHighLatency": [zookeeper("max_latency", gauge(10, 600))],
+    "ZookeeperOutstandingRequests": [zookeeper("outstanding_requests", gauge(0, 20))],
+    "ZookeeperHighFileDescriptors": [
+        zookeeper("open_file_descriptor_count", gauge(100, 900)),
+        zookeeper("max_file_descriptor_count", gauge(1000, 1000)),
+    ],
+    "ZookeeperPendingSyncs": [zookeeper("pending_syncs", gauge(0, 20))],
+    "ZookeeperPendingSessions": [zookeeper("pending_session_queue_size", gauge(0, 20))],
+    "ZookeeperThrottleRequests": [zookeeper("request_throttle_wait_count", counter(1))],
+    "ZookeeperOutstandingTLSHandshakes": [zookeeper("outstanding_tls_handshake", gauge(0, 1))],
+    "ZookeeperConnectionRejected": [zookeeper("connection_rejected", counter(1))],
+    "ZookeeperHighEphemeralNodes": [zookeeper("ephemerals_count", gauge(10, 200))],
+    "ZookeeperUnrecoverableErrors": [zookeeper("unrecoverable_error_count", counter(1))],
+    "ZookeeperLowGetChildrenCacheHitRate": [
+        zookeeper("response_packet_cache_hits", counter(1, 10)),
+        zookeeper("response_packet_cache_misses", counter(10, 1)),
+    ],
+    "ZookeeperEnsembleAuthFailures": [zookeeper("ensemble_auth_fail", counter(1))],
+    "ZookeeperHighFsyncTime": [zookeeper("fsynctime", gauge(10, 600), quantile="0.5")],
+    "ZookeeperLargeRequestsRejected": [zookeeper("large_requests_rejected", counter(1))],
+    "ZookeeperStaleRequestsDropped": [zookeeper("stale_requests_dropped", counter(1))],
+    # Both rules of this name
+    "ZookeeperDigestMismatch": [
+        zookeeper("digest_mismatches_count", counter(1)),
+        zookeeper("sessionless_connections_expired", counter(1)),
+    ],
+    "ZookeeperThreadsDeadlocked": [zookeeper("jvm_threads_deadlocked", gauge(0, 1))],
+    "ZookeeperUnsuccessfulHandshakes": [zookeeper("unsuccessful_handshake", counter(1))],
+}
+
+
+def store_for(series, window):
+    store = alert_rules.SeriesStore()
+    for labels, function in series:
+        store.generate(labels, lambda t: function(t, window), 0, simulation_end, scrape_interval)
+    return store
+
+
+def simulate(rules, store):
+    return alert_rules.simulate(rules, store, 0, simulation_end, evaluation_interval)
+
+
+@TestScenario
+@Name("Every alert rule parses and has a synthetic case")
+def test_rules_covered(self):
+    with When(f"{rules_file} is loaded"):
+        rules = alert_rules.load_rules(util.get_full_path(rules_file))
+
+    with Then("Every alert has a case"):
+        metric("rules", len(rules), "rules")
+        assert len(rules) > 0, error()
+        assert {r.alert for r in rules} == set(cases), error(f"without case: {({r.alert for r in rules} ^ set(cases))}")
+
+
+@TestScenario
+@Name("No alert fires while all metrics are normal")
+def test_quiet(self):
+    rules = alert_rules.load_rules(util.get_full_path(rules_file))
+    with When("All series stay within their normal values"):
+        fired = simulate(rules, store_for([s for series in cases.values() for s in series], None))
+
+    with Then("Nothing fires"):
+        assert fired == [], error(", ".join(sorted({a.rule.alert for a in fired})))
+
+
+@TestScenario
+@Name("Every alert fires when its metrics misbehave and resolves once they recover")
+def test_fire_and_resolve(self):
+    rules = alert_rules.load_rules(util.get_full_path(rules_file))
+    started = time.time()
+    for alertname, series in cases.items():
+        with When(f"{alertname}: metrics misbehave from {trouble_start}s to {trouble_end}s"):
+            fired = simulate(rules, store_for(series, (trouble_start, trouble_end)))
+            note(", ".join(f"firing at {a.firing_at}s, resolved at {a.resolved_at}s" for a in fired))
+
+        with Then(f"{alertname} fires and resolves in time, nothing else fires"):
+            own = [r for r in rules if r.alert == alertname]
+            assert {a.rule.expr for a in fired} == {r.expr for r in own}, error()
+            for alert in fired:
+                assert alert.labels["alertname"] == alertname and alert.labels.get("severity") == alert.rule.labels.get("severity"), error()
+                assert trouble_start <= alert.firing_at <= trouble_start + fire_within + alert.rule.duration, error()
+                assert alert.resolved_at is not None and alert.resolved_at <= trouble_end + resolve_within, error()
+
+    with Then("The whole suite runs in seconds"):
+        duration = time.time() - started
+        note(f"{len(cases)} alerts simulated over {simulation_end}s each")
+        metric("simulation", duration, "s")
+        assert duration < 30, error()
+
+
+@TestScenario
+@Name("Rules see series the way Prometheus does")
+def test_evaluator(self):
+    with When("A counter grows by 1/s and is scraped every 15s"):
+        store = alert_rules.SeriesStore()
+        store.generate({"__name__": "c", "a": "1"}, lambda t: t, 0, 300, 15)
+        evaluator = alert_rules.Evaluator(store)
+
+    with Then("increase() and rate() are extrapolated to the full range"):
+        assert evaluator.evaluate(alert_rules.parse("increase(c[1m])"), 300) == [({"a": "1"}, 60.0)], error()
+        assert evaluator.evaluate(alert_rules.parse("rate(c[1m])"), 300) == [({"a": "1"}, 1.0)], error()
+
+    with And("Counter resets are compensated"):
+        store.add({"__name__": "c", "a": "1"}, 315, 5)
+        (_, increase), = evaluator.evaluate(alert_rules.parse("increase(c[30s])"), 315)
+        assert increase == 20, error()
+
+    with And("Comparisons filter, chained ones narrow the range, instant selectors look back 5m at most"):
+        assert evaluator.evaluate(alert_rules.parse("c > 100 < 200"), 150) == [({"__name__": "c", "a": "1"}, 150.0)], error()
+        assert evaluator.evaluate(alert_rules.parse("c > 100 < 200"), 250) == [], error()
+        assert evaluator.evaluate(alert_rules.parse("c"), 315 + 301) == [], error()
+        assert evaluator.evaluate(alert_rules.parse("1 + 2 * 3 ^ 2"), 0) == 19.0, error()
+
+    with When("Series come from captured exporter scrapes"):
+        rules = [r for r in alert_rules.load_rules(util.get_full_path(rules_file)) if r.alert == "ClickHouseServerDown"]
+        store = alert_rules.SeriesStore()
+        for t in range(0, 600, scrape_interval):
+            errors = 1 if 120 <= t < 240 else 0
+            store.add_scrape(
+                "# HELP chi_clickhouse_metric_fetch_errors metric fetch errors\n"
+                "# TYPE chi_clickhouse_metric_fetch_errors gauge\n"
+                f'chi_clickhouse_metric_fetch_errors{{chi="a",hostname="chi-a-0-0",namespace="test"}} {errors}\n',
+                t,
+            )
+        fired = alert_rules.simulate(rules, store, 0, 600, evaluation_interval)
+
+    with Then("Alerts fire and resolve at the evaluation following the change"):
+        assert [(a.firing_at, a.resolved_at, a.labels["hostname"]) for a in fired] == [(120, 240, "chi-a-0-0")], error()
+
+    with And("Unsupported PromQL is reported, not misread"):
+        try:
+            alert_rules.parse("sum by (chi) (up)")
+            assert False, error()
+        except alert_rules.PromQLError:
+            pass
+
+
+if main():
+    with Module("alert rules", flags=TE):
+        test_cases = [
+            test_rules_covered,
+            test_evaluator,
+            test_quiet,
+            test_fire_and_resolve,
+        ]
+        for t in test_cases:
+            Scenario(test=t, flags=TE)()
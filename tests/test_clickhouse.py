@@ -1,6 +1,7 @@
 from clickhouse import *
 from kubectl import *
 import settings
+import timeline
 from test_operator import require_zookeeper
 
 from testflows.core import TestScenario, Name, When, Then, Given, And, main, Scenario, Module, TE
@@ -45,12 +46,7 @@ def test_ch_001(self):
     create_mv3 = "create materialized view t_mv3 on cluster default to t3 as select a from t1"
 
     with Given("Tables t1, t2, t3 and MVs t1->t2, t1-t3 are created"):
-        query(chi, create_table)
-        query(chi, create_mv_table2)
-        query(chi, create_mv_table3)
-
-        query(chi, create_mv2)
-        query(chi, create_mv3)
+        query_batch(chi, [create_table, create_mv_table2, create_mv_table3, create_mv2, create_mv3])
 
         with When("Add a row to an old partition"):
             query(chi, "insert into t1(a,d) values(6, today()-1)", host=host0)
@@ -59,13 +55,13 @@ def test_ch_001(self):
             query(chi, "system stop fetches default.t1", host=host1)
 
             with Then("Wait 10 seconds and the data should be dropped by TTL"):
-                time.sleep(10)
+                timeline.sleep(10)
                 out = query(chi, "select count() from t1 where a=6", host=host0)
                 assert out == "0"
 
         with When("Resume fetches for t1 at replica1"):
             query(chi, "system start fetches default.t1", host=host1)
-            time.sleep(5)
+            timeline.sleep(5)
 
             with Then("Inserts should resume"):
                 query(chi, "insert into t1(a) values(7)", host=host0)
@@ -85,7 +81,7 @@ def test_ch_001(self):
 
         with When("Resume fetches for t2 at replica1"):
             query(chi, "system start fetches default.t2", host=host1)
-            time.sleep(5)
+            timeline.sleep(5)
 
             with Then("Inserts should fail with an error regarding not satisfied quorum"):
                 out = query_with_error(chi, "insert into t1(a) values(3)", host=host0)
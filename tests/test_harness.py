@@ -0,0 +1,1302 @@
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from testflows.core import TestScenario, Name, When, Then, Given, And, main, Scenario, Module, TE, Fail, Error, note, metric
+from testflows.asserts import error
+
+import alerts
+import chi_hosts
+import cycle
+import clickhouse
+import clickhouse_format
+import clickhouse_http
+import exporter_bench
+import exposition
+import fake_clickhouse
+import fake_kube
+import fake_prometheus
+import kube_api
+import kubectl
+import manifest
+import parallel
+import prometheus_api
+import settings
+import timeline
+import topology
+import util
+
+# Harness self-checks, run against the local stand-in API server: python3 tests/test_harness.py
+
+# tests/test.py in a parallel worker, see test_parallel_results
+WORKER = """import os
+import sys
+
+from testflows.core import TestScenario, Then, main, Module
+
+sys.path.insert(0, {tests_dir!r})
+import parallel
+
+
+@TestScenario
+def test_fails(self):
+    with Then("Known to fail"):
+        assert False, "broken"
+
+
+@TestScenario
+def test_errors(self):
+    raise TimeoutError("Not supported yet")
+
+
+@TestScenario
+def test_passes(self):
+    pass
+
+
+if main():
+    with Module("main"):
+        parallel.record_scenario(globals()[os.environ["SCENARIOS"]])
+"""
+
+
+def chi_objects(chi, ns="test", hosts=1):
+    labels = {"clickhouse.altinity.com/chi": chi, "clickhouse.altinity.com/app": "chop"}
+    hostnames = [f"chi-{chi}-default-{i}-0" for i in range(hosts)]
+    status = {
+        "status": "Completed",
+        "pods": [f"{host}-0" for host in hostnames],
+        "fqdns": [f"{host}.{ns}.svc.cluster.local" for host in hostnames],
+    }
+    objects = [
+        ("chi", {"metadata": {"name": chi, "namespace": ns}, "status": status}),
+        ("service", {"metadata": {"name": f"clickhouse-{chi}", "namespace": ns, "labels": labels}, "spec": {"type": "LoadBalancer"}}),
+    ]
+    for i, host in enumerate(hostnames):
+        host_labels = dict(labels, **{
+            "clickhouse.altinity.com/cluster": "default",
+            "clickhouse.altinity.com/shard": str(i),
+            # Scope indices swapped the way the operator labels pods
+            "clickhouse.altinity.com/shardScopeIndex": "0",
+            "clickhouse.altinity.com/replica": "0",
+            "clickhouse.altinity.com/replicaScopeIndex": str(i),
+        })
+        objects += [
+            ("statefulset", {
+                "metadata": {"name": host, "namespace": ns, "labels": host_labels},
+                "spec": {"replicas": 1},
+                "status": {"readyReplicas": 1},
+            }),
+            ("service", {"metadata": {"name": host, "namespace": ns, "labels": host_labels}, "spec": {"type": "ClusterIP"}}),
+            ("pod", {
+                "metadata": {"name": f"{host}-0", "namespace": ns, "labels": host_labels},
+                "spec": {"containers": [{"image": "yandex/clickhouse-server:20.8", "ports": [{"containerPort": 9000}]}]},
+                "status": {
+                    "phase": "Running",
+                    "conditions": [{"type": "Ready", "status": "True"}],
+                    "containerStatuses": [{"ready": True}],
+                },
+            }),
+        ]
+    return objects
+
+
+def start_fake_kube(with_cache=True):
+    kube = fake_kube.FakeKube().start()
+    kubectl.set_api(kube.api(), with_cache=with_cache)
+    return kube
+
+
+@TestScenario
+@Name("Kubernetes API session reads objects without forking kubectl")
+def test_api_session(self):
+    kube = start_fake_kube(with_cache=False)
+    try:
+        with Given("CHI with 2 hosts is present in the stand-in API server"):
+            for kind, obj in chi_objects("test-api", hosts=2):
+                kube.store.put(kind, obj)
+
+        with Then("Objects are counted by label"):
+            label = "-l clickhouse.altinity.com/chi=test-api"
+            assert kubectl.get_count("sts", label=label) == 2, error()
+            assert kubectl.get_count("pod", label=label) == 2, error()
+            assert kubectl.get_count("service", label=label) == 3, error()
+            assert kubectl.get_count("chi", "test-api") == 1, error()
+            assert kubectl.get_count("chi", "missing") == 0, error()
+
+        with And("Fields are rendered as kubectl custom-columns"):
+            assert kubectl.get_field("chi", "test-api", ".status.status") == "Completed", error()
+            pod = "chi-test-api-default-0-0-0"
+            assert kubectl.get_field("pod", pod, ".status.containerStatuses[0].ready") == "true", error()
+            assert kubectl.get_field("pod", pod, ".metadata.annotations.test") == "<none>", error()
+
+        with And("Pod helpers work on top of the session"):
+            assert kubectl.get_pod_names("test-api") == ["chi-test-api-default-0-0-0", "chi-test-api-default-1-0-0"], error()
+            assert kubectl.get_pod_ports("test-api") == [9000], error()
+            kubectl.check_service("clickhouse-test-api", "LoadBalancer")
+
+        with And("All requests share one keep-alive connection"):
+            assert kube.store.requests > 10, error()
+            assert kube.store.connections == 1, error()
+    finally:
+        kubectl.set_api(None)
+        kube.stop()
+
+
+@TestScenario
+@Name("Objects of several kinds are counted in one batch")
+def test_count_objects(self):
+    kube = start_fake_kube(with_cache=False)
+    try:
+        with Given("CHI with 3 hosts, one of them not ready yet"):
+            for kind, obj in chi_objects("test-count", hosts=3):
+                if obj["metadata"]["name"] == "chi-test-count-default-2-0-0":
+                    obj["status"]["conditions"][0]["status"] = "False"
+                kube.store.put(kind, obj)
+
+        with When("Objects are counted"):
+            requests = kube.store.requests
+            label = "-l clickhouse.altinity.com/chi=test-count"
+            counts = kubectl.count_objects(label=label)
+            states = kubectl.get_object_states(label=label)
+
+        with Then("Counts and readiness are reported per kind"):
+            assert counts == {"statefulset": 3, "pod": 3, "service": 4}, error()
+            assert states["pod"]["chi-test-count-default-0-0-0"] is True, error()
+            assert states["pod"]["chi-test-count-default-2-0-0"] is False, error()
+            assert all(states["statefulset"].values()), error()
+
+        with And("Each call costs one request per kind, issued concurrently"):
+            assert kube.store.requests - requests == 6, error()
+    finally:
+        kubectl.set_api(None)
+        kube.stop()
+
+
+@TestScenario
+@Name("Repeated reads are served from the watch-fed object cache")
+def test_object_cache(self):
+    kube = start_fake_kube()
+    try:
+        with Given("CHI with 2 hosts and its configmaps"):
+            for kind, obj in chi_objects("test-cache", hosts=2):
+                kube.store.put(kind, obj)
+            for name, files in [
+                ("chi-test-cache-common-configd", ["01-clickhouse-listen.xml", "02-clickhouse-logger.xml", "03-clickhouse-querylog.xml"]),
+                ("chi-test-cache-common-usersd", ["01-clickhouse-user.xml", "02-clickhouse-default-profile.xml"]),
+            ]:
+                kube.store.put("configmap", {"metadata": {"name": name, "namespace": "test"}, "data": {f: "" for f in files}})
+
+        with When("Pod and configmap checks run several times"):
+            requests = kube.store.requests
+            stats = kubectl.cache_stats()
+            for i in range(5):
+                kubectl.check_pod_image("test-cache", "yandex/clickhouse-server:20.8")
+                kubectl.check_configmaps("test-cache")
+                assert kubectl.get_pod_names("test-cache") == ["chi-test-cache-default-0-0-0", "chi-test-cache-default-1-0-0"], error()
+
+        with Then("Only the initial lists and watches reach the API server"):
+            assert kube.store.requests - requests <= 4, error()
+            after = kubectl.cache_stats()
+            assert after["misses"] - stats["misses"] == 2, error()
+            assert after["hits"] - stats["hits"] >= 18, error()
+
+        with When("Pod image changes"):
+            pod = kube.store.get("pod", "chi-test-cache-default-0-0-0", "test")
+            pod["spec"]["containers"][0]["image"] = "yandex/clickhouse-server:21.1"
+            kube.store.put("pod", pod)
+
+            with Then("Cache is invalidated by the watch event"):
+                kubectl.wait_field("pod", "chi-test-cache-default-0-0-0", ".spec.containers[0].image", "yandex/clickhouse-server:21.1", timeout=5)
+                kubectl.check_pod_image("test-cache", "yandex/clickhouse-server:21.1")
+
+        with When("Pod is deleted"):
+            kube.store.delete("pod", "chi-test-cache-default-1-0-0", "test")
+
+            with Then("It disappears from label lookups"):
+                label = "-l clickhouse.altinity.com/chi=test-cache"
+                ok, _ = kubectl.cache.wait_for([("pod", "", label)], lambda pods: len(pods) == 1, 5, "test")
+                assert ok, error()
+                assert kubectl.get_pod_names("test-cache") == ["chi-test-cache-default-0-0-0"], error()
+
+        with When("Reflectors of the namespace are stopped"):
+            other = kubectl.cache.reflector("pod", "other")
+            stopped = [r for (_, ns), r in kubectl.cache.reflectors.items() if ns == "test"]
+            kubectl.stop_cache("test")
+
+            with Then("Only those of other namespaces keep watching, the next read lists the namespace again"):
+                assert len(stopped) == 2 and all(r.stopped for r in stopped), error()
+                assert list(kubectl.cache.reflectors.values()) == [other] and not other.stopped, error()
+                assert kubectl.get_pod_names("test-cache") == ["chi-test-cache-default-0-0-0"], error()
+    finally:
+        kubectl.set_api(None)
+        kube.stop()
+
+
+@TestScenario
+@Name("Parallel workers report their real result type and the parent applies its xfails")
+def test_parallel_results(self):
+    worker = os.path.join(tempfile.mkdtemp(), "worker.py")
+    with open(worker, "w") as f:
+        f.write(WORKER.format(tests_dir=os.path.dirname(os.path.abspath(__file__))))
+
+    with When("A failing, an erroring and a passing scenario run in worker processes"):
+        runs = {name: parallel.run_worker(f"test_{name}", "test", script=worker) for name in ("fails", "errors", "passes")}
+
+    with Then("Every worker records the result type its scenario got"):
+        assert {name: run[3]["type"] for name, run in runs.items()} == {"fails": "Fail", "errors": "Error", "passes": "OK"}, error()
+        assert "Not supported yet" in runs["errors"][3]["message"], error()
+
+    with And("The parent re-raises them, under its xfails they come back expected"):
+        xfails = {"fails": [(Fail, "known")], "errors": [(Error, "known")]}
+        with Module("workers", xfails=xfails):
+            results = {name: type(parallel.report(name, "test", *run)).__name__ for name, run in runs.items()}
+        assert results == {"fails": "XFail", "errors": "XError", "passes": "OK"}, error()
+
+
+@TestScenario
+@Name("Waits resolve on watch events instead of polling")
+def test_watch_wait(self):
+    kube = start_fake_kube()
+    try:
+        objects = chi_objects("test-watch", hosts=2)
+
+        def reconcile():
+            for kind, obj in objects:
+                time.sleep(0.05)
+                kube.store.put(kind, obj)
+
+        with When("Objects appear shortly after the wait starts"):
+            started = time.monotonic()
+            threading.Timer(0.5, reconcile).start()
+            kubectl.wait_objects("test-watch", {"statefulset": 2, "pod": 2, "service": 3}, timeout=30)
+            kubectl.wait_chi_status("test-watch", "Completed", timeout=30)
+            kubectl.wait_pod_status("chi-test-watch-default-1-0-0", "Running", timeout=30)
+            kubectl.wait_jsonpath("pod", "chi-test-watch-default-1-0-0", "{.status.containerStatuses[0].ready}", "true", timeout=30)
+            elapsed = time.monotonic() - started
+
+        with Then("Waiting takes as long as the objects take to appear, not a polling interval"):
+            assert elapsed < 5, error()
+
+        with When("Field changes while being watched"):
+            pod = kube.store.get("pod", "chi-test-watch-default-0-0-0", "test")
+            pod["status"]["phase"] = "Pending"
+            kube.store.put("pod", pod)
+            pod["status"]["phase"] = "Running"
+            threading.Timer(0.5, kube.store.put, args=("pod", pod)).start()
+
+            with Then("Wait resolves on the MODIFIED event"):
+                kubectl.wait_pod_status("chi-test-watch-default-0-0-0", "Running", timeout=30)
+
+        with When("Condition is never satisfied"):
+            started = time.monotonic()
+            ok, _ = kube_api.wait_for(kubectl.api, [("pod", "", "-l app=missing")], lambda pods: len(pods) > 0, 1, ns="test")
+
+            with Then("Wait gives up at the deadline"):
+                assert not ok, error()
+                assert time.monotonic() - started < 3, error()
+    finally:
+        kubectl.set_api(None)
+        kube.stop()
+
+
+@TestScenario
+@Name("Reflector resumes from resourceVersion and re-lists when it expires")
+def test_watch_resume(self):
+    kube = start_fake_kube()
+    kube.store.history = 5
+    try:
+        api = kube.api(default_ns="test")
+        reflector = kube_api.Reflector(api, "pod", ns="test", watch_timeout=1).start()
+        try:
+            with When("Pods are added across several watch sessions"):
+                for i in range(3):
+                    kube.store.put("pod", {"metadata": {"name": f"pod-{i}", "namespace": "test"}})
+                    time.sleep(1.5)
+                ok, _ = kube_api.wait_for(api, [("pod", "", "")], lambda pods: len(pods) == 3, 5, ns="test")
+                assert ok, error()
+                assert len(reflector.items()) == 3, error()
+
+            with When("Reflector falls behind the retained history"):
+                reflector.stop()
+                reflector.thread.join()
+                for i in range(3, 20):
+                    kube.store.put("pod", {"metadata": {"name": f"pod-{i}", "namespace": "test"}})
+                reflector.start()
+
+                with Then("It re-lists and catches up"):
+                    deadline = time.monotonic() + 5
+                    while len(reflector.items()) != 20 and time.monotonic() < deadline:
+                        time.sleep(0.1)
+                    assert len(reflector.items()) == 20, error()
+        finally:
+            reflector.stop()
+    finally:
+        kubectl.set_api(None)
+        kube.stop()
+
+
+@TestScenario
+@Name("ClickHouse queries go over pooled HTTP connections")
+def test_clickhouse_http(self):
+    kube = start_fake_kube()
+    transport = settings.clickhouse_transport
+
+    def responder(sql, params, user):
+        if "missing_table" in sql:
+            return 404, "Code: 60. DB::Exception: Table default.missing_table doesn't exist.\n"
+        return 200, "" if sql.startswith("CREATE") else f"{user}\t{sql}\n"
+
+    server = fake_clickhouse.FakeClickHouse(responder).start()
+    try:
+        with Given("CHI with 2 hosts, both reachable over the ClickHouse HTTP stand-in"):
+            for kind, obj in chi_objects("test-http", hosts=2):
+                kube.store.put(kind, obj)
+            settings.clickhouse_transport = "http"
+            for pod in ["chi-test-http-default-0-0-0", "chi-test-http-default-1-0-0"]:
+                clickhouse_http.endpoints[("test", pod)] = clickhouse_http.Endpoint(*server.address)
+
+        with When("Queries run against the CHI"):
+            for i in range(20):
+                assert clickhouse.query("test-http", "select 1") == "default\tselect 1", error()
+
+            with Then("All of them share one keep-alive connection"):
+                assert server.connections == 1, error()
+
+        with When("Query targets a host by its FQDN and passes credentials"):
+            out = clickhouse.query(
+                "test-http", "select \\\"x\\\"",
+                host="chi-test-http-default-1-0.test.svc.cluster.local", user="test_user", pwd="secret",
+            )
+
+            with Then("Shell escaping is undone and the user is sent with the request"):
+                assert out == 'test_user\tselect "x"', error()
+
+        with When("Several statements are sent at once"):
+            out = clickhouse.query("test-http", "CREATE TABLE t (s String) ENGINE = Memory; SELECT 'a;b'")
+
+            with Then("They run one by one in the same session"):
+                assert out == "default\tSELECT 'a;b'", error()
+                sessions = {params.get("session_id") for _, params, _ in server.queries[-2:]}
+                assert len(sessions) == 1 and None not in sessions, error()
+
+        with When("Query fails"):
+            out = clickhouse.query_with_error("test-http", "select * from missing_table")
+
+            with Then("Error is reported the way clickhouse-client prints it"):
+                assert "Received exception from server" in out, error()
+                assert "DB::Exception: Table default.missing_table doesn't exist." in out, error()
+    finally:
+        settings.clickhouse_transport = transport
+        chi_hosts.invalidate()
+        clickhouse_http.close_all()
+        server.stop()
+        kubectl.set_api(None)
+        kube.stop()
+
+
+@TestScenario
+@Name("CHI host topology is resolved once and follows CHI changes")
+def test_chi_hosts(self):
+    kube = start_fake_kube()
+    try:
+        with Given("CHI with 2 shards"):
+            for kind, obj in chi_objects("test-hosts", hosts=2):
+                kube.store.put(kind, obj)
+
+        with When("Hosts are resolved over and over"):
+            hosts = chi_hosts.get("test-hosts")
+            misses = kubectl.cache_stats()["misses"]
+            for i in range(20):
+                assert chi_hosts.get("test-hosts") == hosts, error()
+
+            with Then("Topology comes from pod labels and CHI status, later calls are served from memory"):
+                assert [h.pod for h in hosts] == ["chi-test-hosts-default-0-0-0", "chi-test-hosts-default-1-0-0"], error()
+                assert hosts[1].fqdn == "chi-test-hosts-default-1-0.test.svc.cluster.local", error()
+                assert [h.shard_index for h in hosts] == [0, 1], error()
+                assert [h.replica_index for h in hosts] == [0, 0], error()
+                assert kubectl.cache_stats()["misses"] == misses, error()
+
+        with When("A third shard is added"):
+            for kind, obj in chi_objects("test-hosts", hosts=3):
+                kube.store.put(kind, obj)
+
+            with Then("The entry is rebuilt from the watch events"):
+                ok, _ = kubectl.cache.wait_for(
+                    [("chi", "test-hosts", "")], lambda chis: len(chis[0]["status"]["pods"]) == 3, 5, "test",
+                )
+                assert ok, error()
+                ok, _ = kubectl.cache.wait_for(
+                    [("pod", "", "-l clickhouse.altinity.com/chi=test-hosts")], lambda pods: len(pods) == 3, 5, "test",
+                )
+                assert ok, error()
+                assert [h.shard_index for h in chi_hosts.get("test-hosts")] == [0, 1, 2], error()
+
+        with When("There is no watch-fed cache"):
+            kubectl.set_api(kube.api(), with_cache=False)
+            chi_hosts.invalidate()
+            assert len(chi_hosts.get("test-hosts")) == 3, error()
+            kube.store.delete("pod", "chi-test-hosts-default-2-0-0", "test")
+
+            with Then("Entry is kept until it is invalidated"):
+                assert len(chi_hosts.get("test-hosts")) == 3, error()
+                kubectl.chi_changed("test-hosts", "test")
+                assert len(chi_hosts.get("test-hosts")) == 2, error()
+    finally:
+        chi_hosts.invalidate()
+        kubectl.set_api(None)
+        kube.stop()
+
+
+@TestScenario
+@Name("Statement batches run in one round trip per host")
+def test_query_batch(self):
+    kube = start_fake_kube()
+    transport = settings.clickhouse_transport
+
+    def responder(sql, params, user):
+        if sql.startswith("FAIL"):
+            return 500, "Code: 62. DB::Exception: Syntax error\n"
+        time.sleep(0.2)
+        return 200, f"{params.get('session_id')}\n" if sql.startswith("SELECT") else ""
+
+    server = fake_clickhouse.FakeClickHouse(responder).start()
+    try:
+        with Given("CHI with 3 hosts, reachable over the ClickHouse HTTP stand-in"):
+            for kind, obj in chi_objects("test-batch", hosts=3):
+                kube.store.put(kind, obj)
+            settings.clickhouse_transport = "http"
+            for i in range(3):
+                clickhouse_http.endpoints[("test", f"chi-test-batch-default-{i}-0-0")] = clickhouse_http.Endpoint(*server.address)
+
+        with When("Batch is sent to every host"):
+            started = time.monotonic()
+            results = clickhouse.query_batch_on_hosts("test-batch", ["CREATE TABLE t (a Int8) ENGINE = Memory", "SELECT 1"])
+            elapsed = time.monotonic() - started
+
+            with Then("Hosts are served concurrently, statements in order within one session"):
+                assert sorted(results) == [f"chi-test-batch-default-{i}-0" for i in range(3)], error()
+                for host, host_results in results.items():
+                    assert [r.ok for r in host_results] == [True, True], error()
+                    assert host_results[0].output == "" and host_results[1].output != "None", error()
+                    assert all(r.duration >= 0.2 for r in host_results), error()
+                assert elapsed < 1.2, error()
+
+        with When("A statement fails"):
+            results = clickhouse.query_batch("test-batch", ["SELECT 1", "FAIL", "SELECT 2"], with_error=True)
+
+            with Then("Batch stops there"):
+                assert [r.ok for r in results] == [True, False], error()
+                assert "Syntax error" in results[1].output, error()
+
+        with When("The exec transport script runs against a stand-in clickhouse-client"):
+            statements = ["SELECT 'a'", "SELECT \"b\"", "SELECT fail", "SELECT 'c'"]
+            script = clickhouse.batch_script(statements, "127.0.0.1", "9000", "", "")
+            client = 'clickhouse-client() { q="${@: -1}"; case "$q" in *fail*) echo "Code: 47"; return 47;; *) echo "${q#--query=}";; esac; }'
+            out = subprocess.run(["bash", "-c", client + "\n" + script], stdout=subprocess.PIPE, text=True).stdout
+            results = clickhouse.parse_batch_output(statements, out)
+
+            with Then("Outputs, exit codes and timings are recovered per statement"):
+                assert [r.output for r in results] == ["SELECT 'a'", 'SELECT "b"', "Code: 47"], error()
+                assert [r.ok for r in results] == [True, True, False], error()
+                assert all(r.duration >= 0 for r in results), error()
+    finally:
+        settings.clickhouse_transport = transport
+        chi_hosts.invalidate()
+        clickhouse_http.close_all()
+        server.stop()
+        kubectl.set_api(None)
+        kube.stop()
+
+
+@TestScenario
+@Name("Queries fan out to every CHI host concurrently")
+def test_query_on_hosts(self):
+    kube = start_fake_kube()
+    transport = settings.clickhouse_transport
+    values = {0: "1", 1: "1", 2: "1"}
+
+    def responder(i):
+        def respond(sql, params, user):
+            time.sleep(0.5)
+            return 200, values[i] + "\n"
+        return respond
+
+    servers = [fake_clickhouse.FakeClickHouse(responder(i)).start() for i in range(3)]
+    try:
+        with Given("CHI with 3 hosts, each one with a ClickHouse HTTP stand-in of its own"):
+            for kind, obj in chi_objects("test-fanout", hosts=3):
+                kube.store.put(kind, obj)
+            settings.clickhouse_transport = "http"
+            for i, server in enumerate(servers):
+                clickhouse_http.endpoints[("test", f"chi-test-fanout-default-{i}-0-0")] = clickhouse_http.Endpoint(*server.address)
+
+        with When("Query runs on all hosts"):
+            started = time.monotonic()
+            out = clickhouse.query_on_hosts("test-fanout", "SELECT 1")
+            elapsed = time.monotonic() - started
+
+            with Then("Every host answers within one round trip"):
+                assert out == {f"chi-test-fanout-default-{i}-0": "1" for i in range(3)}, error()
+                assert elapsed < 1.4, error()
+                assert clickhouse.assert_query_on_hosts("test-fanout", "SELECT 1", "1") == "1", error()
+
+        with When("One host disagrees"):
+            values[2] = "0"
+
+            with Then("Same-value check fails"):
+                try:
+                    clickhouse.assert_query_on_hosts("test-fanout", "SELECT 1")
+                except AssertionError:
+                    pass
+                else:
+                    assert False, error()
+    finally:
+        settings.clickhouse_transport = transport
+        chi_hosts.invalidate()
+        clickhouse_http.close_all()
+        for server in servers:
+            server.stop()
+        kubectl.set_api(None)
+        kube.stop()
+
+
+@TestScenario
+@Name("Query results are decoded into typed rows as they are read")
+def test_query_rows(self):
+    kube = start_fake_kube()
+    transport = settings.clickhouse_transport
+
+    def responder(sql, params, user):
+        assert params.get("default_format") == "TSVWithNamesAndTypes", error()
+        if sql.startswith("SELECT number"):
+            null = "\\N"
+            return 200, "number\tsquare\nUInt64\tNullable(UInt64)\n" + "".join(
+                f"{i}\t{i * i if i % 2 == 0 else null}\n" for i in range(100000)
+            )
+        if sql.startswith("SELECT count"):
+            return 200, "count()\nUInt64\n100000000\n"
+        return 200, "s\ta\tt\nString\tArray(String)\tTuple(Date, Float64)\n" \
+            "tab\\there\t['x','it\\\\'s']\t('2020-01-01',nan)\n"
+
+    server = fake_clickhouse.FakeClickHouse(responder).start()
+    kubectl_cmd = kubectl.kubectl_cmd
+    try:
+        with Given("CHI with a ClickHouse HTTP stand-in"):
+            for kind, obj in chi_objects("test-rows"):
+                kube.store.put(kind, obj)
+            settings.clickhouse_transport = "http"
+            clickhouse_http.endpoints[("test", "chi-test-rows-default-0-0-0")] = clickhouse_http.Endpoint(*server.address)
+
+        with When("A large result is iterated"):
+            with clickhouse.query_rows("test-rows", "SELECT number, ...") as rows:
+                assert rows.columns == [("number", "UInt64"), ("square", "Nullable(UInt64)")], error()
+                total = 0
+                nulls = 0
+                for number, square in rows:
+                    total += number
+                    nulls += square is None
+
+            with Then("Values come back typed"):
+                assert total == sum(range(100000)), error()
+                assert nulls == 50000, error()
+
+        with When("Strings, arrays and tuples are decoded"):
+            row = clickhouse.query_rows("test-rows", "SELECT s, a, t").all()[0]
+
+            with Then("Escapes are undone and nested values are typed"):
+                assert row[0] == "tab\there", error()
+                assert row[1] == ["x", "it's"], error()
+                assert str(row[2][0]) == "2020-01-01" and row[2][1] != row[2][1], error()
+
+        with When("Only the first value is needed"):
+            with Then("Scalar comes back as a number"):
+                assert clickhouse.query_value("test-rows", "SELECT count() FROM test_local") == 100000000, error()
+
+        with Then("Fully read responses leave the connection for reuse"):
+            assert server.connections == 1, error()
+
+        with When("clickhouse-client writes more to stderr than a pipe holds"):
+            settings.clickhouse_transport = "exec"
+            client = os.path.join(tempfile.mkdtemp(), "kubectl.py")
+            with open(client, "w") as f:
+                f.write(
+                    "import sys\n"
+                    "if 'SELECT n' not in sys.argv[-1]:\n"
+                    "    sys.exit('Code: 47. DB::Exception: Missing columns')\n"
+                    "sys.stderr.write('warning\\n' * 200000)\n"
+                    "sys.stdout.write('n\\nUInt8\\n1\\n2\\n')\n"
+                )
+            kubectl.kubectl_cmd = f"{sys.executable} {client}"
+
+            with Then("Rows still come back over exec"):
+                assert [n for n, in clickhouse.query_rows("test-rows", "SELECT n", timeout=10)] == [1, 2], error()
+
+            with And("A failed query still fails"):
+                try:
+                    clickhouse.query_rows("test-rows", "SELECT boom", timeout=10).all()
+                    failed = False
+                except AssertionError:
+                    failed = True
+                assert failed, error()
+    finally:
+        kubectl.kubectl_cmd = kubectl_cmd
+        settings.clickhouse_transport = transport
+        chi_hosts.invalidate()
+        clickhouse_http.close_all()
+        server.stop()
+        kubectl.set_api(None)
+        kube.stop()
+
+
+@TestScenario
+@Name("Scenario timeline records API calls, waits, queries and sleeps")
+def test_timeline(self):
+    kube = start_fake_kube()
+    transport = settings.clickhouse_transport
+    timeline_dir = settings.timeline_dir
+    server = fake_clickhouse.FakeClickHouse().start()
+    try:
+        with Given("CHI with a ClickHouse HTTP stand-in and a timeline directory"):
+            for kind, obj in chi_objects("test-timeline"):
+                kube.store.put(kind, obj)
+            settings.clickhouse_transport = "http"
+            clickhouse_http.endpoints[("test", "chi-test-timeline-default-0-0-0")] = clickhouse_http.Endpoint(*server.address)
+            settings.timeline_dir = tempfile.mkdtemp()
+
+        with When("A scenario runs"):
+            with timeline.scenario("test_timeline"):
+                kube_api.wait_for(kubectl.api, [("pod", "", "")], lambda pods: True, 5, ns="test")
+                pod = kube.store.get("pod", "chi-test-timeline-default-0-0-0", "test")
+                pod["status"]["phase"] = "Pending"
+                kube.store.put("pod", pod)
+                for phase in ["Unknown", "Running"]:
+                    pod["status"]["phase"] = phase
+                    threading.Timer(0.3, kube.store.put, args=("pod", dict(pod, status=dict(pod["status"])))).start()
+                    time.sleep(0.1)
+                kubectl.wait_pod_status("chi-test-timeline-default-0-0-0", "Running", timeout=10)
+                clickhouse.query("test-timeline", "SELECT 1")
+                timeline.sleep(0.1, "settle")
+
+        with Then("Timeline and trace are written for the scenario"):
+            with open(os.path.join(settings.timeline_dir, "test_timeline.json")) as f:
+                recorded = json.load(f)
+            with open(os.path.join(settings.timeline_dir, "test_timeline.trace.json")) as f:
+                trace = json.load(f)
+            categories = {e["category"] for e in recorded["events"]}
+            assert {"api", "wait", "query", "sleep"} <= categories, error()
+            waits = [e for e in recorded["events"] if e["category"] == "wait"]
+            assert waits[0]["ns"] == "test" and waits[0]["retries"] >= 1, error()
+            queries = [e for e in recorded["events"] if e["category"] == "query"]
+            assert queries[0]["bytes"] == len("SELECT 1"), error()
+            assert len(trace["traceEvents"]) == len(recorded["events"]), error()
+            assert all(e["ph"] == "X" and e["dur"] >= 0 for e in trace["traceEvents"]), error()
+            assert recorded["summary"]["sleep"]["count"] == 1, error()
+
+        with Then("Nothing is recorded once the scenario is over"):
+            timeline.sleep(0.01, "outside")
+            assert timeline.events == [], error()
+    finally:
+        settings.timeline_dir = timeline_dir
+        settings.clickhouse_transport = transport
+        chi_hosts.invalidate()
+        clickhouse_http.close_all()
+        server.stop()
+        kubectl.set_api(None)
+        kube.stop()
+
+
+@TestScenario
+@Name("Cycle driver keeps per-run results and reports percentiles")
+def test_cycle(self):
+    calls = []
+
+    def runner(scenario, timeline_dir):
+        # test_b fails on the second run, test_022 always ends with the error test.py xfails it with,
+        # waits get slower on every run
+        run = len([c for c in calls if c == scenario]) + 1
+        calls.append(scenario)
+        events = [
+            {"category": "kubectl", "name": "apply", "start": 0.0, "end": 1.0, "duration": 1.0, "step": "create", "thread": 1},
+            {"category": "wait", "name": "wait_field('chi')", "start": 1.0, "end": 1.0 + run, "duration": run, "step": "create", "retries": run, "thread": 1},
+        ]
+        timeline.write(scenario, events, 0.0, 1.0 + run, directory=timeline_dir)
+        if scenario == "test_022":
+            return 1, 10.0 * run, {"type": "Error", "message": "timeout"}
+        if scenario == "test_b" and run == 2:
+            return 1, 10.0 * run, {"type": "Fail", "message": "assertion"}
+        return 0, 10.0 * run, {"type": "OK", "message": ""}
+
+    base = tempfile.mkdtemp()
+    db = cycle.connect(os.path.join(base, "cycle.sqlite"))
+    with When("Three runs of two scenarios are stored"):
+        runs = cycle.run_cycle(db, ["test_a", "test_b"], runs=3, timeline_base=base, runner=runner)
+        assert runs == 3, error()
+
+    with Then("Failure rate and duration percentiles are reported per scenario"):
+        res = cycle.report(db)
+        assert res["scenarios"]["test_a"]["failure_rate"] == 0, error()
+        assert abs(res["scenarios"]["test_b"]["failure_rate"] - 1 / 3) < 1e-9, error()
+        assert res["scenarios"]["test_b"]["p50"] == 20.0 and res["scenarios"]["test_b"]["max"] == 30.0, error()
+
+    with And("Steps and waits get their own percentiles"):
+        assert res["steps"][("test_a", "create")]["max"] == 4.0, error()
+        assert res["waits"][("test_a", "wait_field('chi')")]["p95"] == 3.0, error()
+        cycle.print_report(db)
+
+    with When("Cycle stops at the first failure"):
+        calls.clear()
+        assert cycle.run_cycle(db, ["test_b"], runs=5, until_failure=True, timeline_base=base, runner=runner) == 2, error()
+
+    with And("An xfailed scenario is an expected result and does not stop the cycle"):
+        assert cycle.run_cycle(db, ["test_022"], runs=3, until_failure=True, timeline_base=base, runner=runner) == 3, error()
+        assert cycle.report(db)["scenarios"]["test_022"]["failure_rate"] == 0, error()
+        assert not cycle.expected("test_001", 1, {"type": "Error", "message": "timeout"}), error()
+
+    with And("Only operator scenarios are cycled by default"):
+        assert "test_022" in cycle.scenario_ids() and "test_ch_001" not in cycle.scenario_ids(), error()
+
+
+@TestScenario
+@Name("Scenarios run offline against the simulated operator and the kubectl shim")
+def test_fake_operator(self):
+    kube = fake_kube.FakeKube(reconcile=True, ready_delay=0.05).add_crds().start()
+    kubectl_cmd = kubectl.kubectl_cmd
+    try:
+        with Given("kubectl is pointed to the shim and the shim to the stand-in API server"):
+            config = kube.write_kubeconfig(os.path.join(tempfile.mkdtemp(), "kubeconfig"))
+            shim = os.path.join(os.path.dirname(os.path.abspath(__file__)), "kubectl_shim.py")
+            kubectl.kubectl_cmd = f"KUBECONFIG={config} {sys.executable} {shim}"
+            kubectl.set_api(kube.api())
+            kubectl.create_ns("test")
+
+        with When("A single node CHI is created, checked and deleted"):
+            started = kube.store.requests
+            with timeline.scenario("test_fake_operator"):
+                kubectl.create_and_check(
+                    config="configs/test-001.yaml",
+                    check={"object_counts": {"statefulset": 1, "pod": 1, "service": 2}, "configmaps": 1},
+                )
+                recorded = timeline.summary(timeline.events)
+            metric("API requests", kube.store.requests - started, "requests")
+
+        with Then("CHI went through the whole lifecycle in the stand-in"):
+            assert kube.reconciler.reconciles == 1, error()
+            assert kube.store.list("pod", "test") == [], error()
+
+        with When("A CHI with a custom layout is created"):
+            kubectl.create_and_check(
+                config="configs/test-003-complex-layout.yaml",
+                check={"object_counts": "auto", "do_not_delete": 1},
+            )
+
+        with Then("Hosts are named and labelled after the layout"):
+            pods = kubectl.get_pod_names("test-002-complex-layout")
+            assert len(pods) == 4, error()
+            assert "chi-test-002-complex-layout-clickhouse-replica1-1-0" in pods, error()
+            hosts = chi_hosts.get("test-002-complex-layout", "test")
+            assert sorted((h.shard, h.replica) for h in hosts) == [("shard0", "0"), ("shard0", "1"), ("shard1", "0"), ("shard1", "1")], error()
+            assert all((h.shard, h.replica) == (f"shard{h.shard_index}", str(h.replica_index)) for h in hosts), error()
+
+        with And("The shim renders objects the way kubectl does"):
+            out = kubectl.launch("get pods -o=custom-columns=name:.metadata.name,phase:.status.phase -l clickhouse.altinity.com/cluster=clickhouse")
+            assert out.splitlines()[0].split() == ["name", "phase"] and len(out.splitlines()) == 5, error()
+            assert all(line.split()[1] == "Running" for line in out.splitlines()[1:]), error()
+            out = kubectl.launch("get chi test-002-complex-layout -o jsonpath=\"{.status.status}\"")
+            assert out == "Completed", error()
+            out = kubectl.launch("get pod missing", ok_to_fail=True)
+            assert "NotFound" in out, error()
+
+        with When("Templates are applied and the CHI uses them"):
+            kubectl.delete_chi("test-002-complex-layout")
+            kubectl.create_and_check(
+                config="configs/test-002-tpl.yaml",
+                check={
+                    "pod_count": 1,
+                    "apply_templates": {
+                        settings.clickhouse_template,
+                        "templates/tpl-log-volume.yaml",
+                        "templates/tpl-one-per-host.yaml",
+                    },
+                    "pod_image": settings.clickhouse_version,
+                    "pod_volumes": {"/var/log/clickhouse-server"},
+                    "pod_podAntiAffinity": 1,
+                },
+            )
+
+        with Then("Waits resolve on watch events, not on polling"):
+            assert recorded.get("sleep", {"count": 0})["count"] == 0, error()
+            assert recorded["wait"]["seconds"] < 5, error()
+    finally:
+        kubectl.kubectl_cmd = kubectl_cmd
+        chi_hosts.invalidate()
+        kubectl.set_api(None)
+        kube.stop()
+
+
+@TestScenario
+@Name("Unchanged CHITs are not re-applied")
+def test_template_registry(self):
+    kube = fake_kube.FakeKube().start()
+    kubectl_cmd = kubectl.kubectl_cmd
+    try:
+        with Given("kubectl is pointed to the shim and a template is copied to a scratch file"):
+            config = kube.write_kubeconfig(os.path.join(tempfile.mkdtemp(), "kubeconfig"))
+            shim = os.path.join(os.path.dirname(os.path.abspath(__file__)), "kubectl_shim.py")
+            kubectl.kubectl_cmd = f"KUBECONFIG={config} {sys.executable} {shim}"
+            kubectl.set_api(kube.api())
+            template = os.path.join(tempfile.mkdtemp(), "tpl.yaml")
+            with open(util.get_full_path(settings.clickhouse_template)) as src, open(template, "w") as dst:
+                dst.write(src.read())
+
+        with timeline.scenario("test_template_registry"):
+            def applies():
+                return len([e for e in timeline.take() if e["category"] == "kubectl" and e["name"].startswith("apply")])
+
+            with When("Templates are applied for the first time"):
+                timeline.take()
+                kubectl.apply_templates([template, "templates/tpl-log-volume.yaml"], "test")
+                assert applies() == 2, error()
+                assert kube.store.get("chit", "clickhouse-version", "test") is not None, error()
+
+            with Then("Applying them again only reads the cluster state"):
+                kubectl.apply_templates([template, "templates/tpl-log-volume.yaml"], "test")
+                assert applies() == 0, error()
+
+            with When("A template changes"):
+                with open(template) as f:
+                    content = f.read()
+                with open(template, "w") as f:
+                    f.write(content.replace(settings.clickhouse_version, "yandex/clickhouse-server:21.1"))
+                kubectl.apply_templates([template, "templates/tpl-log-volume.yaml"], "test")
+
+            with Then("Only the changed one is applied and the new version is served"):
+                assert applies() == 1, error()
+                chit = kubectl.get_template("clickhouse-version", "test")
+                assert "21.1" in json.dumps(chit["spec"]), error()
+
+            with When("The template is deleted behind the harness' back"):
+                kube.store.delete("chit", "clickhouse-version", "test")
+                kubectl.wait_until([("chit", "", "")], lambda objects: len(objects), lambda n: n == 1, "test", 10)
+                kubectl.apply_templates([template], "test")
+
+            with Then("It is applied again"):
+                assert applies() == 1, error()
+
+            with When("The watch cache is off and a template changes"):
+                kubectl.set_api(kube.api(), with_cache=False)
+                with open(template, "w") as f:
+                    f.write(content.replace(settings.clickhouse_version, "yandex/clickhouse-server:21.2"))
+                kubectl.apply_templates([template], "test")
+
+            with Then("The CHIT is polled until the applied resourceVersion is served"):
+                assert applies() == 1, error()
+                assert "21.2" in json.dumps(kubectl.get_template("clickhouse-version", "test")["spec"]), error()
+                try:
+                    kubectl.wait_template("clickhouse-version", "0", "test", timeout=1)
+                    assert False, error("a resourceVersion that is never served should time out")
+                except Fail:
+                    pass
+    finally:
+        kubectl.kubectl_cmd = kubectl_cmd
+        kubectl.set_api(None)
+        kube.stop()
+
+
+@TestScenario
+@Name("Manifests are parsed once and re-parsed when they change")
+def test_manifest_index(self):
+    with When("Manifest directories are indexed"):
+        started = time.time()
+        manifests = manifest.index()
+        note(f"{len(manifests)} files indexed, {len(manifest.errors)} did not parse")
+        metric("manifest indexing", time.time() - started, "s")
+        assert len(manifests) > 100, error()
+
+    with Then("Facts of a manifest come from the index"):
+        complex_layout = manifest.get(util.get_full_path("configs/test-003-complex-layout.yaml"))
+        assert complex_layout is manifests[util.get_full_path("configs/test-003-complex-layout.yaml")][0], error()
+        assert complex_layout.layout == {"clickhouse": [2, 2]}, error()
+        assert complex_layout.use_templates == ["clickhouse-version"], error()
+        assert manifest.get_chi_name(complex_layout.path) == "test-002-complex-layout", error()
+        assert settings.clickhouse_version in manifest.get(util.get_full_path(settings.clickhouse_template)).images, error()
+        assert len(manifest.find("clickhouse-version", kind="ClickHouseInstallationTemplate")) > 1, error()
+
+    with When("A manifest changes"):
+        path = os.path.join(tempfile.mkdtemp(), "chi.yaml")
+        with open(path, "w") as f:
+            f.write("kind: ClickHouseInstallation\nmetadata:\n  name: a\n")
+        first = manifest.get(path)
+        with open(path, "w") as f:
+            f.write("kind: ClickHouseInstallation\nmetadata:\n  name: bb\n")
+
+    with Then("It is parsed again"):
+        assert first.name == "a" and manifest.get_chi_name(path) == "bb", error()
+
+
+@TestScenario
+@Name("Expected objects are computed from CHI manifests")
+def test_topology(self):
+    with When("A CHI with service templates is expanded"):
+        expected = topology.from_manifest(util.get_full_path("configs/test-012-service-template.yaml"))
+
+    with Then("Services follow the templates the way test_012 expects"):
+        assert topology.object_counts(expected) == {"statefulset": 2, "pod": 2, "service": 4}, error()
+        assert expected.services == ["service-test-012", "service-default", "service-test-012-0-0", "service-test-012-1-0"], error()
+        assert expected.statefulsets == ["chi-test-012-default-0-0", "chi-test-012-default-1-0"], error()
+
+    with And("Templates come from the CHITs the CHI uses"):
+        chit = {
+            "kind": "ClickHouseInstallationTemplate",
+            "metadata": {"name": "pod-names"},
+            "spec": {"templates": {
+                "podTemplates": [{"name": "default", "generateName": "pod-{chi}-{shardIndex}-{replicaIndex}"}],
+                "volumeClaimTemplates": [{"name": "data"}],
+            }, "defaults": {"templates": {"podTemplate": "default", "dataVolumeClaimTemplate": "data"}}},
+        }
+        chi = {"metadata": {"name": "a"}, "spec": {
+            "useTemplates": [{"name": "pod-names"}],
+            "configuration": {"clusters": [{"name": "c", "layout": {"shardsCount": 2, "replicasCount": 2}}]},
+        }}
+        expected = topology.expand(chi, [chit])
+        assert expected.pods == ["pod-a-0-0-0", "pod-a-0-1-0", "pod-a-1-0-0", "pod-a-1-1-0"], error()
+        assert expected.pvcs[0] == "data-pod-a-0-0-0" and len(expected.pvcs) == 4, error()
+        assert len(topology.expand(chi).pvcs) == 0, error()
+
+    with And("Pod templates name statefulsets, mounts without a volumeClaimTemplate get no PVC"):
+        expected = topology.from_manifest(util.get_full_path("../docs/chi-examples/19-pod-generate-name.yaml"))
+        assert expected.statefulsets == ["chi-pod-generate-name-shard1-repl1-0-0"], error()
+        assert expected.pvcs == [], error()
+
+    with When("A CHI of thousands of hosts is expanded"):
+        chi = {"metadata": {"name": "big"}, "spec": {"configuration": {"clusters": [
+            {"name": "c", "layout": {"shardsCount": 500, "replicasCount": 4}},
+            {"name": "d", "layout": {"replicas": [{"name": "r"}], "shardsCount": 1000}},
+        ]}}}
+        started = time.time()
+        expected = topology.expand(chi)
+        duration = time.time() - started
+        metric(f"{len(expected.hosts)} hosts expansion", duration, "s")
+
+    with Then("It takes a fraction of a second"):
+        assert len(expected.hosts) == 3000 and len(expected.services) == 3001, error()
+        assert expected.statefulsets[-1] == "chi-big-d-999-r", error()
+        assert duration < 1, error()
+
+
+@TestScenario
+@Name("Importing settings does no I/O, file-sourced values resolve on first access")
+def test_settings_import(self):
+    with Given("settings.py alone in a directory without ../release and CHIT manifests"):
+        directory = os.path.join(tempfile.mkdtemp(), "tests")
+        os.mkdir(directory)
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "settings.py")) as src, \
+                open(os.path.join(directory, "settings.py"), "w") as dst:
+            dst.write(src.read())
+
+    def run(code, **env):
+        return subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code], cwd=directory, env=dict(os.environ, **env),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+        )
+
+    with When("It is imported"):
+        res = run("import settings; print(settings.test_namespace)")
+
+    with Then("Import succeeds and only pulls in the standard library"):
+        assert res.returncode == 0 and res.stdout.strip() == settings.test_namespace, error()
+        # -X importtime lines: "import time: self [us] | cumulative | imported package"
+        profile = {
+            line.split("|")[2].strip(): int(line.split("|")[1])
+            for line in res.stderr.splitlines() if line.startswith("import time:") and "cumulative" not in line
+        }
+        metric("settings import", profile["settings"] / 1000, "ms")
+        assert "settings" in profile and "yaml" not in profile and "manifest" not in profile, error()
+
+    with And("File-sourced values fail only when accessed"):
+        res = run("import settings; settings.operator_version")
+        assert res.returncode != 0 and "FileNotFoundError" in res.stderr, error()
+        res = run("import settings; print(settings.operator_version)", OPERATOR_VERSION="0.99.0")
+        assert res.returncode == 0 and res.stdout.strip() == "0.99.0", error()
+
+    with When("clickhouse_version is resolved in the harness"):
+        settings.reset()
+        assert "clickhouse_version" not in vars(settings), error()
+        version = settings.clickhouse_version
+
+    with Then("It comes from the template and is memoized"):
+        assert version in manifest.get(util.get_full_path(settings.clickhouse_template)).images, error()
+        assert vars(settings)["clickhouse_version"] == version, error()
+
+
+@TestScenario
+@Name("Prometheus API queries go over one keep-alive connection")
+def test_prometheus_api(self):
+    alert = {"__name__": "ALERTS", "alertname": "ClickHouseServerDown", "alertstate": "firing", "hostname": "chi-a-0-0"}
+    prometheus = fake_prometheus.FakePrometheus(
+        series=[(alert, 1), ({"__name__": "up", "job": "exporter"}, 0)],
+        pages={"/metrics": "chi_clickhouse_metric_fetch_errors 0\n"},
+    ).start()
+    prometheus_url = settings.prometheus_url
+    try:
+        with Given("Alert checks talk to the Prometheus stand-in"):
+            settings.prometheus_url = prometheus.url
+            prometheus_api.close_all()
+            client = prometheus_api.get_client("prometheus-0")
+
+        with When("Alert state is checked repeatedly"):
+            started = time.time()
+            for _ in range(20):
+                assert alerts.check_alert_state(client, "ClickHouseServerDown", labels={"hostname": "chi-a-0-0"}), error()
+            per_check = (time.time() - started) / 20
+            metric("alert check", per_check * 1000, "ms")
+            assert not alerts.check_alert_state(client, "ClickHouseServerDown", labels={"hostname": "chi-a-1-0"}), error()
+
+        with Then("Every check is one HTTP request on the same connection"):
+            assert prometheus.connections == 1 and len(prometheus.queries) == 21, error()
+            assert prometheus.queries[0] == 'ALERTS{hostname="chi-a-0-0",alertname="ClickHouseServerDown",alertstate="firing"}[10s]', error()
+            assert per_check < 0.05, error()
+
+        with And("Responses decode into typed series"):
+            up = client.query("up", at=1000)
+            assert up == [prometheus_api.Series({"__name__": "up", "job": "exporter"}, [prometheus_api.Sample(1000.0, 0.0)])], error()
+            assert client.query_range("up", 0, 60, 15)[0].metric["job"] == "exporter", error()
+            scalar = prometheus_api.decode('{"status": "success", "data": {"resultType": "scalar", "result": [1, "+Inf"]}}')
+            assert scalar[0].samples[0].value == float("inf"), error()
+            try:
+                client.query("sum(rate(up[5m]))")
+                assert False, error()
+            except prometheus_api.PrometheusError as e:
+                assert e.error_type == "bad_data", error()
+
+        with And("Plain GETs reach other endpoints over the same pool"):
+            exporter = prometheus_api.Client("exporter-0", "kube-system", prometheus_api.metrics_exporter_port, url=prometheus.url)
+            assert exporter.get("/metrics").startswith("chi_clickhouse_metric_fetch_errors"), error()
+    finally:
+        settings.prometheus_url = prometheus_url
+        prometheus_api.close_all()
+        prometheus.stop()
+
+
+@TestScenario
+@Name("Exposition parser indexes a multi-megabyte scrape while it streams in")
+def test_exposition(self):
+    def table_metrics(tables, parts=lambda i: i):
+        lines = [
+            "# HELP chi_clickhouse_table_parts Number of active parts of the table",
+            "# TYPE chi_clickhouse_table_parts gauge",
+        ]
+        for i in range(tables):
+            lines.append(
+                f'chi_clickhouse_table_parts{{table="table_{i}",database="db{i % 50}",'
+                f'hostname="chi-a-default-{i % 4}-0.test.svc.cluster.local",chi="a",namespace="test"}} {parts(i)}'
+            )
+        return "\n".join(lines) + "\n"
+
+    with Given("A /metrics body of 40000 table series"):
+        body = table_metrics(40000)
+        prometheus = fake_prometheus.FakePrometheus(pages={"/metrics": body}).start()
+        client = prometheus_api.Client("exporter-0", "kube-system", prometheus_api.metrics_exporter_port, url=prometheus.url)
+    try:
+        with When("It is scraped"):
+            started = time.time()
+            scrape = client.scrape("/metrics")
+            elapsed = time.time() - started
+            note(f"{len(body) / 1e6:.1f}MB, {len(scrape)} series")
+            metric("scrape", elapsed, "s")
+
+        with Then("Every series is indexed by name and label set, whatever the label order"):
+            assert len(scrape) == 40000 and scrape.samples == 40000 and elapsed < 1, error()
+            labels = {"chi": "a", "namespace": "test", "database": "db7", "table": "table_7",
+                      "hostname": "chi-a-default-3-0.test.svc.cluster.local"}
+            assert scrape.get("chi_clickhouse_table_parts", labels) == 7, error()
+            assert scrape.types["chi_clickhouse_table_parts"] == "gauge", error()
+            assert len(scrape.select("chi_clickhouse_table_parts", {"database": "db7"})) == 800, error()
+
+        with And("Typed assertions report what is not met"):
+            hostname = re.compile(r"chi-a-default-0-0\b")
+            met = [
+                exposition.expect("chi_clickhouse_table_parts", {"hostname": hostname}, type="gauge", min=0),
+                exposition.expect("chi_clickhouse_table_parts", {"chi": "b"}, present=False),
+            ]
+            assert scrape.failures(met) == [], error()
+            unmet = [
+                exposition.expect("chi_clickhouse_table_parts", {"table": "table_1"}, max=0),
+                exposition.expect("chi_clickhouse_table_parts", type="counter"),
+                exposition.expect("chi_clickhouse_metric_VersionInteger"),
+                exposition.expect("chi_clickhouse_table_parts", {"chi": "a"}, present=False),
+            ]
+            assert len(scrape.failures(unmet)) == 4, error()
+
+        with And("Two scrapes diff series by series"):
+            after = exposition.Scrape.from_text(table_metrics(40001, parts=lambda i: i + (i == 5)))
+            after.feed(["chi_clickhouse_metric_fetch_errors NaN 1700000000000"])
+            changes = exposition.diff(scrape, after)
+            assert [name for name, _ in changes.added] == ["chi_clickhouse_metric_fetch_errors", "chi_clickhouse_table_parts"], error()
+            assert changes.removed == [] and [(old, new) for _, _, old, new in changes.changed] == [(5, 6)], error()
+
+        with And("Escaped label values and special values parse"):
+            sample = next(exposition.parse(['m{b="x\\"y",a="1\\\\2\\n"} +Inf 12']))
+            assert sample.labels == (("a", "1\\2\n"), ("b", 'x"y')) and sample.value == float("inf"), error()
+            assert sample.timestamp == 12, error()
+            try:
+                list(exposition.parse(["m{a=1} 2"]))
+                assert False, error()
+            except exposition.ExpositionError:
+                pass
+    finally:
+        client.reset()
+        prometheus.stop()
+
+
+def note_step(step):
+    note(exporter_bench.format_step(step).strip())
+    metric(f"{step.hosts} hosts scrape median", step.scrape_median, "s")
+
+
+@TestScenario
+@Name("Exporter benchmark serves every exporter query and measures a scrape")
+def test_exporter_bench(self):
+    s = exporter_bench.shape(metrics=10, tables=3, replicas=2, mutations=1, disks=1)
+    with Given("The stand-in answers the five exporter queries with well-formed results"):
+        server = fake_clickhouse.FakeClickHouse(exporter_bench.responder(s), record=False).start()
+        endpoint = clickhouse_http.Endpoint(*server.address)
+        try:
+            conn, response = clickhouse_http.send(endpoint, None, {}, {}, 5, "/ping", "GET")
+            assert response.read() == b"Ok.\n", error()
+            clickhouse_http.finish(endpoint, conn, response)
+            columns = {"metrics": 4, "table_sizes": 8, "replicas": 3, "mutations": 4, "disks": 3, "combined": 9}
+            for kind, body in exporter_bench.bodies(s).items():
+                rows = clickhouse_format.Rows(body.splitlines(keepends=True)).all()
+                assert all(len(row) == columns[kind] for row in rows), error()
+            status, body = clickhouse_http.request(endpoint, "SELECT name FROM system.disks", {}, {}, 5)
+            assert status == 200 and body.startswith("name\t"), error()
+            assert clickhouse_http.request(endpoint, "SELECT 1", {}, {}, 5)[0] == 400, error()
+        finally:
+            endpoint.stop()
+            server.stop()
+
+    if shutil.which("go") is None:
+        with Then("go is not installed, the exporter run is skipped"):
+            return
+
+    with When("The exporter built from the tree scrapes two hosts"):
+        steps = exporter_bench.run([1, 2], s, scrapes=1)
+        for step in steps:
+            note_step(step)
+
+    with Then("Every host reports every series"):
+        assert [step.series for step in steps] == [step.expected for step in steps], error()
+        assert steps[1].expected == 2 * exporter_bench.expected_series(s) == 72, error()
+        assert all(step.fetch_errors == 0 and step.rss_kb > 0 and step.staleness is None for step in steps), error()
+
+    with And("Collecting in background, scrapes serve snapshots with their staleness"):
+        slow = s._replace(latency=0.1)
+        steps = exporter_bench.run([2], slow, scrapes=1, collect_interval=1)
+        note_step(steps[0])
+        assert steps[0].series == steps[0].expected == 2 * (exporter_bench.expected_series(s) + 1), error()
+        # Five queries of 0.1s each would hold up a scrape that queried the hosts
+        assert steps[0].staleness < 5 and steps[0].scrape_max < 0.3, error()
+
+    with And("A host that never answers costs one host timeout, then is backed off and still reported failed"):
+        stuck = s._replace(unresponsive=1)
+        steps = exporter_bench.run([3], stuck, scrapes=2, host_timeout=1, workers=2)
+        note_step(steps[0])
+        assert steps[0].series == steps[0].expected == 2 * exporter_bench.expected_series(s) + 1, error()
+        assert steps[0].fetch_errors == 1 and steps[0].scrape_max < 0.5, error()
+
+    with And("Fetching each host with one combined query reports the same series as five queries"):
+        separate, combined = [exporter_bench.run([2], s, scrapes=2, combined=c)[0] for c in (False, True)]
+        for step in (separate, combined):
+            note_step(step)
+        assert combined.series == separate.series == combined.expected and combined.fetch_errors == 0, error()
+        # Per host and scrape, one query instead of five
+        assert combined.queries == 2 * 2 and separate.queries == 2 * 2 * 5, error()
+
+    with And("A host that answers the combined query with an SQL error is not backed off"):
+        broken = s._replace(broken=("combined",))
+        steps = exporter_bench.run([2], broken, scrapes=2, combined=True)
+        note_step(steps[0])
+        assert steps[0].fetch_errors == 2 and steps[0].queries == 2 * 2, error()
+
+
+@TestScenario
+@Name("Alert watcher resolves many alert expectations from one query per tick")
+def test_alert_watcher(self):
+    def alert(name, hostname="chi-a-0-0"):
+        return {"__name__": "ALERTS", "alertname": name, "alertstate": "firing", "hostname": hostname}
+
+    prometheus = fake_prometheus.FakePrometheus(series=[(alert("ClickHouseServerDown"), 1)]).start()
+    client = prometheus_api.Client("prometheus-0", "prometheus", url=prometheus.url)
+    try:
+        with Given("Alerts start firing at different times"):
+            def fire():
+                time.sleep(0.2)
+                prometheus.set_series([(alert("ClickHouseServerDown"), 1), (alert("ClickHouseDNSErrors"), 1)])
+                time.sleep(0.2)
+                prometheus.set_series([(alert("ClickHouseDNSErrors"), 1), (alert("ClickHouseRejectedInsert", "chi-a-1-0"), 1)])
+            threading.Thread(target=fire, daemon=True).start()
+
+        with When("The watcher waits for all of them"):
+            expectations = [
+                prometheus_api.expect_alert("ClickHouseServerDown", labels={"hostname": "chi-a-0-0"}, timeout=2),
+                prometheus_api.expect_alert("ClickHouseDNSErrors", timeout=2),
+                prometheus_api.expect_alert("ClickHouseRejectedInsert", labels={"hostname": "chi-a-1-0"}, time_range="1m", timeout=2),
+                prometheus_api.expect_alert("ClickHouseServerDown", present=False, timeout=2),
+                prometheus_api.expect_alert("ClickHouseTooManyConnections", timeout=0.3),
+            ]
+            watcher = prometheus_api.AlertWatcher(client, expectations, interval=0.05)
+            started = time.time()
+            outcomes = watcher.run()
+            duration = time.time() - started
+
+        with Then("Every expectation resolves on its own with its latency"):
+            note(", ".join(f"{o.expectation.alertname} {o.latency}" for o in outcomes))
+            assert [o.resolved for o in outcomes] == [True, True, True, True, False], error()
+            assert outcomes[0].latency < 0.1 <= outcomes[1].latency < outcomes[2].latency, error()
+            assert outcomes[3].latency >= 0.4, error()
+
+        with And("One query per tick covers all pending expectations"):
+            assert watcher.queries == len(prometheus.queries) and duration < 1.5, error()
+            assert prometheus.queries[0] == 'ALERTS{alertname=~"ClickHouseDNSErrors|ClickHouseRejectedInsert|' \
+                'ClickHouseServerDown|ClickHouseTooManyConnections",alertstate=~"firing"}[1m]', error()
+            assert prometheus_api.duration_seconds("1h30m") == 5400, error()
+    finally:
+        client.reset()
+        prometheus.stop()
+
+
+if main():
+    with Module("harness", flags=TE):
+        test_cases = [
+            test_api_session,
+            test_count_objects,
+            test_object_cache,
+            test_parallel_results,
+            test_watch_wait,
+            test_watch_resume,
+            test_clickhouse_http,
+            test_chi_hosts,
+            test_query_batch,
+            test_query_on_hosts,
+            test_query_rows,
+            test_timeline,
+            test_cycle,
+            test_fake_operator,
+            test_template_registry,
+            test_manifest_index,
+            test_topology,
+            test_settings_import,
+            test_prometheus_api,
+            test_alert_watcher,
+            test_exposition,
+            test_exporter_bench,
+        ]
+        for t in test_cases:
+            Scenario(test=t, flags=TE)()
@@ -1,14 +1,16 @@
 import re
 import time
-import json
 import random
 
-from testflows.core import TestScenario, Name, When, Then, Given, And, main, run, Module
+from testflows.core import TestScenario, Name, When, Then, Given, And, main, Module
 from testflows.asserts import error
 
+import alerts
 import settings
 import kubectl
 import clickhouse
+import prometheus_api
+import timeline
 
 from test_operator import set_operator_version, require_zookeeper
 from test_metrics_exporter import set_metrics_exporter_version
@@ -21,42 +23,22 @@ clickhouse_operator_spec = None
 chi = None
 
 
+def prometheus_client():
+    return prometheus_api.get_client(prometheus_spec["items"][0]["metadata"]["name"], settings.prometheus_namespace)
+
+
 def check_alert_state(alert_name, alert_state="firing", labels=None, time_range="10s"):
-    with Then(f"check {alert_name} for state {alert_state} and {labels} labels in {time_range}"):
-        prometheus_pod = prometheus_spec["items"][0]["metadata"]["name"]
-        cmd = f"exec -n {settings.prometheus_namespace} {prometheus_pod} -c prometheus -- "
-        cmd += "wget -qO- 'http://127.0.0.1:9090/api/v1/query?query=ALERTS{"
-        if labels is None:
-            labels = {}
-        assert isinstance(labels, dict), error()
-
-        labels.update({"alertname": alert_name, "alertstate": alert_state})
-        cmd += ",".join([f"{name}=\"{value}\"" for name, value in labels.items()])
-        cmd += f"}}[{time_range}]' 2>/dev/null"
-        out = kubectl.launch(cmd)
-        out = json.loads(out)
-        assert "status" in out and out["status"] == "success", error("wrong response from prometheus query API")
-        if len(out["data"]["result"]) == 0:
-            with And("not present, empty result"):
-                return False
-        result_labels = out["data"]["result"][0]["metric"].items()
-        exists = all(item in result_labels for item in labels.items())
-        with And("got result and contains labels" if exists else "got result, but doesn't contain labels"):
-            return exists
+    return alerts.check_alert_state(prometheus_client(), alert_name, alert_state, labels, time_range)
 
 
 def wait_alert_state(alert_name, alert_state, expected_state, labels=None, callback=None, max_try=20, sleep_time=10,
                      time_range="10s"):
-    catched = False
-    for i in range(max_try):
-        if not callback is None:
-            callback()
-        if expected_state == check_alert_state(alert_name, alert_state, labels, time_range):
-            catched = True
-            break
-        with And(f"not ready, wait {sleep_time}s"):
-            time.sleep(sleep_time)
-    return catched
+    return alerts.wait_alert_state(prometheus_client(), alert_name, alert_state, expected_state, labels, callback, max_try,
+                                   sleep_time, time_range)
+
+
+def wait_alerts(expectations, callback=None, sleep_time=5):
+    return alerts.wait_alerts(prometheus_client(), expectations, callback, sleep_time)
 
 
 def random_pod_choice_for_callbacks():
@@ -328,36 +310,29 @@ def test_delayed_and_rejected_insert_and_max_part_count_for_partition_and_low_in
             sql = min_block + "INSERT INTO default.test(event_time, test) SELECT now(), number FROM system.numbers LIMIT 1;"
             clickhouse.query_with_error(chi_name, sql, host=selected_svc, ns=kubectl.namespace)
             with And(f"wait prometheus_scrape_interval={prometheus_scrape_interval}*2 sec"):
-                time.sleep(prometheus_scrape_interval * 2)
+                timeline.sleep(prometheus_scrape_interval * 2)
 
             sql = min_block + "INSERT INTO default.test(event_time, test) SELECT now(), number FROM system.numbers LIMIT 1;"
             clickhouse.query_with_error(chi_name, sql, host=selected_svc, ns=kubectl.namespace)
 
     insert_many_parts_to_clickhouse()
-    with Then("check ClickHouseDelayedInsertThrottling firing"):
-        fired = wait_alert_state("ClickHouseDelayedInsertThrottling", "firing", True, labels={"hostname": delayed_svc}, time_range="30s",
-                                 sleep_time=5)
-        assert fired, error("can't get ClickHouseDelayedInsertThrottling alert in firing state")
-    with Then("check ClickHouseMaxPartCountForPartition firing"):
-        fired = wait_alert_state("ClickHouseMaxPartCountForPartition", "firing", True, labels={"hostname": delayed_svc}, time_range="45s",
-                                 sleep_time=5)
-        assert fired, error("can't get ClickHouseMaxPartCountForPartition alert in firing state")
-    with Then("check ClickHouseLowInsertedRowsPerQuery firing"):
-        fired = wait_alert_state("ClickHouseLowInsertedRowsPerQuery", "firing", True, labels={"hostname": delayed_svc}, time_range="60s",
-                                 sleep_time=5)
-        assert fired, error("can't get ClickHouseLowInsertedRowsPerQuery alert in firing state")
+    delayed_alerts = (
+        ("ClickHouseDelayedInsertThrottling", "30s"),
+        ("ClickHouseMaxPartCountForPartition", "45s"),
+        ("ClickHouseLowInsertedRowsPerQuery", "60s"),
+    )
+    wait_alerts([
+        # Waited for one after the other these had 100s each
+        prometheus_api.expect_alert(name, labels={"hostname": delayed_svc}, time_range=time_range, timeout=300)
+        for name, time_range in delayed_alerts
+    ])
 
     clickhouse.query(chi_name, "SYSTEM START MERGES default.test", host=selected_svc, ns=kubectl.namespace)
 
-    with Then("check ClickHouseDelayedInsertThrottling gone away"):
-        resolved = wait_alert_state("ClickHouseDelayedInsertThrottling", "firing", False, labels={"hostname": delayed_svc}, sleep_time=5)
-        assert resolved, error("can't check ClickHouseDelayedInsertThrottling alert is gone away")
-    with Then("check ClickHouseMaxPartCountForPartition gone away"):
-        resolved = wait_alert_state("ClickHouseMaxPartCountForPartition", "firing", False, labels={"hostname": delayed_svc}, sleep_time=5)
-        assert resolved, error("can't check ClickHouseMaxPartCountForPartition alert is gone away")
-    with Then("check ClickHouseLowInsertedRowsPerQuery gone away"):
-        resolved = wait_alert_state("ClickHouseLowInsertedRowsPerQuery", "firing", False, labels={"hostname": delayed_svc}, sleep_time=5)
-        assert resolved, error("can't check ClickHouseLowInsertedRowsPerQuery alert is gone away")
+    wait_alerts([
+        prometheus_api.expect_alert(name, present=False, labels={"hostname": delayed_svc}, timeout=300)
+        for name, _ in delayed_alerts
+    ])
 
     parts_limits = parts_to_throw_insert
     selected_svc = rejected_svc
@@ -657,7 +632,7 @@ def test_version_changed():
         )
         prometheus_scrape_interval = 15
         with And(f"wait prometheus_scrape_interval={prometheus_scrape_interval}*2 sec"):
-            time.sleep(prometheus_scrape_interval * 2)
+            timeline.sleep(prometheus_scrape_interval * 2)
 
     with Then("check ClickHouseVersionChanged firing"):
         fired = wait_alert_state("ClickHouseVersionChanged", "firing", True, labels={"hostname": changed_svc},
@@ -5,8 +5,11 @@ import json
 from testflows.core import TestScenario, Name, When, Then, Given, And, main, Scenario, Module, TE
 from testflows.asserts import error
 
+import exposition
 import kubectl
+import prometheus_api
 import settings
+import timeline
 import util
 
 
@@ -30,21 +33,15 @@ def test_metrics_exporter_reboot(self):
     def check_monitoring_chi(operator_namespace, operator_pod, expect_result, max_retries=10):
         with Then(f"metrics-exporter /chi enpoint result should return {expect_result}"):
             for i in range(1, max_retries):
+                exporter = prometheus_api.get_client(operator_pod, operator_namespace, prometheus_api.metrics_exporter_port)
                 # check /metrics for try to refresh monitored instances
-                kubectl.launch(
-                    f"exec {operator_pod} -c metrics-exporter -- wget -O- -q http://127.0.0.1:8888/metrics",
-                    ns=operator_namespace
-                )
+                exporter.get("/metrics")
                 # check /chi after refresh monitored instances
-                out = kubectl.launch(
-                    f"exec {operator_pod} -c metrics-exporter -- wget -O- -q http://127.0.0.1:8888/chi",
-                    ns=operator_namespace
-                )
-                out = json.loads(out)
+                out = json.loads(exporter.get("/chi"))
                 if out == expect_result:
                     break
                 with Then("Not ready. Wait for " + str(i * 5) + " seconds"):
-                    time.sleep(i * 5)
+                    timeline.sleep(i * 5)
             assert out == expect_result, error()
 
     with Given("clickhouse-operator is installed"):
@@ -77,7 +74,7 @@ def test_metrics_exporter_reboot(self):
             check_monitoring_chi(operator_namespace, operator_pod, expected_chi)
             with When("reboot metrics exporter"):
                 kubectl.launch(f"exec -n {operator_namespace} {operator_pod} -c metrics-exporter -- reboot")
-                time.sleep(15)
+                timeline.sleep(15)
                 kubectl.wait_field("pods", "-l app=clickhouse-operator",
                                         ".status.containerStatuses[*].ready", "true,true",
                                    ns=settings.operator_namespace)
@@ -92,22 +89,14 @@ def test_metrics_exporter_reboot(self):
 def test_metrics_exporter_with_multiple_clickhouse_version(self):
     def check_monitoring_metrics(operator_namespace, operator_pod, expect_result, max_retries=10):
         with Then(f"metrics-exporter /metrics enpoint result should match with {expect_result}"):
+            client = prometheus_api.get_client(operator_pod, operator_namespace, prometheus_api.metrics_exporter_port)
             for i in range(1, max_retries):
-                out = kubectl.launch(
-                    f"exec {operator_pod} -c metrics-exporter -- wget -O- -q http://127.0.0.1:8888/metrics",
-                    ns=operator_namespace
-                )
-                all_strings_expected_done = True
-                for string, exists in expect_result.items():
-                    all_strings_expected_done = (exists == (string in out))
-                    if not all_strings_expected_done:
-                        break
-
-                if all_strings_expected_done:
+                failures = client.scrape("/metrics").failures(expect_result)
+                if len(failures) == 0:
                     break
-                with Then("Not ready. Wait for " + str(i * 5) + " seconds"):
-                    time.sleep(i * 5)
-            assert all_strings_expected_done, error()
+                with Then(f"Not ready, {failures[0]}. Wait for " + str(i * 5) + " seconds"):
+                    timeline.sleep(i * 5)
+            assert len(failures) == 0, error(failures)
 
     with Given("clickhouse-operator pod exists"):
         out = kubectl.launch("get pods -l app=clickhouse-operator", ns='kube-system').splitlines()[1]
@@ -117,9 +106,9 @@ def test_metrics_exporter_with_multiple_clickhouse_version(self):
         with Then("check empty /metrics"):
             kubectl.delete_ns(kubectl.namespace, ok_to_fail=True)
             kubectl.create_ns(kubectl.namespace)
-            check_monitoring_metrics(operator_namespace, operator_pod, expect_result={
-                'chi_clickhouse_metric_VersionInteger': False,
-            })
+            check_monitoring_metrics(operator_namespace, operator_pod, expect_result=[
+                exposition.expect('chi_clickhouse_metric_VersionInteger', present=False),
+            ])
 
         with Then("Install multiple clickhouse version"):
             config = util.get_full_path("configs/test-017-multi-version.yaml")
@@ -134,18 +123,22 @@ def test_metrics_exporter_with_multiple_clickhouse_version(self):
                     "do_not_delete": True,
                 })
             with And("Check not empty /metrics"):
-                check_monitoring_metrics(operator_namespace, operator_pod, expect_result={
-                    '# HELP chi_clickhouse_metric_VersionInteger': True,
-                    '# TYPE chi_clickhouse_metric_VersionInteger gauge': True,
-                    'chi_clickhouse_metric_VersionInteger{chi="test-017-multi-version",hostname="chi-test-017-multi-version-default-0-0': True,
-                    'chi_clickhouse_metric_VersionInteger{chi="test-017-multi-version",hostname="chi-test-017-multi-version-default-1-0': True,
-                })
+                check_monitoring_metrics(operator_namespace, operator_pod, expect_result=[
+                    exposition.expect('chi_clickhouse_metric_VersionInteger', type='gauge', min=1, labels={
+                        'chi': 'test-017-multi-version',
+                        'hostname': re.compile(r'chi-test-017-multi-version-default-0-0\b'),
+                    }),
+                    exposition.expect('chi_clickhouse_metric_VersionInteger', type='gauge', min=1, labels={
+                        'chi': 'test-017-multi-version',
+                        'hostname': re.compile(r'chi-test-017-multi-version-default-1-0\b'),
+                    }),
+                ])
 
         with Then("check empty /metrics after delete namespace"):
             kubectl.delete_ns(kubectl.namespace)
-            check_monitoring_metrics(operator_namespace, operator_pod, expect_result={
-                'chi_clickhouse_metric_VersionInteger': False,
-            })
+            check_monitoring_metrics(operator_namespace, operator_pod, expect_result=[
+                exposition.expect('chi_clickhouse_metric_VersionInteger', present=False),
+            ])
 
 
 if main():
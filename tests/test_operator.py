@@ -3,6 +3,7 @@ import time
 import clickhouse
 import kubectl
 import settings
+import timeline
 import util
 import manifest
 
@@ -16,11 +17,7 @@ def test_001(self):
     kubectl.create_and_check(
         config="configs/test-001.yaml",
         check={
-            "object_counts": {
-                "statefulset": 1,
-                "pod": 1,
-                "service": 2,
-            },
+            "object_counts": "auto",
             "configmaps": 1,
         }
     )
@@ -53,11 +50,7 @@ def test_003(self):
     kubectl.create_and_check(
         config="configs/test-003-complex-layout.yaml",
         check={
-            "object_counts": {
-                "statefulset": 4,
-                "pod": 4,
-                "service": 5,
-            },
+            "object_counts": "auto",
         },
     )
 
@@ -105,7 +98,7 @@ def test_006(self):
                 "do_not_delete": 1,
             }
         )
-    time.sleep(60)
+    timeline.sleep(60)
     with Then("Use different podTemplate and confirm that pod image is updated"):
         kubectl.create_and_check(
             config="configs/test-006-ch-upgrade-2.yaml",
@@ -115,7 +108,7 @@ def test_006(self):
                 "do_not_delete": 1,
             }
         )
-    time.sleep(60)
+    timeline.sleep(60)
     with Then("Change image in podTemplate itself and confirm that pod image is updated"):
         kubectl.create_and_check(
             config="configs/test-006-ch-upgrade-3.yaml",
@@ -138,7 +131,7 @@ def test_007(self):
     )
 
 
-def test_operator_upgrade(config, version_from, version_to=settings.operator_version):
+def test_operator_upgrade(config, version_from, version_to=None):
     version_to = settings.operator_version
     with Given(f"clickhouse-operator {version_from}"):
         set_operator_version(version_from)
@@ -160,7 +153,7 @@ def test_operator_upgrade(config, version_from, version_to=settings.operator_ver
 
         with When(f"upgrade operator to {version_to}"):
             set_operator_version(version_to, timeout=120)
-            time.sleep(10)
+            timeline.sleep(10)
             kubectl.wait_chi_status(chi, "Completed", retries=6)
             kubectl.wait_objects(chi, {"statefulset": 1, "pod": 1, "service": 2})
             with Then("ClickHouse pods should not be restarted"):
@@ -170,7 +163,8 @@ def test_operator_upgrade(config, version_from, version_to=settings.operator_ver
         kubectl.delete_chi(chi)
 
 
-def test_operator_restart(config, version=settings.operator_version):
+def test_operator_restart(config, version=None):
+    version = version or settings.operator_version
     with Given(f"clickhouse-operator {version}"):
         set_operator_version(version)
         config = util.get_full_path(config)
@@ -187,12 +181,12 @@ def test_operator_restart(config, version=settings.operator_version):
                 },
                 "do_not_delete": 1,
             })
-        time.sleep(10)
+        timeline.sleep(10)
         start_time = kubectl.get_field("pod", f"chi-{chi}-{cluster}-0-0-0", ".status.startTime")
 
         with When("Restart operator"):
             restart_operator()
-            time.sleep(10)
+            timeline.sleep(10)
             kubectl.wait_chi_status(chi, "Completed")
             kubectl.wait_objects(
                 chi,
@@ -201,7 +195,7 @@ def test_operator_restart(config, version=settings.operator_version):
                     "pod": 1,
                     "service": 2,
                 })
-            time.sleep(10)
+            timeline.sleep(10)
             new_start_time = kubectl.get_field("pod", f"chi-{chi}-{cluster}-0-0-0", ".status.startTime")
             assert start_time == new_start_time
 
@@ -219,7 +213,7 @@ def test_008(self):
 
 @TestScenario
 @Name("test_009. Test operator upgrade")
-def test_009(self, version_from="0.11.0", version_to=settings.operator_version):
+def test_009(self, version_from="0.11.0", version_to=None):
     with Then("Test simple chi for operator upgrade"):
         test_operator_upgrade("configs/test-009-operator-upgrade-1.yaml", version_from, version_to)
     with Then("Test advanced chi for operator upgrade"):
@@ -269,7 +263,7 @@ def test_010(self):
             "do_not_delete": 1,
         }
     )
-    time.sleep(10)
+    timeline.sleep(10)
     with And("ClickHouse should complain regarding zookeeper path"):
         out = clickhouse.query_with_error("test-010-zkroot", "select * from system.zookeeper where path = '/'")
         assert "Received exception from server" in out, error()
@@ -305,7 +299,7 @@ def test_011(self):
             }
         )
 
-        time.sleep(60)
+        timeline.sleep(60)
 
         with Then("Connection to localhost should succeed with default user"):
             out = clickhouse.query_with_error("test-011-secured-cluster", "select 'OK'")
@@ -328,7 +322,7 @@ def test_011(self):
             assert out != 'OK'
 
         with And("Connection from insecured to secured host should fail for user with no password"):
-            time.sleep(10)  # FIXME
+            timeline.sleep(10)  # FIXME
             out = clickhouse.query_with_error(
                 "test-011-insecured-cluster",
                 "select 'OK'",
@@ -431,7 +425,7 @@ def test_011_1(self):
             with Then("Wait until configmap is reloaded"):
                 # Need to wait to make sure configuration is reloaded. For some reason it takes long here
                 # Maybe we can restart the pod to speed it up
-                time.sleep(120)
+                timeline.sleep(120)
             with Then("Connection to localhost should succeed with default user"):
                 out = clickhouse.query_with_error(
                     "test-011-secured-default",
@@ -513,7 +507,7 @@ def test_013(self):
 
     # wait for cluster to start
     for i in range(20):
-        time.sleep(10)
+        timeline.sleep(10)
         out = clickhouse.query_with_error(
             chi,
             "SELECT count() FROM cluster('all-sharded', system.one) settings receive_timeout=10")
@@ -560,7 +554,7 @@ def test_013(self):
 
     # wait for cluster to start
     for i in range(20):
-        time.sleep(10)
+        timeline.sleep(10)
         out = clickhouse.query_with_error(
             chi,
             "SELECT count() FROM cluster('all-sharded', system.one) settings receive_timeout=10")
@@ -577,18 +571,12 @@ def test_013(self):
 
     with And("Schema objects should be migrated to new shards"):
         for obj in schema_objects:
-            out = clickhouse.query(
-                chi,
-                f"SELECT count() FROM system.tables WHERE name = '{obj}'",
-                host=f"chi-{chi}-{cluster}-1-0"
-            )
-            assert out == "1"
-            out = clickhouse.query(
+            clickhouse.assert_query_on_hosts(
                 chi,
                 f"SELECT count() FROM system.tables WHERE name = '{obj}'",
-                host=f"chi-{chi}-{cluster}-2-0"
+                "1",
+                hosts=[f"chi-{chi}-{cluster}-1-0", f"chi-{chi}-{cluster}-2-0"],
             )
-            assert out == "1"
 
     with When("Remove shards"):
         kubectl.create_and_check(
@@ -605,7 +593,7 @@ def test_013(self):
 
         # wait for cluster to start
         for i in range(20):
-            time.sleep(10)
+            timeline.sleep(10)
             out = clickhouse.query_with_error(
                 chi,
                 "SELECT count() FROM cluster('all-sharded', system.one) settings receive_timeout=10")
@@ -665,25 +653,15 @@ def test_014(self):
         'a_view'
     ]
     with Given("Create schema objects"):
-        clickhouse.query(
-            chi,
-            create_table,
-            host=f"chi-{chi}-{cluster}-0-0")
-        clickhouse.query(
+        clickhouse.query_batch(
             chi,
-            "CREATE VIEW test_view as SELECT * from test_local",
-            host=f"chi-{chi}-{cluster}-0-0")
-        clickhouse.query(
-            chi,
-            "CREATE VIEW a_view as SELECT * from test_view",
-            host=f"chi-{chi}-{cluster}-0-0")
-        clickhouse.query(
-            chi,
-            "CREATE MATERIALIZED VIEW test_mv Engine = Log as SELECT * from test_local",
-            host=f"chi-{chi}-{cluster}-0-0")
-        clickhouse.query(
-            chi,
-            "CREATE DICTIONARY test_dict (a Int8, b Int8) PRIMARY KEY a SOURCE(CLICKHOUSE(host 'localhost' port 9000 table 'test_local' user 'default')) LAYOUT(FLAT()) LIFETIME(0)",
+            [
+                create_table,
+                "CREATE VIEW test_view as SELECT * from test_local",
+                "CREATE VIEW a_view as SELECT * from test_view",
+                "CREATE MATERIALIZED VIEW test_mv Engine = Log as SELECT * from test_local",
+                "CREATE DICTIONARY test_dict (a Int8, b Int8) PRIMARY KEY a SOURCE(CLICKHOUSE(host 'localhost' port 9000 table 'test_local' user 'default')) LAYOUT(FLAT()) LIFETIME(0)",
+            ],
             host=f"chi-{chi}-{cluster}-0-0")
 
     with Given("Replicated table is created on a first replica and data is inserted"):
@@ -697,7 +675,7 @@ def test_014(self):
                 create_table,
                 host=f"chi-{chi}-{cluster}-0-1")
             # Give some time for replication to catch up
-            time.sleep(10)
+            timeline.sleep(10)
             with Then("Data should be replicated"):
                 out = clickhouse.query(
                     chi,
@@ -715,24 +693,19 @@ def test_014(self):
             timeout=600,
         )
         # Give some time for replication to catch up
-        time.sleep(10)
+        timeline.sleep(10)
 
         new_start_time = kubectl.get_field("pod", f"chi-{chi}-{cluster}-0-0-0", ".status.startTime")
         assert start_time == new_start_time
 
         with Then("Schema objects should be migrated to the new replica"):
-            for obj in schema_objects:
-                out = clickhouse.query(
-                    chi,
-                    f"SELECT count() FROM system.tables WHERE name = '{obj}'",
-                    host=f"chi-{chi}-{cluster}-0-2")
-                assert out == "1"
-            # Check dictionary
-            out = clickhouse.query(
-                    chi,
-                    f"SELECT count() FROM system.dictionaries WHERE name = 'test_dict'",
-                    host=f"chi-{chi}-{cluster}-0-2")
-            assert out == "1"
+            results = clickhouse.query_batch(
+                chi,
+                [f"SELECT count() FROM system.tables WHERE name = '{obj}'" for obj in schema_objects] +
+                # Check dictionary
+                ["SELECT count() FROM system.dictionaries WHERE name = 'test_dict'"],
+                host=f"chi-{chi}-{cluster}-0-2")
+            assert [r.output for r in results] == ["1"] * (len(schema_objects) + 1), error()
 
         with And("Replicated table should have the data"):
             out = clickhouse.query(
@@ -761,7 +734,7 @@ def test_014(self):
     with When("Restart Zookeeper pod"):
         with Then("Delete Zookeeper pod"):
             kubectl.launch("delete pod zookeeper-0")
-            time.sleep(1)
+            timeline.sleep(1)
 
         with Then("Insert into the table while there is no Zookeeper -- table should be in readonly mode"):
             out = clickhouse.query_with_error(chi, "INSERT INTO test_local values(2)")
@@ -772,7 +745,7 @@ def test_014(self):
             kubectl.wait_pod_status("zookeeper-0", "Running")
 
         with Then("Wait for ClickHouse to reconnect to Zookeeper and switch to read-write mode"):
-            time.sleep(30)
+            timeline.sleep(30)
         # with Then("Restart clickhouse pods"):
         #    kubectl("delete pod chi-test-014-replication-default-0-0-0")
         #    kubectl("delete pod chi-test-014-replication-default-0-1-0")
@@ -795,7 +768,7 @@ def test_015(self):
         timeout=600,
     )
 
-    time.sleep(30)
+    timeline.sleep(30)
     with Then("Query from one server to another one should work"):
         out = clickhouse.query(
             "test-015-host-network",
@@ -807,7 +780,7 @@ def test_015(self):
 
     with Then("Distributed query should work"):
         for i in range(20):
-            time.sleep(10)
+            timeline.sleep(10)
             out = clickhouse.query_with_error(
                 "test-015-host-network",
                 host="chi-test-015-host-network-default-0-0",
@@ -1214,7 +1187,7 @@ def test_021(self):
                 if out == "2":
                     break
                 with Then(f"Not ready yet. Wait for {1<<i} seconds"):
-                    time.sleep(1<<i)
+                    timeline.sleep(1<<i)
             print("SELECT count() FROM system.disks RETURNED:")
             print(out)
             assert out == "2"
@@ -1347,7 +1320,7 @@ def test_025(self):
         distr_lb_error_time = start_time
         latent_replica_time = start_time
         for i in range(1, 100):
-            cnt_local    = clickhouse.query_with_error(chi, "select count() from test_local", "chi-test-025-rescaling-default-0-1.test.svc.cluster.local")
+            cnt_local    = clickhouse.query_with_error(chi, "select count() from test_local", f"chi-test-025-rescaling-default-0-1.{kubectl.namespace}.svc.cluster.local")
             cnt_lb       = clickhouse.query_with_error(chi, "select count() from test_local")
             cnt_distr_lb = clickhouse.query_with_error(chi, "select count() from test_distr")
             if "Exception" in cnt_lb or cnt_lb == 0:
@@ -1362,7 +1335,7 @@ def test_025(self):
                 latent_replica_time = time.time()
                 print("Replicated table did not catch up")
             print("Waiting 1 second.")
-            time.sleep(1)
+            timeline.sleep(1)
         print(f"Tables not ready: {round(distr_lb_error_time - start_time)}s, data not ready: {round(latent_replica_time - distr_lb_error_time)}s")
         
         with Then("Query to the distributed table via load balancer should never fail"):
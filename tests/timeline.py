@@ -0,0 +1,181 @@
+import contextlib
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+
+from testflows.core import current, note, metric
+
+import settings
+
+# Records where a run spends its time: every kubectl/API call, wait iteration, query and explicit sleep
+# becomes an event. Events of a scenario are written to settings.timeline_dir as <scenario>.json
+# and <scenario>.trace.json, the latter loads into chrome://tracing or https://ui.perfetto.dev.
+# Events are only kept while a scenario() is open, calls made outside of one are not recorded
+
+events = []
+# Name of the open scenario(), None when events are not collected
+active = None
+lock = threading.Lock()
+pid = os.getpid()
+# Per-thread stack of the fields of open spans, see retry()
+local = threading.local()
+
+
+def current_step():
+    # Full name of the testflows step the event happens in, None outside of a test or in helper threads
+    try:
+        return getattr(current(), "name", None)
+    except Exception:
+        return None
+
+
+def record(category, name, started, finished, **fields):
+    event = {
+        "category": category,
+        "name": name,
+        "start": started,
+        "end": finished,
+        "duration": finished - started,
+        "thread": threading.get_ident(),
+        "step": current_step(),
+    }
+    event.update({k: v for k, v in fields.items() if v is not None})
+    with lock:
+        if active is not None:
+            events.append(event)
+    return event
+
+
+@contextlib.contextmanager
+def span(category, name, **fields):
+    # Times the block, the caller may add fields such as bytes or exitcode to the yielded dict
+    stack = local.__dict__.setdefault("stack", [])
+    stack.append((category, fields))
+    started = time.time()
+    try:
+        yield fields
+    finally:
+        stack.pop()
+        record(category, name, started, time.time(), **fields)
+
+
+def retry(category="wait"):
+    # Counts one more iteration of the innermost open span of the category
+    for c, fields in reversed(local.__dict__.get("stack", [])):
+        if c == category:
+            fields["retries"] = fields.get("retries", 0) + 1
+            return
+
+
+def timed(category):
+    # Decorator recording every call as a span named after the function and its arguments
+    def decorator(f):
+        signature = inspect.signature(f)
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            ns = bound.arguments.get("ns")
+            described = ", ".join([repr(a) for a in args] + [f"{k}={v!r}" for k, v in kwargs.items()])[:200]
+            with span(category, f"{f.__name__}({described})", ns=ns, retries=0) as fields:
+                result = f(*args, **kwargs)
+                if isinstance(result, str):
+                    fields["bytes"] = len(result)
+                return result
+        return wrapper
+    return decorator
+
+
+def sleep(seconds, reason=None):
+    # time.sleep() that shows up in the timeline, sleeping inside a wait counts as one of its retries
+    retry()
+    with span("sleep", reason or f"sleep {seconds}s", seconds=seconds):
+        time.sleep(seconds)
+
+
+def take():
+    global events
+    with lock:
+        taken, events = events, []
+    return taken
+
+
+def trace_events(recorded):
+    # Chrome trace-event format, complete ("X") events with microsecond timestamps
+    tids = {}
+    trace = []
+    for e in recorded:
+        tid = tids.setdefault(e["thread"], len(tids))
+        args = {k: v for k, v in e.items() if k not in ("category", "name", "start", "end", "duration", "thread")}
+        trace.append({
+            "name": e["name"],
+            "cat": e["category"],
+            "ph": "X",
+            "ts": int(e["start"] * 1e6),
+            "dur": int(e["duration"] * 1e6),
+            "pid": pid,
+            "tid": tid,
+            "args": args,
+        })
+    return {"traceEvents": trace, "displayTimeUnit": "ms"}
+
+
+def summary(recorded):
+    # {category: {"count": n, "seconds": total}}
+    totals = {}
+    for e in recorded:
+        total = totals.setdefault(e["category"], {"count": 0, "seconds": 0.0})
+        total["count"] += 1
+        total["seconds"] += e["duration"]
+    return totals
+
+
+def write(scenario, recorded, started, finished, directory=None):
+    directory = directory or settings.timeline_dir
+    os.makedirs(directory, exist_ok=True)
+    timeline = {
+        "scenario": scenario,
+        "namespace": settings.test_namespace,
+        "start": started,
+        "end": finished,
+        "duration": finished - started,
+        "summary": summary(recorded),
+        "events": recorded,
+    }
+    with open(os.path.join(directory, f"{scenario}.json"), "w") as f:
+        json.dump(timeline, f)
+    with open(os.path.join(directory, f"{scenario}.trace.json"), "w") as f:
+        json.dump(trace_events(recorded), f)
+
+
+def report(totals):
+    # Time spent per category as a note and metrics of the current test, nothing outside of a test
+    if current_step() is None or not totals:
+        return
+    note("Time spent: " + ", ".join(f"{c} {t['seconds']:.1f}s/{t['count']}" for c, t in sorted(totals.items())))
+    for c, t in sorted(totals.items()):
+        metric(f"{c} time", t["seconds"], "s")
+
+
+@contextlib.contextmanager
+def scenario(name):
+    # Collects the events of one scenario and writes them out when timelines are enabled
+    global active
+    with lock:
+        outer, active = active, name
+    take()
+    started = time.time()
+    try:
+        yield
+    finally:
+        finished = time.time()
+        recorded = take()
+        with lock:
+            active = outer
+        report(summary(recorded))
+        if settings.timeline_dir != "":
+            write(name, recorded, started, finished)
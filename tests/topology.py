@@ -0,0 +1,254 @@
+import collections
+import copy
+import hashlib
+import re
+
+import manifest
+
+# Expected Kubernetes objects of a CHI, computed from its manifest and CHITs the way the operator expands it:
+# templates are merged as in Normalizer.CreateTemplatedCHI(), shards x replicas are expanded as in
+# pkg/model/normalizer.go and objects are named by the patterns of pkg/model/namer.go.
+
+# Host of a CHI. templates are the template names in effect for the host after inheritance,
+# pvcs the names of the PVCs of its pod
+Host = collections.namedtuple(
+    "Host",
+    "cluster shard replica name shard_index replica_index statefulset pod service configmap pvcs templates",
+)
+Topology = collections.namedtuple("Topology", "chi namespace hosts statefulsets pods services configmaps pvcs")
+
+# Name part lengths of namer.go in the names context
+chi_name_len = 60
+part_name_len = 15
+
+template_names = (
+    "hostTemplate", "podTemplate", "dataVolumeClaimTemplate", "logVolumeClaimTemplate",
+    "serviceTemplate", "clusterServiceTemplate", "shardServiceTemplate", "replicaServiceTemplate",
+)
+macro_re = re.compile(r"\{[A-Za-z]+\}")
+
+
+def is_true(value):
+    # util.IsStringBoolTrue
+    return str(value).strip().lower() in ("1", "true", "yes", "on", "enable", "enabled")
+
+
+def merge(dst, src):
+    # chiv1 MergeFrom with MergeTypeOverrideByNonEmptyValues: non-empty values of src win,
+    # templates are matched by name
+    for key, value in src.items():
+        if value is None or value == "" or value == [] or value == {}:
+            continue
+        current = dst.get(key)
+        if isinstance(value, dict) and isinstance(current, dict):
+            merge(current, value)
+        elif isinstance(value, list) and isinstance(current, list) and all(isinstance(v, dict) and "name" in v for v in value + current):
+            by_name = {item["name"]: item for item in current}
+            for item in value:
+                if item["name"] in by_name:
+                    merge(by_name[item["name"]], item)
+                else:
+                    current.append(copy.deepcopy(item))
+        else:
+            dst[key] = copy.deepcopy(value)
+    return dst
+
+
+def templated(chi, chits=()):
+    # CHI spec on top of auto templates and the CHITs it uses, in that order
+    by_name = {t["metadata"]["name"]: t for t in chits}
+    use = [t for t in chits if ((t.get("spec") or {}).get("templating") or {}).get("policy", "").lower() == "auto"]
+    use += [by_name[u["name"]] for u in (chi.get("spec") or {}).get("useTemplates") or [] if u["name"] in by_name]
+    spec = {}
+    for t in use:
+        merge(spec, t.get("spec") or {})
+    merge(spec, chi.get("spec") or {})
+    return spec
+
+
+def sanitize(name, length):
+    return name[:length].strip("-_.")
+
+
+def string_id(name, length):
+    return hashlib.sha1(name.encode()).hexdigest()[:length]
+
+
+def replace(pattern, macros):
+    # strings.Replacer: every macro is replaced in one pass, unknown ones stay as they are
+    return macro_re.sub(lambda m: macros.get(m.group(0), m.group(0)), pattern)
+
+
+def inherit(templates, parent):
+    # Fills template names the object does not set itself from its parent
+    merged = dict(parent)
+    merged.update({k: v for k, v in (templates or {}).items() if v})
+    # DEPRECATED volumeClaimTemplate stands for dataVolumeClaimTemplate
+    if merged.get("volumeClaimTemplate") and not merged.get("dataVolumeClaimTemplate"):
+        merged["dataVolumeClaimTemplate"] = merged["volumeClaimTemplate"]
+    return merged
+
+
+def is_auto_host_name(name, shard, replica, shard_index, replica_index):
+    return name in (f"{shard}-{replica}", f"{shard_index}-{replica_index}", str(shard_index), str(replica_index))
+
+
+def cluster_hosts(cluster):
+    # [(shard, replica, host name, shard index, replica index, shard templates, replica templates, host templates)]
+    # in the order the operator walks them
+    layout = cluster.get("layout") or {}
+    shards = layout.get("shards") or []
+    replicas = layout.get("replicas") or []
+    counts = manifest.cluster_layout(cluster)
+    replica_names = [
+        (replicas[i].get("name") if i < len(replicas) else None) or str(i)
+        for i in range(max(counts + [len(replicas)]))
+    ]
+    hosts = []
+    for shard_index, count in enumerate(counts):
+        shard = shards[shard_index] if shard_index < len(shards) else {}
+        shard_name = shard.get("name") or str(shard_index)
+        shard_hosts = shard.get("replicas") or []
+        for replica_index in range(count):
+            replica = replicas[replica_index] if replica_index < len(replicas) else {}
+            # A host can be defined in the shard's replicas or in the replica's shards
+            host = dict((replica.get("shards") or [])[shard_index]) if shard_index < len(replica.get("shards") or []) else {}
+            host.update(shard_hosts[replica_index] if replica_index < len(shard_hosts) else {})
+            name = host.get("name") or ""
+            if name == "" or is_auto_host_name(name, shard_name, replica_names[replica_index], shard_index, replica_index):
+                name = f"{shard_name}-{replica_names[replica_index]}"
+            hosts.append((
+                shard_name, replica_names[replica_index], name, shard_index, replica_index,
+                shard.get("templates"), replica.get("templates"), host.get("templates"),
+            ))
+    return hosts
+
+
+def volume_claims(templates, pod_template, claim_templates):
+    # VolumeClaimTemplates of a host's StatefulSet: the ones its containers mount plus data and log ones
+    names = []
+    for container in ((pod_template or {}).get("spec") or {}).get("containers") or []:
+        for mount in container.get("volumeMounts") or []:
+            if mount.get("name") in claim_templates and mount["name"] not in names:
+                names.append(mount["name"])
+    for key in ("dataVolumeClaimTemplate", "logVolumeClaimTemplate"):
+        name = templates.get(key)
+        if name in claim_templates and name not in names:
+            names.append(name)
+    return names
+
+
+def expand(chi, chits=(), ns=None):
+    # Topology of a CHI manifest, chits are the CHIT objects available to the operator
+    spec = templated(chi, chits)
+    name = chi["metadata"]["name"]
+    ns = ns or chi["metadata"].get("namespace") or "default"
+    stopped = is_true(spec.get("stop", ""))
+    defaults = inherit((spec.get("defaults") or {}).get("templates"), {})
+    templates = spec.get("templates") or {}
+    pod_templates = {t["name"]: t for t in templates.get("podTemplates") or []}
+    service_templates = {t["name"]: t for t in templates.get("serviceTemplates") or []}
+    claim_templates = {t["name"]: t for t in templates.get("volumeClaimTemplates") or []}
+
+    chi_macros = {
+        "{namespace}": sanitize(ns, chi_name_len),
+        "{chi}": sanitize(name, chi_name_len),
+        "{chiID}": string_id(name, chi_name_len),
+    }
+
+    def service_name(template_name, pattern, macros):
+        # Returns None when the template is not known, only CHI and host services exist without one
+        template = service_templates.get(template_name)
+        if template is None:
+            return None
+        return replace(template.get("generateName") or pattern, macros)
+
+    services = []
+    if not stopped:
+        services.append(
+            service_name(defaults.get("serviceTemplate"), "clickhouse-{chi}", chi_macros) or
+            replace("clickhouse-{chi}", chi_macros)
+        )
+    hosts = []
+    clusters = (spec.get("configuration") or {}).get("clusters") or [{"name": "cluster"}]
+    for cluster_index, cluster in enumerate(clusters):
+        cluster_templates = inherit(cluster.get("templates"), defaults)
+        cluster_macros = dict(chi_macros, **{
+            "{cluster}": sanitize(cluster["name"], part_name_len),
+            "{clusterID}": string_id(cluster["name"], part_name_len),
+            "{clusterIndex}": str(cluster_index),
+        })
+        service = service_name(cluster_templates.get("clusterServiceTemplate"), "cluster-{chi}-{cluster}", cluster_macros)
+        if service is not None:
+            services.append(service)
+        shard_specified = len((cluster.get("layout") or {}).get("shards") or []) > 0 or \
+            len((cluster.get("layout") or {}).get("replicas") or []) == 0
+        seen_shards = set()
+        for shard, replica, host_name, shard_index, replica_index, s_tpl, r_tpl, h_tpl in cluster_hosts(cluster):
+            shard_templates = inherit(s_tpl, cluster_templates)
+            macros = dict(cluster_macros, **{
+                "{shard}": sanitize(shard, part_name_len),
+                "{shardID}": string_id(shard, part_name_len),
+                "{shardIndex}": str(shard_index),
+            })
+            if shard_index not in seen_shards:
+                seen_shards.add(shard_index)
+                service = service_name(shard_templates.get("shardServiceTemplate"), "shard-{chi}-{cluster}-{shard}", macros)
+                if service is not None:
+                    services.append(service)
+            host_templates = inherit(h_tpl, shard_templates if shard_specified else inherit(r_tpl, cluster_templates))
+            macros.update({
+                "{replica}": sanitize(replica, part_name_len),
+                "{replicaID}": string_id(replica, part_name_len),
+                "{replicaIndex}": str(replica_index),
+                # host.Address has these two swapped, names follow it
+                "{shardScopeIndex}": str(replica_index),
+                "{replicaScopeIndex}": str(shard_index),
+                "{host}": sanitize(host_name, part_name_len),
+                "{hostID}": string_id(host_name, part_name_len),
+            })
+            pod_template = pod_templates.get(host_templates.get("podTemplate"))
+            statefulset = replace((pod_template or {}).get("generateName") or "chi-{chi}-{cluster}-{host}", macros)
+            pod = f"{statefulset}-0"
+            hosts.append(Host(
+                cluster=cluster["name"],
+                shard=shard,
+                replica=replica,
+                name=host_name,
+                shard_index=shard_index,
+                replica_index=replica_index,
+                statefulset=statefulset,
+                pod=pod,
+                service=service_name(host_templates.get("replicaServiceTemplate"), "chi-{chi}-{cluster}-{host}", macros) or
+                replace("chi-{chi}-{cluster}-{host}", macros),
+                configmap=replace("chi-{chi}-deploy-confd-{cluster}-{host}", macros),
+                pvcs=[f"{claim}-{pod}" for claim in volume_claims(host_templates, pod_template, claim_templates)],
+                templates=host_templates,
+            ))
+
+    return Topology(
+        chi=name,
+        namespace=ns,
+        hosts=hosts,
+        statefulsets=[h.statefulset for h in hosts],
+        pods=[] if stopped else [h.pod for h in hosts],
+        services=services + [h.service for h in hosts],
+        configmaps=[replace("chi-{chi}-common-configd", chi_macros), replace("chi-{chi}-common-usersd", chi_macros)] +
+        [h.configmap for h in hosts],
+        pvcs=[pvc for h in hosts for pvc in h.pvcs],
+    )
+
+
+def from_manifest(path, chits=(), ns=None):
+    # chits: CHIT objects or manifest paths
+    chits = [manifest.get(c).doc if isinstance(c, str) else c for c in chits]
+    return expand(manifest.get(path).doc, chits, ns)
+
+
+def object_counts(topology):
+    # Same format as create_and_check()'s check["object_counts"]
+    return {
+        "statefulset": len(topology.statefulsets),
+        "pod": len(topology.pods),
+        "service": len(topology.services),
+    }